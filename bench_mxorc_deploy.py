@@ -0,0 +1,213 @@
+"""Benchmarks the deploy path against local stand-in servers and saves the
+   results as JSON, so regressions are visible between versions."""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from os.path import dirname, join
+import paramiko
+import mxorc_deploy
+import mxorc_logger
+from mxorc_stub_server import StubServer
+
+LOGGER = mxorc_logger.get_logger(name="mxorc_deploy_bench")
+
+THIS_DIRECTORY = dirname(__file__)
+
+# the remote path every stand-in server maps into its own tree
+REMOTE_ALIAS = "/mxorc_bench/remote/"
+
+
+def main():
+    """The main function, parses args then runs every combination of file
+       count, file size, round trip time and host count
+    Globals:
+        LOGGER
+    Arguments:
+        none
+    Returns:
+        none
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", default="10,100",
+                        help="Comma separated file counts.")
+    parser.add_argument("--sizes", default="1024,65536",
+                        help="Comma separated file sizes in bytes.")
+    parser.add_argument("--rtt", default="0,0.02",
+                        help="Comma separated round trip times in seconds.")
+    parser.add_argument("--hosts", default="1,4",
+                        help="Comma separated host counts.")
+    parser.add_argument("--modes", default="sftp,bundle",
+                        help="Comma separated transfer modes, sftp or bundle.")
+    parser.add_argument("-o", "--output", default="bench_results.json",
+                        help="The JSON file the results are saved to.")
+    args = parser.parse_args()
+    mxorc_logger.configure()
+
+    results = []
+    key = paramiko.RSAKey.generate(1024)
+    for files in numbers(args.files, int):
+        for size in numbers(args.sizes, int):
+            for rtt in numbers(args.rtt, float):
+                for hosts in numbers(args.hosts, int):
+                    for mode in args.modes.split(","):
+                        result = run_scenario(key, files, size, rtt, hosts,
+                                              mode)
+                        LOGGER.info(
+                            "%4d files x %7d bytes, rtt %.3fs, %2d hosts, "
+                            "%-6s: cold %.2fs %.0f files/s %.0f bytes/s "
+                            "%d round trips, warm %.2fs %d round trips",
+                            files, size, rtt, hosts, mode,
+                            result["cold"]["seconds"],
+                            result["cold"]["files_per_second"],
+                            result["cold"]["bytes_per_second"],
+                            result["cold"]["round_trips"],
+                            result["warm"]["seconds"],
+                            result["warm"]["round_trips"])
+                        results.append(result)
+
+    with open(args.output, "w") as output:
+        json.dump({"version": version(), "python": platform.python_version(),
+                   "paramiko": paramiko.__version__, "timestamp": time.time(),
+                   "results": results}, output, indent=2, sort_keys=True)
+    LOGGER.info("Saved %d results to %s.", len(results), args.output)
+
+
+def numbers(values, kind):
+    """Parse a comma separated list of numbers
+    Globals:
+        none
+    Arguments:
+        values - the comma separated list
+        kind - int or float
+    Returns:
+        A list of numbers
+    """
+    return [kind(value) for value in values.split(",") if value]
+
+
+def version():
+    """The version being benchmarked
+    Globals:
+        THIS_DIRECTORY
+    Arguments:
+        none
+    Returns:
+        The git description of the working tree, or unknown
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=THIS_DIRECTORY or ".").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_scenario(key, files, size, rtt, hosts, mode):
+    """Deploy a folder to a fleet of stand-in servers twice, first to empty
+       hosts then again unchanged, measuring both
+    Globals:
+        none
+    Arguments:
+        key - the SSH key used for connectivity
+        files - the number of files in the folder
+        size - the size of every file in bytes
+        rtt - the latency injected into every request in seconds
+        hosts - the number of servers
+        mode - sftp or bundle
+    Returns:
+        A dictionary describing the scenario and its measurements
+    """
+    directory = tempfile.mkdtemp()
+    servers = []
+    try:
+        local_path = join(directory, "local", "bench")
+        os.makedirs(local_path)
+        for index in range(files):
+            with open(join(local_path, "script_%d.sh" % index), "wb") as script:
+                script.write(os.urandom(size))
+        configure(join(directory, "local") + "/", join(directory, "cache"))
+
+        for index in range(hosts):
+            root = join(directory, "remote_%d" % index) + "/"
+            os.makedirs(root)
+            servers.append(StubServer(root, alias=REMOTE_ALIAS, latency=rtt))
+
+        start = time.time()
+        connections = mxorc_deploy.fan_out(
+            lambda server: mxorc_deploy.SSHConnector(
+                "bench", "127.0.0.1", key, port=server.port), servers, hosts)
+        connect_seconds = time.time() - start
+        try:
+            cold = measure(connections, servers, mode, files * size)
+            warm = measure(connections, servers, mode, 0)
+        finally:
+            for ssh in connections:
+                ssh.close()
+    finally:
+        for server in servers:
+            server.stop()
+        shutil.rmtree(directory)
+
+    return {"files": files, "size": size, "rtt": rtt, "hosts": hosts,
+            "mode": mode, "connect_seconds": connect_seconds,
+            "cold": cold, "warm": warm}
+
+
+def measure(connections, servers, mode, folder_bytes):
+    """Deploy the folder to every host at once and measure it
+    Globals:
+        none
+    Arguments:
+        connections - an SSHConnector per server
+        servers - the stand-in servers
+        mode - sftp or bundle
+        folder_bytes - the bytes expected to be transferred per host
+    Returns:
+        A dictionary of the fan-out time, the throughput over all hosts and
+        the round trips per host
+    """
+    for server in servers:
+        server.reset()
+    start = time.time()
+    stats = mxorc_deploy.fan_out(
+        lambda ssh: mxorc_deploy.deploy("bench", ssh, bundle=mode == "bundle"),
+        connections, len(connections))
+    seconds = time.time() - start
+    deployed = sum(host["deployed"] for host in stats)
+    return {"seconds": seconds,
+            "deployed": deployed,
+            "failed": sum(host["failed"] for host in stats),
+            "files_per_second": deployed / seconds,
+            "bytes_per_second": folder_bytes * len(servers) / seconds,
+            "round_trips": sum(server.counters["requests"]
+                               for server in servers) // len(servers)}
+
+
+def configure(local_root, cache_directory):
+    """Point the deploy config at the benchmark's trees
+    Globals:
+        none
+    Arguments:
+        local_root - the local folder holding the folder being deployed
+        cache_directory - where to keep the hash cache
+    Returns:
+        none
+    """
+    config = mxorc_deploy.load_config()
+    if not config.has_section("Deploy Config"):
+        config.add_section("Deploy Config")
+    for option, value in (("timeout", "30"), ("deploy_attempts", "3"),
+                          ("local_path", local_root),
+                          ("remote_path", REMOTE_ALIAS),
+                          ("hash_cache_dir", cache_directory)):
+        config.set("Deploy Config", option, value)
+    mxorc_deploy.reset_settings()
+
+
+if __name__ == "__main__":
+    main()
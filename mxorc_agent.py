@@ -0,0 +1,840 @@
+"""Holds authenticated SSH sessions open between runs of mxorc_deploy, so
+   back-to-back invocations against the same hosts skip their handshakes."""
+import argparse
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import SocketServer
+from os.path import dirname, exists, isdir
+import paramiko
+from paramiko import SSHException
+import mxorc_deploy
+import mxorc_inventory
+import mxorc_logger
+
+LOGGER = mxorc_logger.get_logger(name="mxorc_agent")
+
+# the largest piece of data relayed between a client and a channel at once
+RELAY_SIZE = 32768
+
+# the frames of a relayed command: a stream byte, then a length, or the exit
+# status, and that many bytes of data
+FRAME = struct.Struct("!BI")
+STDOUT, STDERR, EXIT_STATUS = 1, 2, 3
+
+
+def main():
+    """The main function, parses args then serves sessions until stopped
+    Globals:
+        LOGGER
+    Arguments:
+        none
+    Returns:
+        none
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--socket",
+                        help="The Unix socket to listen on, defaults to "
+                        "agent_socket in the config.")
+    parser.add_argument("--stop", action="store_true",
+                        help="Stop the agent listening on the socket.")
+    args = parser.parse_args()
+    mxorc_logger.configure()
+    args.socket = args.socket or socket_path()
+
+    if args.stop:
+        if not request(args.socket, {"op": "stop"}):
+            LOGGER.error("No agent is listening on %s.", args.socket)
+            sys.exit(1)
+        return
+
+    if available(args.socket):
+        LOGGER.error("An agent is already listening on %s.", args.socket)
+        sys.exit(1)
+    try:
+        server = listen(args.socket)
+    except (OSError, ValueError) as error:
+        LOGGER.error("Could not listen on %s: %s", args.socket, error)
+        sys.exit(1)
+
+    pool = SessionPool(
+        mxorc_deploy.service_key(),
+        idle_timeout=mxorc_deploy.settings().agent_idle_timeout,
+        keepalive=mxorc_deploy.settings().agent_keepalive,
+        max_sessions=mxorc_deploy.settings().agent_max_sessions)
+    server.pool = pool
+    LOGGER.info("Agent listening on %s.", args.socket)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.close()
+        if exists(args.socket):
+            os.remove(args.socket)
+        LOGGER.info("Agent stopped.")
+
+
+def socket_path():
+    """The configured agent socket
+    Globals:
+        none
+    Arguments:
+        none
+    Returns:
+        The path of the Unix socket
+    """
+    return mxorc_deploy.settings().agent_socket
+
+
+def listen(path):
+    """Bind the agent's socket where only this user can reach it. Anyone able
+       to connect drives the authenticated sessions the agent holds, so the
+       socket is never accessible to others, not even until it is chmod'ed.
+    Globals:
+        none
+    Arguments:
+        path - the Unix socket to listen on
+    Returns:
+        An AgentServer, without a pool yet
+    Raises:
+        OSError - if the directory or socket could not be created
+        ValueError - if the socket's directory is not this user's alone
+    """
+    directory = dirname(path)
+    if not isdir(directory):
+        os.makedirs(directory, 0o700)
+    status = os.stat(directory)
+    if status.st_uid != os.getuid():
+        raise ValueError("%s is not owned by this user" % directory)
+    if status.st_mode & 0o077:
+        raise ValueError("%s is accessible to other users, chmod it to 700"
+                         % directory)
+    if exists(path):
+        os.remove(path)
+    umask = os.umask(0o077)
+    try:
+        return AgentServer(path, AgentHandler)
+    finally:
+        os.umask(umask)
+
+
+def connect(path, timeout=None):
+    """Open a connection to the agent
+    Globals:
+        none
+    Arguments:
+        path - the agent's Unix socket
+        timeout - the socket timeout in seconds, if any
+    Returns:
+        A connected socket
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def request(path, header, timeout=1):
+    """Send a request without data to the agent and read its answer
+    Globals:
+        none
+    Arguments:
+        path - the agent's Unix socket
+        header - the request, as a dictionary
+        timeout - seconds to wait for the agent
+    Returns:
+        The answer, as a dictionary, or None when no agent answered
+    """
+    try:
+        sock = connect(path, timeout)
+    except socket.error:
+        return None
+    try:
+        sock.sendall(json.dumps(header) + "\n")
+        return json.loads(sock.makefile("rb").readline())
+    except (socket.error, ValueError):
+        return None
+    finally:
+        sock.close()
+
+
+def available(path):
+    """Whether an agent is listening on a socket
+    Globals:
+        none
+    Arguments:
+        path - the agent's Unix socket
+    Returns:
+        True - if an agent answered
+        False - if none did
+    """
+    return exists(path) and bool(request(path, {"op": "ping"}))
+
+
+class SessionPool(object):
+
+    """ Authenticated SSHConnectors keyed by (user, host, port). Sessions are
+        kept alive with keepalives, closed after sitting idle and evicted
+        least recently used first once the pool is full.
+    """
+
+    def __init__(self, key, idle_timeout=300, keepalive=30, max_sessions=64):
+        """Session pool initialization, starts the reaper thread
+        Globals:
+            none
+        Arguments:
+            self
+            key - the SSH key used for connectivity
+            idle_timeout - seconds an unused session is kept open
+            keepalive - seconds between keepalives on every session
+            max_sessions - the most sessions kept open at once
+        Returns:
+            none
+        """
+        self.key = key
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.max_sessions = max_sessions
+        self.inventory = mxorc_inventory.Inventory(
+            mxorc_deploy.settings().host_inventory_path,
+            state_path=mxorc_deploy.settings().host_state_path)
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.closed = threading.Event()
+        self.reaper = threading.Thread(target=self.reap, name="reaper")
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def lease(self, user, host, port):
+        """Take a session, connecting or reconnecting it if needed. Every
+           lease has to be given back with release.
+        Globals:
+            LOGGER
+        Arguments:
+            self
+            user - the user being connected to
+            host - the host being connected to
+            port - the SSH port
+        Returns:
+            An SSHConnector
+        """
+        pool_key = (user, host, port)
+        with self.lock:
+            session = self.sessions.get(pool_key)
+            if session is None:
+                session = {"ssh": None, "leases": 0, "used": time.time(),
+                           "lock": threading.Lock()}
+                self.sessions[pool_key] = session
+            # counted before evicting, so a new session does not make room
+            # by evicting itself
+            session["leases"] += 1
+            session["used"] = time.time()
+            self.evict()
+
+        try:
+            with session["lock"]:
+                if session["ssh"] is None:
+                    session["ssh"] = mxorc_deploy.SSHConnector(
+                        user, host, self.key, port, self.inventory)
+                    session["ssh"].transport.set_keepalive(self.keepalive)
+                    self.inventory.save()
+                elif not session["ssh"].transport.is_active():
+                    session["ssh"].reconnect(session["ssh"].generation)
+                    session["ssh"].transport.set_keepalive(self.keepalive)
+                else:
+                    LOGGER.debug("Reusing the session to %s.", host)
+        except Exception:
+            self.release(user, host, port)
+            raise
+        return session["ssh"]
+
+    def release(self, user, host, port):
+        """Give a leased session back
+        Globals:
+            none
+        Arguments:
+            self
+            user - the user being connected to
+            host - the host being connected to
+            port - the SSH port
+        Returns:
+            none
+        """
+        with self.lock:
+            session = self.sessions[(user, host, port)]
+            session["leases"] -= 1
+            session["used"] = time.time()
+
+    def evict(self):
+        """Close the least recently used idle sessions until the pool has
+           room, must be called holding the lock
+        Globals:
+            LOGGER
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        idle = sorted((session["used"], pool_key)
+                      for pool_key, session in self.sessions.items()
+                      if not session["leases"])
+        while len(self.sessions) > self.max_sessions and idle:
+            pool_key = idle.pop(0)[1]
+            LOGGER.info("Evicting the session to %s.", pool_key[1])
+            self.drop(pool_key)
+
+    def reap(self):
+        """Close sessions that sat idle for longer than the idle timeout,
+           until the pool is closed
+        Globals:
+            LOGGER
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        while not self.closed.wait(min(self.idle_timeout, 5)):
+            with self.lock:
+                for pool_key, session in list(self.sessions.items()):
+                    if (not session["leases"] and
+                            time.time() - session["used"] > self.idle_timeout):
+                        LOGGER.info("Closing the idle session to %s.",
+                                    pool_key[1])
+                        self.drop(pool_key)
+
+    def drop(self, pool_key):
+        """Close and forget a session, must be called holding the lock
+        Globals:
+            none
+        Arguments:
+            self
+            pool_key - the session's (user, host, port)
+        Returns:
+            none
+        """
+        session = self.sessions.pop(pool_key)
+        if session["ssh"] is not None:
+            session["ssh"].close()
+
+    def close(self):
+        """Close every session and stop the reaper
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.closed.set()
+        self.reaper.join()
+        with self.lock:
+            for pool_key in list(self.sessions):
+                self.drop(pool_key)
+
+
+class AgentServer(SocketServer.ThreadingUnixStreamServer):
+
+    """ Serves every client connection on its own thread."""
+
+    daemon_threads = True
+    pool = None
+
+
+class AgentHandler(SocketServer.StreamRequestHandler):
+
+    """ Handles one request. The client sends a JSON header line, naming the
+        operation and, for sessions, the user, host and port:
+            ping - answers {"ok": true}
+            stop - answers {"ok": true}, then stops the agent
+            run  - reads "length" bytes of stdin, runs "command" with the
+                   channel timeout "timeout", if given, and answers
+                   {"status", "stdout", "stderr"} followed by that many
+                   bytes of stdout then stderr
+            sftp - opens an SFTP subsystem channel, answers {"ok": true} and
+                   then relays bytes both ways until either side closes
+            exec - starts "command", answers {"ok": true}, then relays what
+                   the client sends to its stdin until the client shuts
+                   down writing, and its stdout and stderr back in frames,
+                   ending with a frame holding its exit status
+        Failures are answered with {"error": message}.
+    """
+
+    def handle(self):
+        """Handle one request
+        Globals:
+            LOGGER
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        header = json.loads(self.rfile.readline())
+        operation = header.get("op")
+        if operation in ("ping", "stop"):
+            self.answer({"ok": True})
+            if operation == "stop":
+                threading.Thread(target=self.server.shutdown).start()
+            return
+
+        pool = self.server.pool
+        session = (header["user"], header["host"], int(header["port"]))
+        try:
+            ssh = pool.lease(*session)
+        # pylint: disable=broad-except
+        except Exception as error:
+            self.answer({"error": str(error) or error.__class__.__name__})
+            return
+        try:
+            if operation == "run":
+                data = self.rfile.read(header.get("length", 0))
+                status, output, error = ssh.run(header["command"], data,
+                                                header.get("timeout"))
+                self.answer({"status": status, "stdout": len(output),
+                             "stderr": len(error)})
+                self.wfile.write(output)
+                self.wfile.write(error)
+            elif operation == "sftp":
+                channel = ssh.transport.open_session(timeout=ssh.timeout)
+                channel.invoke_subsystem("sftp")
+                self.answer({"ok": True})
+                self.relay(channel)
+            elif operation == "exec":
+                channel = ssh.transport.open_session(timeout=ssh.timeout)
+                channel.exec_command(header["command"])
+                self.answer({"ok": True})
+                self.relay_command(channel)
+            else:
+                self.answer({"error": "Unknown operation %s" % operation})
+        except (SSHException, socket.error, EOFError) as error:
+            LOGGER.warning("%s on %s failed: %s", operation, session[1], error)
+            self.answer({"error": str(error) or error.__class__.__name__})
+        finally:
+            pool.release(*session)
+
+    def answer(self, message):
+        """Write an answer line to the client
+        Globals:
+            none
+        Arguments:
+            self
+            message - the answer, as a dictionary
+        Returns:
+            none
+        """
+        self.wfile.write(json.dumps(message) + "\n")
+        self.wfile.flush()
+
+    def relay(self, channel):
+        """Copy bytes between the client and a channel until either closes
+        Globals:
+            none
+        Arguments:
+            self
+            channel - the paramiko channel
+        Returns:
+            none
+        """
+        client = self.connection
+        try:
+            while True:
+                readable = select.select([client, channel], [], [])[0]
+                if client in readable:
+                    data = client.recv(RELAY_SIZE)
+                    if not data:
+                        break
+                    channel.sendall(data)
+                if channel in readable:
+                    data = channel.recv(RELAY_SIZE)
+                    if not data:
+                        break
+                    client.sendall(data)
+        finally:
+            channel.close()
+
+
+    def relay_command(self, channel):
+        """Feed a command's stdin from the client and send its output back
+           in frames until it exits
+        Globals:
+            FRAME
+        Arguments:
+            self
+            channel - the paramiko channel running the command
+        Returns:
+            none
+        """
+        client = self.connection
+        reading = True
+        try:
+            while True:
+                # stderr does not wake select, so poll
+                readable = select.select(
+                    [client, channel] if reading else [channel], [], [],
+                    0.1)[0]
+                if client in readable:
+                    data = client.recv(RELAY_SIZE)
+                    if data:
+                        channel.sendall(data)
+                    else:
+                        channel.shutdown_write()
+                        reading = False
+                # the exit status arrives after all of the output
+                exited = channel.exit_status_ready()
+                while channel.recv_ready():
+                    self.frame(STDOUT, channel.recv(RELAY_SIZE))
+                while channel.recv_stderr_ready():
+                    self.frame(STDERR, channel.recv_stderr(RELAY_SIZE))
+                if exited:
+                    self.frame(EXIT_STATUS, status=channel.recv_exit_status())
+                    break
+        finally:
+            channel.close()
+
+    def frame(self, stream, data=b"", status=None):
+        """Write a frame to the client
+        Globals:
+            FRAME
+        Arguments:
+            self
+            stream - STDOUT, STDERR or EXIT_STATUS
+            data - the bytes of output
+            status - the exit status, for an EXIT_STATUS frame
+        Returns:
+            none
+        """
+        self.wfile.write(FRAME.pack(stream, len(data) if status is None
+                                    else status) + data)
+        self.wfile.flush()
+
+
+class AgentCommand(object):
+
+    """ A command relayed through the agent, with the parts of a paramiko
+        channel that Connector.run and the streaming uploads use. Its output
+        arrives in frames, each one buffered until read.
+    """
+
+    def __init__(self, sock, reader):
+        """Agent command initialization
+        Globals:
+            none
+        Arguments:
+            self
+            sock - the socket connected to the agent's relay
+            reader - a file reading from the socket
+        Returns:
+            none
+        """
+        self.sock = sock
+        self.reader = reader
+        self.buffers = {STDOUT: [], STDERR: []}
+        self.status = None
+
+    def sendall(self, data):
+        """Write bytes to the command's stdin"""
+        self.sock.sendall(data)
+
+    def shutdown_write(self):
+        """Close the command's stdin"""
+        self.sock.shutdown(socket.SHUT_WR)
+
+    def receive(self):
+        """Read one frame from the agent
+        Globals:
+            FRAME
+        Arguments:
+            self
+        Returns:
+            none
+        Raises:
+            SSHException - if the agent hung up before the command exited
+        """
+        header = self.reader.read(FRAME.size)
+        if len(header) < FRAME.size:
+            raise SSHException("The agent hung up.")
+        stream, length = FRAME.unpack(header)
+        if stream == EXIT_STATUS:
+            self.status = length
+            self.sock.close()
+            return
+        data = self.reader.read(length)
+        if len(data) < length:
+            raise SSHException("The agent hung up.")
+        self.buffers[stream].append(data)
+
+    def read(self, stream, size=None):
+        """Read output of the command
+        Globals:
+            none
+        Arguments:
+            self
+            stream - STDOUT or STDERR
+            size - the most bytes read, all of it until the command exits if
+                   None
+        Returns:
+            The bytes read
+        """
+        while self.status is None and (
+                size is None or
+                sum(len(data) for data in self.buffers[stream]) < size):
+            self.receive()
+        data = b"".join(self.buffers[stream])
+        if size is None:
+            size = len(data)
+        self.buffers[stream] = [data[size:]] if data[size:] else []
+        return data[:size]
+
+    def recv_exit_status(self):
+        """Wait for the command to exit, returns its exit status"""
+        while self.status is None:
+            self.receive()
+        return self.status
+
+    def makefile(self, mode="r"):
+        """The command's stdin or stdout"""
+        return AgentCommandFile(self, STDOUT if "r" in mode else None)
+
+    def makefile_stderr(self, mode="r"):
+        """The command's stderr"""
+        return AgentCommandFile(self, STDERR)
+
+    def close(self):
+        """Close the relay"""
+        self.sock.close()
+
+
+class AgentCommandFile(object):
+
+    """ One of the streams of an AgentCommand, as a file."""
+
+    def __init__(self, channel, stream):
+        """Agent command file initialization
+        Globals:
+            none
+        Arguments:
+            self
+            channel - the AgentCommand
+            stream - STDOUT or STDERR to read, None to write stdin
+        Returns:
+            none
+        """
+        self.channel = channel
+        self.stream = stream
+
+    def read(self, size=None):
+        """Read output, all of it until the command exits if no size"""
+        return self.channel.read(self.stream, size)
+
+    def write(self, data):
+        """Write bytes to stdin"""
+        self.channel.sendall(data)
+
+    def flush(self):
+        """Nothing is buffered"""
+        pass
+
+    def close(self):
+        """Close stdin, output needs no closing"""
+        if self.stream is None:
+            self.channel.shutdown_write()
+
+
+class AgentChannel(object):
+
+    """ Lets paramiko's SFTPClient talk through an agent relay as if it was
+        an SSH channel.
+    """
+
+    def __init__(self, sock, name):
+        """Agent channel initialization
+        Globals:
+            none
+        Arguments:
+            self
+            sock - the socket connected to the agent's relay
+            name - the name used in paramiko's log lines
+        Returns:
+            none
+        """
+        self.sock = sock
+        self.name = name
+        self.closed = False
+
+    def send(self, data):
+        """Send bytes, returns the number sent"""
+        return self.sock.send(data)
+
+    def recv(self, size):
+        """Receive up to size bytes"""
+        return self.sock.recv(size)
+
+    def settimeout(self, timeout):
+        """Set the socket timeout"""
+        self.sock.settimeout(timeout)
+
+    def get_name(self):
+        """The name used in paramiko's log lines"""
+        return self.name
+
+    def close(self):
+        """Close the relay"""
+        self.closed = True
+        self.sock.close()
+
+
+class AgentConnector(mxorc_deploy.Connector):
+
+    """ Leases sessions from a running agent instead of connecting, with the
+        same interface as SSHConnector. Every command and SFTP session is
+        relayed over its own connection to the agent.
+    """
+
+    def __init__(self, user, host, port, path):
+        """Agent connector initialization, opens the first SFTP session
+        Globals:
+            LOGGER, DEPLOY_CONFIG
+        Arguments:
+            self
+            user - the user being connected to
+            host - the host being connected to
+            port - the SSH port
+            path - the agent's Unix socket
+        Returns:
+            none
+        """
+        mxorc_deploy.Connector.__init__(self, user, host, port)
+        self.path = path
+        self.generation = 1
+        LOGGER.info("Leasing a session to %s as %s from the agent.", host,
+                    user)
+        with mxorc_deploy.METRICS.span(host, "connect"):
+            self.sftp = self.open_sftp()
+
+    def request(self, header, data=b"", timeout=None):
+        """Send a session request to the agent and read its answer
+        Globals:
+            none
+        Arguments:
+            self
+            header - the request, as a dictionary
+            data - bytes sent after the header
+            timeout - seconds to wait for the answer, defaults to the
+                      configured timeout
+        Returns:
+            The connected socket, a file reading from it and the answer
+        Raises:
+            SSHException - if the agent failed the request
+        """
+        header.update({"user": self.user, "host": self.host,
+                       "port": self.port, "length": len(data)})
+        sock = connect(self.path, timeout or self.timeout)
+        reader = None
+        try:
+            sock.sendall(json.dumps(header) + "\n")
+            sock.sendall(data)
+            reader = sock.makefile("rb", 0)
+            answer = json.loads(reader.readline() or "{}")
+        except (socket.error, ValueError) as error:
+            sock.close()
+            raise SSHException("The agent failed: %s" % error)
+        if "error" in answer or not answer:
+            sock.close()
+            raise SSHException(answer.get("error", "The agent hung up."))
+        return sock, reader, answer
+
+    def exec_command(self, command, timeout=None):
+        """Start a command through the agent, streaming its stdin and output
+        Globals:
+            none
+        Arguments:
+            self
+            command - the command to execute
+            timeout - the socket timeout, defaults to the configured timeout
+        Returns:
+            The stdin, stdout and stderr of the command, as file like objects
+        """
+        sock, reader, _ = self.request({"op": "exec", "command": command})
+        sock.settimeout(timeout or self.timeout)
+        channel = AgentCommand(sock, reader)
+        return (channel.makefile("wb"), channel.makefile("r"),
+                channel.makefile_stderr("r"))
+
+    def run(self, command, data=None, timeout=None):
+        """Execute a command through the agent and wait for it to finish
+        Globals:
+            none
+        Arguments:
+            self
+            command - the command to execute
+            data - optional bytes written to the command's stdin
+            timeout - the socket timeout, defaults to the configured timeout
+        Returns:
+            The exit status, stdout and stderr of the command
+        """
+        mxorc_deploy.METRICS.count(self.host, "round_trips")
+        # the answer only comes once the command is done, so the agent and
+        # the wait for the answer both use the command's timeout
+        sock, reader, answer = self.request(
+            {"op": "run", "command": command, "timeout": timeout},
+            data or b"", timeout)
+        try:
+            output = reader.read(answer["stdout"])
+            error = reader.read(answer["stderr"])
+        finally:
+            sock.close()
+        return answer["status"], output, error
+
+    def open_sftp(self):
+        """Open another SFTP session relayed through the agent
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            A paramiko SFTPClient, the caller has to close it
+        """
+        sock, _, _ = self.request({"op": "sftp"})
+        return paramiko.SFTPClient(AgentChannel(sock, self.host))
+
+    def reconnect(self, generation):
+        """The agent reconnects dropped sessions itself, only the relays of
+           the failed generation are replaced
+        Globals:
+            none
+        Arguments:
+            self
+            generation - the connection generation the caller failed on
+        Returns:
+            none
+        """
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.generation += 1
+            self.sftp.close()
+            self.sftp = self.open_sftp()
+
+    def close(self):
+        """Close the SFTP relay, the session stays open in the agent
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        if self.sftp is not None:
+            self.sftp.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,102 @@
 """Deploys or removes a specified folder of Bash scripts to/from hosts."""
 import argparse
+import hashlib
+import json
 import logging
+import mmap
+import os
+import random
+import re
+import socket
+import sys
+import tarfile
+import threading
+import time
 import ConfigParser
+import Queue
+from multiprocessing.pool import ThreadPool
 from socket import gaierror
 from os import listdir
-from os.path import isfile, join, dirname
+from os.path import (abspath, basename, dirname, expanduser, isdir, isfile,
+                     islink, join)
 from hashlib import md5
-import paramiko
-from paramiko import SSHException
+from pipes import quote
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+import mxorc_inventory
 import mxorc_logger
+import mxorc_metrics
 
 THIS_DIRECTORY = dirname(__file__)
+DEPLOY_CONFIG_PATH = join(THIS_DIRECTORY, "conf/mxorc_deploy.conf")
 
+# the config file is read on first use, so --help and argument errors never
+# touch it, then parsed once into SETTINGS
 DEPLOY_CONFIG = ConfigParser.ConfigParser()
-DEPLOY_CONFIG.read(join(THIS_DIRECTORY, "conf/mxorc_deploy.conf"))
+CONFIG_LOADED = False
+SETTINGS = None
+SETTINGS_LOCK = threading.Lock()
+
+# the private key, loaded once and shared by every host
+SERVICE_KEY = None
+
+# marks a setting without a default, reading it while unset raises
+# ConfigParser.NoOptionError
+REQUIRED = object()
 
 LOGGER = mxorc_logger.get_logger(name="mxorc_deploy")
 logging.getLogger("paramiko").setLevel(logging.WARNING)
 
+# the timing spans of every phase, recorded when a report is asked for
+METRICS = mxorc_metrics.Recorder()
+
+# hash caches are shared between hosts deploying the same folder
+HASH_CACHES = {}
+HASH_CACHES_LOCK = threading.Lock()
+
+# most file names handed to one remote command
+MANIFEST_BATCH = 500
+
+# the checksum algorithms a host can be asked for, by name, with the remote
+# command computing them and the local constructor, None where this Python
+# lacks it
+HASH_ALGORITHMS = {
+    "blake2b": ("b2sum", blake2b),
+    "sha256": ("sha256sum", hashlib.sha256),
+    "md5": ("md5sum", md5),
+}
+
+# files at least this large are hashed through mmap instead of read()
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+# the bytes read or hashed at once
+HASH_CHUNK = 1024 * 1024
+
+# the escapes md5sum uses for names holding a backslash or newline
+ESCAPE_PATTERN = re.compile(r"\\(.)")
+
 def main():
-    """The main function, parses args then defines an SSH connection, then
-        then executes deploy or remove, based on arguments
+    """The main function, parses args then fans out over the target hosts,
+        executing deploy or remove on each, based on arguments
     Globals:
         LOGGER, DEPLOY_CONFIG
     Arguments:
         none
     Returns:
-        none
+        0 - if every host succeeded or was skipped
+        1 - if any host failed
     """
     parser = argparse.ArgumentParser()
     parser_action = parser.add_mutually_exclusive_group(required=True)
@@ -34,270 +104,2859 @@ def main():
                                help="Deploy script folder to hosts.")
     parser_action.add_argument("-r", "--remove", action="store_true",
                                help="Remove script folder from hosts.")
-    parser.add_argument("-f", "--folder", required=True,
+    parser_action.add_argument("-c", "--gc", action="store_true",
+                               help="Delete the blobs of the hosts' blob "
+                               "store that no deployed file links to.")
+    parser_action.add_argument("--rollback", action="store_true",
+                               help="Switch a staged folder back to its "
+                               "previous release.")
+    parser.add_argument("-f", "--folder",
                         help="Folder of scripts to deploy/remove"
                         " to/from hosts.")
-    parser.add_argument("-t", "--target", required=True,
-                        help="The host to deploy to.")
+    parser.add_argument("-t", "--target", action="append", default=[],
+                        help="The host(s) to deploy to. May be repeated or "
+                        "given as a comma separated list.")
+    parser.add_argument("-i", "--inventory",
+                        help="File listing hosts to deploy to, one per line.")
+    parser.add_argument("-g", "--group", action="append", default=[],
+                        help="Deploy to every host of this group in the host "
+                        "inventory, \"all\" for every host. May be repeated.")
+    parser.add_argument("-p", "--parallel", type=int,
+                        help="Maximum number of hosts worked on at once, "
+                        "defaults to max_parallel in the config.")
+    parser.add_argument("-w", "--window", type=int,
+                        help="Maximum number of files uploaded to a host at "
+                        "once, defaults to upload_window in the config.")
+    parser.add_argument("--no-agent", action="store_true",
+                        help="Connect directly even if an agent is running.")
+    parser.add_argument("-R", "--recursive", action="store_true",
+                        help="Deploy/remove the whole tree under the folder, "
+                        "deploys also remove remote files deleted locally.")
+    parser.add_argument("-b", "--bundle", action="store_true",
+                        help="Stream changed files as one compressed tar "
+                        "instead of uploading them one by one.")
+    parser.add_argument("-s", "--store", action="store_true",
+                        help="Upload each unique file once per host into a "
+                        "blob store and hardlink the folder's files to it, "
+                        "defaults to blob_store in the config. Removes "
+                        "then also delete unreferenced blobs.")
+    parser.add_argument("--relay", action="store_true",
+                        help="Deploy to relay_seeds hosts per inventory group "
+                        "first, then have every verified host forward the "
+                        "changed files to relay_branching more over SSH.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep deploying: poll the local folder and push "
+                        "changed and deleted files to the hosts until "
+                        "interrupted.")
+    parser.add_argument("--staged", action="store_true",
+                        help="Deploy into a new release and switch the "
+                        "folder's symlink to it once verified, defaults to "
+                        "staged_releases in the config.")
+    parser.add_argument("--plan", action="store_true",
+                        help="Only print what a deploy would add, change and "
+                        "remove on each host, writing nothing. A deploy "
+                        "within manifest_cache_ttl seconds then reuses the "
+                        "hosts' manifests instead of fetching them again.")
+    parser.add_argument("--plan-file",
+                        help="Also write the plan to this JSON file.")
+    parser.add_argument("--report",
+                        help="Write the timings of every phase per host to "
+                        "this JSON file, defaults to metrics_report in the "
+                        "config.")
+    parser.add_argument("--prometheus",
+                        help="Write the timings of every phase per host to "
+                        "this Prometheus textfile collector file, defaults "
+                        "to metrics_textfile in the config.")
+    parser.add_argument("--log-format", choices=("text", "json"),
+                        help="Write log records as text or as JSON lines, "
+                        "defaults to log_format in the config.")
     args = parser.parse_args()
+    if not args.gc and not args.folder:
+        parser.error("argument -f/--folder is required")
+    if args.parallel is not None and args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    if (args.plan or args.plan_file) and (not args.deploy or args.watch):
+        parser.error("--plan only works with -d/--deploy, without --watch")
+    args.plan = args.plan or bool(args.plan_file)
+
+    # only now that the arguments are known to be good, read the config
+    try:
+        config = settings()
+        user = config.user
+    except (ConfigParser.Error, ValueError) as error:
+        parser.error("%s: %s" % (DEPLOY_CONFIG_PATH, error))
+    mxorc_logger.configure()
+    # planning only reads, so it goes as wide as the pre-flight checks
+    args.parallel = args.parallel or (config.max_preflight if args.plan
+                                      else config.max_parallel)
+    args.manifests = ManifestCache(config.manifest_cache_path,
+                                   config.manifest_cache_ttl) \
+        if args.deploy else None
+    args.store = args.store or config.blob_store
+    args.staged = args.staged or config.staged_releases
+    if args.watch and (not args.deploy or args.staged or args.relay):
+        parser.error("--watch only works with -d/--deploy, without --staged "
+                     "or --relay")
+    args.report = args.report or config.metrics_report
+    args.prometheus = args.prometheus or config.metrics_textfile
+    METRICS.enabled = bool(args.report or args.prometheus)
+
+    # keep the workers off the log handlers, a listener thread writes for
+    # them and is flushed at exit
+    if config.log_queue:
+        mxorc_logger.start_queue(
+            config.log_queue_size, config.log_overflow,
+            json_output=(args.log_format or config.log_format) == "json")
+
+    host_inventory = mxorc_inventory.Inventory(
+        config.host_inventory_path, resolve_ttl=config.resolve_ttl,
+        probe_timeout=config.probe_timeout,
+        state_path=config.host_state_path)
+    hosts = parse_targets(args.target + [",".join(host_inventory.hosts(group))
+                                         for group in args.group],
+                          args.inventory)
+    if not hosts:
+        parser.error("at least one host is required, use -t, -i or -g")
 
+    connect = connector(user, host_inventory, use_agent=not args.no_agent)
+
+    # find unresolvable and unreachable hosts before connecting to any
+    unreachable = host_inventory.preflight(hosts, config.port,
+                                           config.max_preflight)
+
+    # act on every host according to parsed arguments
+    reachable = [host for host in hosts if host not in unreachable]
+    if args.plan:
+        results = fan_out(lambda host: plan_host(host, args, connect),
+                          reachable, args.parallel)
+        results.extend({"host": host, "status": "failed", "add": [],
+                        "change": [], "remove": [], "unchanged": 0,
+                        "error": "pre-flight: %s" % error}
+                       for host, error in unreachable.items())
+        args.manifests.save()
+        host_inventory.save()
+        print(format_plan(results))
+        if args.plan_file:
+            with open(args.plan_file, "w") as plan_file:
+                json.dump({"folder": args.folder, "planned": time.time(),
+                           "hosts": results}, plan_file, indent=2,
+                          sort_keys=True)
+        return int(any(result["status"] == "failed" for result in results))
+    if args.watch:
+        status = watch(reachable, args, connect)
+        host_inventory.save()
+        return status
+    if args.deploy and args.relay:
+        results = relay_deploy(reachable, args, connect, host_inventory)
+    else:
+        results = fan_out(lambda host: run_host(host, args, connect),
+                          reachable, args.parallel)
+    results.extend({"host": host, "status": "failed", "duration": 0.0,
+                    "retries": 0, "error": "pre-flight: %s" % error}
+                   for host, error in unreachable.items())
+    if args.manifests is not None:
+        args.manifests.save()
+    host_inventory.save()
+    log_summary(results)
+    if args.report:
+        METRICS.write_report(args.report)
+    if args.prometheus:
+        METRICS.write_textfile(args.prometheus)
+    return int(any(result["status"] == "failed" for result in results))
+
+
+def connector(user, inventory, use_agent=True):
+    """Pick how hosts are connected to, through the agent's sessions when
+       one is running, directly with the service key otherwise
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        user - the user to connect as
+        inventory - the Inventory holding the hosts' ports, addresses and keys
+        use_agent - whether a running agent may be used
+    Returns:
+        A function called with a host, returning its Connector
+    """
+    # imported here, the agent's connector builds on Connector
+    import mxorc_agent
+
+    config = settings()
+    agent_path = mxorc_agent.socket_path()
+    if use_agent and mxorc_agent.available(agent_path):
+        # lease sessions the agent already holds, skipping the handshakes
+        LOGGER.info("Using the agent on %s.", agent_path)
+        return lambda host: mxorc_agent.AgentConnector(
+            user, host, inventory.port(host, config.port), agent_path)
     # capture key from file
-    service_key = paramiko.RSAKey.from_private_key(open(
-        DEPLOY_CONFIG.get("Deploy Config", "private_key_path")))
+    key = service_key()
+    return lambda host: SSHConnector(user, host, key, inventory=inventory)
+
+
+def load_config():
+    """Read the config file into DEPLOY_CONFIG, once
+    Globals:
+        DEPLOY_CONFIG, CONFIG_LOADED
+    Arguments:
+        none
+    Returns:
+        DEPLOY_CONFIG
+    """
+    global CONFIG_LOADED
+    with SETTINGS_LOCK:
+        if not CONFIG_LOADED:
+            DEPLOY_CONFIG.read(DEPLOY_CONFIG_PATH)
+            CONFIG_LOADED = True
+    return DEPLOY_CONFIG
 
-    # create connections, then act according to parsed arguments
-    ssh = SSHConnector(DEPLOY_CONFIG.get("Deploy Config", "user"), args.target,
-                       service_key)
-    if args.deploy:
-        deploy(args.folder, ssh)
-    elif args.remove:
-        remove(args.folder, ssh)
 
-    # close connections to prevent hanging
-    LOGGER.info("Closing connections.")
-    ssh.ssh.close()
-    ssh.sftp.close()
-    LOGGER.info("Successfully closed connections.")
+def settings():
+    """The Deploy Config section, parsed and validated on first use
+    Globals:
+        SETTINGS, SETTINGS_LOCK
+    Arguments:
+        none
+    Returns:
+        The Settings
+    Raises:
+        ValueError - if an option holds a value of the wrong type or range
+    """
+    global SETTINGS
+    if SETTINGS is None:
+        load_config()
+        with SETTINGS_LOCK:
+            if SETTINGS is None:
+                SETTINGS = Settings(DEPLOY_CONFIG)
+    return SETTINGS
 
-# pylint: disable=too-few-public-methods
-class SSHConnector(object):
 
-    """ Creates an SSH and SFTP connection that allows for directly using
-        paramiko. Only starts the instance with some error checking. Other
-        errors related to execution of commands should be caught where those
-        commands are called.
+def reset_settings():
+    """Forget the parsed settings and key, so changes made to DEPLOY_CONFIG
+       are picked up on the next use
+    Globals:
+        SETTINGS, SERVICE_KEY
+    Arguments:
+        none
+    Returns:
+        none
     """
+    global SETTINGS, SERVICE_KEY
+    with SETTINGS_LOCK:
+        SETTINGS = None
+        SERVICE_KEY = None
 
-    def __init__(self, user, host, key):
-        """SSH initializaton
+
+def service_key():
+    """The configured private key, read from its file once
+    Globals:
+        SERVICE_KEY, SETTINGS_LOCK
+    Arguments:
+        none
+    Returns:
+        A paramiko RSAKey
+    """
+    global SERVICE_KEY
+    import paramiko
+    key_path = settings().private_key_path
+    with SETTINGS_LOCK:
+        if SERVICE_KEY is None:
+            with open(key_path) as key_file:
+                SERVICE_KEY = paramiko.RSAKey.from_private_key(key_file)
+        return SERVICE_KEY
+
+
+def choice(*values):
+    """A setting type accepting only some values
+    Globals:
+        none
+    Arguments:
+        values - the accepted values
+    Returns:
+        A function checking and returning a value
+    """
+    def convert(value):
+        """Check the value is one of the accepted ones"""
+        if value not in values:
+            raise ValueError("must be one of %s" % ", ".join(values))
+        return value
+    return convert
+
+
+def boolean(value):
+    """A setting type for on/off switches
+    Globals:
+        none
+    Arguments:
+        value - the configured string
+    Returns:
+        True or False
+    """
+    if value.lower() in ("on", "true", "yes", "1"):
+        return True
+    if value.lower() in ("off", "false", "no", "0"):
+        return False
+    raise ValueError("must be on or off")
+
+
+def algorithms(value):
+    """A setting type for an ordered list of checksum algorithms, the ones
+       this Python can not compute are left out
+    Globals:
+        HASH_ALGORITHMS
+    Arguments:
+        value - the comma separated names, most preferred first
+    Returns:
+        A list of algorithm names, ending with md5 if it was not named
+    """
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    for name in names:
+        if name not in HASH_ALGORITHMS:
+            raise ValueError("unknown algorithm %s, use %s" % (
+                name, ", ".join(sorted(HASH_ALGORITHMS))))
+    return [name for name in names if HASH_ALGORITHMS[name][1]] + (
+        [] if "md5" in names else ["md5"])
+
+
+def cpu_count():
+    """The number of local processors, 1 if unknown
+    Globals:
+        none
+    Arguments:
+        none
+    Returns:
+        The processor count
+    """
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def path(value):
+    """A setting type for local paths, expanding ~
+    Globals:
+        none
+    Arguments:
+        value - the configured string
+    Returns:
+        The expanded path
+    """
+    return expanduser(value)
+
+
+class Settings(object):
+
+    """ The Deploy Config section parsed once into typed values, read as
+        attributes. Values are checked when parsed, so a bad config fails
+        before any host is connected to instead of halfway through a run.
+    """
+
+    # option, type, default and the lowest number allowed
+    OPTIONS = (
+        ("user", str, REQUIRED, None),
+        ("private_key_path", path, REQUIRED, None),
+        ("timeout", int, REQUIRED, 1),
+        ("deploy_attempts", int, REQUIRED, 0),
+        ("local_path", str, REQUIRED, None),
+        ("remote_path", str, REQUIRED, None),
+        ("port", int, 22, 1),
+        ("banner_timeout", int, None, 1),
+        ("auth_timeout", int, None, 1),
+        ("max_parallel", int, 8, 1),
+        ("max_preflight", int, 64, 1),
+        ("upload_window", int, 4, 1),
+        ("retry_backoff", float, 1.0, 0),
+        ("retry_backoff_max", float, 30.0, 0),
+        ("host_inventory_path", path,
+         join(THIS_DIRECTORY, "conf/mxorc_inventory.conf"), None),
+        ("host_state_path", path, None, None),
+        ("resolve_ttl", int, 300, 0),
+        ("probe_timeout", int, 3, 1),
+        ("hash_cache_dir", path, expanduser("~/.cache/mxorc_deploy"), None),
+        ("hash_algorithms", algorithms, algorithms("blake2b,sha256,md5"),
+         None),
+        ("hash_workers", int, cpu_count(), 1),
+        ("blob_store", boolean, False, None),
+        ("blob_store_dir", str, ".mxorc_store", None),
+        ("blob_gc_grace", int, 60, 0),
+        ("staged_releases", boolean, False, None),
+        ("releases_kept", int, 5, 0),
+        ("watch_interval", float, 0.1, 0.01),
+        ("watch_debounce", float, 0.2, 0),
+        ("manifest_cache_path", path,
+         expanduser("~/.cache/mxorc_deploy/manifests.json"), None),
+        ("manifest_cache_ttl", int, 300, 0),
+        ("manifest_timeout", int, 600, 1),
+        ("relay_seeds", int, 1, 1),
+        ("relay_branching", int, 4, 1),
+        ("relay_ssh_options", str, "-o BatchMode=yes -o ConnectTimeout=10",
+         None),
+        ("relay_timeout", int, 3600, 1),
+        ("metrics_report", path, None, None),
+        ("metrics_textfile", path, None, None),
+        ("log_queue", boolean, True, None),
+        ("log_queue_size", int, 10000, 0),
+        ("log_overflow", choice(*mxorc_logger.OVERFLOW_POLICIES), "block",
+         None),
+        ("log_format", choice("text", "json"), "text", None),
+        ("tomcat_servers_dir", str, "/opt/tomcat/servers", None),
+        ("instance_index_path", path,
+         expanduser("~/.cache/mxorc_deploy/instances.json"), None),
+        ("instance_index_ttl", int, 60, 0),
+        ("tomcat_control_user", str, "swacat", None),
+        ("rolling_batch_size", int, 1, 1),
+        ("rolling_max_failures", int, 0, 0),
+        ("rolling_health_timeout", int, 120, 0),
+        ("rolling_health_interval", float, 1.0, 0.1),
+        ("rolling_settle", int, 0, 0),
+        ("agent_socket", path, expanduser("~/.cache/mxorc_deploy/agent.sock"),
+         None),
+        ("agent_idle_timeout", int, 300, 0),
+        ("agent_keepalive", int, 30, 0),
+        ("agent_max_sessions", int, 64, 1))
+
+    def __init__(self, config, section="Deploy Config"):
+        """Settings initialization, parses and checks every option
         Globals:
-            LOGGER, DEPLOY_CONFIG
+            none
         Arguments:
             self
-            host - the host being connected to
-            user - the user being connected to
-            key - the SSH key used for connectivity
+            config - the ConfigParser holding the section
+            section - the section's name
         Returns:
             none
+        Raises:
+            ValueError - if an option holds a value of the wrong type or range
         """
-        # Build ssh connections, catch a bad key and a failed connection
-        LOGGER.info("Attempting to make SSH connection to %s as %s.", host, user)
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.section = section
+        self.values = {}
+        for option, kind, default, minimum in self.OPTIONS:
+            if not config.has_option(section, option):
+                if default is not REQUIRED:
+                    self.values[option] = default
+                continue
+            try:
+                value = kind(config.get(section, option))
+            except ValueError as error:
+                raise ValueError("%s: %s" % (option, error))
+            if minimum is not None and value < minimum:
+                raise ValueError("%s: must be at least %s" % (option, minimum))
+            self.values[option] = value
+
+    def __getattr__(self, option):
         try:
-            self.ssh.connect(hostname=host, username=user, pkey=key,
-                             timeout=int(DEPLOY_CONFIG.get("Deploy Config", "timeout")))
-        except AttributeError as error:
-            LOGGER.error("Cannot connect to %s with the user %s, no key was "
-                         "provided. Use paramiko.RSAKey.from_private_key(open"
-                         "(SERVICE_KEY_FILENAME)) to turn a key file into an "
-                         "usable key.", host, user)
-            LOGGER.error(error)
-            raise
-        except paramiko.ssh_exception.AuthenticationException as error:
-            LOGGER.error("Cannot connect to %s with the user %s, the ssh"
-                         " authentication failed.", host, user)
-            LOGGER.error(error)
-            raise
-        LOGGER.info("Successfully made SSH connection to %s as %s.", host, user)
+            return self.__dict__["values"][option]
+        except KeyError:
+            raise ConfigParser.NoOptionError(option, self.section)
+
 
-        # build transport, and catch ssh failures and malconfigurations
-        LOGGER.info("Attempting to make SFTP connection to  %s as %s.",
-                    host, user)
-        self.transport = paramiko.Transport((host, 22))
+def parse_targets(targets, inventory=None):
+    """Build the ordered, de-duplicated list of hosts to act on
+    Globals:
+        LOGGER
+    Arguments:
+        targets - the values of every -t flag, each may be comma separated
+        inventory - an optional file listing one host per line, blank lines
+                    and lines starting with # are ignored
+    Returns:
+        A list of host names
+    """
+    names = []
+    for target in targets:
+        names.extend(target.split(","))
+    if inventory:
         try:
-            self.transport.connect(username=user, pkey=key)
-        except SSHException as error:
-            LOGGER.error("Cannot connect to %s with the user %s, the transport"
-                         " authentication failed.", host, user)
-            LOGGER.error(error)
-            raise
-        except gaierror as error:
-            LOGGER.error("Your connection details are malconfigured.")
-            LOGGER.error(error)
+            with open(inventory) as inventory_file:
+                names.extend(line.split("#", 1)[0] for line in inventory_file)
+        except IOError:
+            LOGGER.error("%s could not be read.", inventory)
             raise
-        self.sftp = paramiko.SFTPClient.from_transport(self.transport)
-        LOGGER.info("Sucessfully made SFTP connection to %s as %s.", host, user)
 
-        LOGGER.info("Successfully set up connections.")
+    hosts = []
+    for name in names:
+        name = name.strip()
+        if name and name not in hosts:
+            hosts.append(name)
+    return hosts
 
 
-def deploy(folder, ssh, retry=0):
-    """Deploy a folder to specified host. Sets up an ssh connection with
-       the SSHConnector class, then uses that connection to loop through a
-       listing of files to deploy. It also deploys a checksum then validates it.
+def fan_out(function, hosts, max_parallel):
+    """Call a function for every host from a bounded pool of worker threads,
+       so the wall-clock time follows the slowest host rather than the sum
     Globals:
-        LOGGER, DEPLOY_CONFIG
+        none
     Arguments:
-        folder - the folder being deployed
-        ssh - the ssh connection
+        function - called with a single host, returns that host's result
+        hosts - the hosts to call the function for
+        max_parallel - the most hosts worked on at the same time
     Returns:
+        A list of results, in the same order as hosts
+    """
+    if not hosts:
+        return []
+    pool = ThreadPool(min(max_parallel, len(hosts)))
+    try:
+        return pool.map(function, hosts, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def relay_tree(hosts, inventory, seeds, branching):
+    """Arrange hosts into one relay tree per inventory group. The first
+       seeds hosts of a group are deployed to directly, every other host is
+       fed by a host of its group, each feeding at most branching hosts, so
+       the number of waves grows with the logarithm of the group's size.
+    Globals:
         none
+    Arguments:
+        hosts - the hosts to deploy to
+        inventory - the Inventory recording the hosts' groups
+        seeds - the hosts per group deployed to directly
+        branching - the most hosts fed by one host
+    Returns:
+        A dictionary of host to the host feeding it, None for seeds
     """
-    deploy_attempts = DEPLOY_CONFIG.get("Deploy Config", "deploy_attempts")
-    local_path = DEPLOY_CONFIG.get("Deploy Config", "local_path") + folder
-    remote_path = DEPLOY_CONFIG.get("Deploy Config", "remote_path") + folder
+    groups = {}
+    order = []
+    for host in hosts:
+        group = inventory.get(host, "group", "")
+        if group not in groups:
+            groups[group] = []
+            order.append(group)
+        groups[group].append(host)
+    parents = {}
+    for group in order:
+        members = groups[group]
+        for index, host in enumerate(members):
+            parents[host] = None if index < seeds else \
+                members[(index - seeds) // branching]
+    return parents
 
-    # get a listing of all the files of the specified folder on the local path
-    try:
-        files = [filename for filename in listdir(local_path) if isfile(join(local_path, filename))]
-    except OSError:
-        LOGGER.error("%s does not exist.", local_path)
-        raise
 
-    # create parts of the path not included in the argument
-    try:
-        ssh.ssh.exec_command("mkdir -p " + remote_path, timeout=int(
-            DEPLOY_CONFIG.get("Deploy Config", "timeout")))
-    except IOError:
-        LOGGER.warning("Cannot create %s, it may already exist.", remote_path)
-    LOGGER.info("Created remote folder %s", remote_path)
+def relay_deploy(hosts, args, connect, inventory):
+    """Deploy to the seeds of every group, then wave by wave to the hosts
+       fed by the hosts of the previous wave. Every host is still verified
+       from here, a host whose feeder failed is deployed to directly.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        hosts - the hosts to deploy to
+        args - the parsed command line arguments
+        connect - called with a host, returns its SSHConnector
+        inventory - the Inventory recording the hosts' groups
+    Returns:
+        A list of results, in the same order as hosts
+    """
+    parents = relay_tree(hosts, inventory, settings().relay_seeds,
+                         settings().relay_branching)
+    results = {}
 
-    for filename in files:
-        full_local_path = join(local_path, filename)
-        full_remote_path = join(remote_path, filename)
-        local_checksum_path = full_local_path + ".md5"
+    def run(host):
+        """Deploy to one host, through its feeder if that one succeeded"""
+        parent = parents[host]
+        if parent is not None and results[parent]["status"] == "failed":
+            LOGGER.warning("%s failed, deploying to %s directly.", parent,
+                           host)
+            parent = None
+        return run_host(host, args, connect, relay=parent)
+
+    wave = [host for host in hosts if parents[host] is None]
+    while wave:
+        LOGGER.info("Deploying to %d hosts: %s", len(wave), ", ".join(wave))
+        for result in fan_out(run, wave, args.parallel):
+            results[result["host"]] = result
+        wave = [host for host in hosts if parents[host] in wave]
+    return [results[host] for host in hosts]
 
-        # don't deploy checksums or anything already deployed and up to date
-        if str(filename).endswith(".md5"):
-            LOGGER.info("%s is a checksum, and will not be deployed.", filename)
-            continue
-        elif checksum(local_checksum_path, full_remote_path, ssh):
-            LOGGER.warning("Checksums match, the deployment of %s unnecessary",
-                           filename)
-            continue
-        else:
-            # deploy the file, and its accompanying checksum
-            LOGGER.info("No deployed files detected.")
-            LOGGER.info("Generating checksum prior to deployment.")
-            md5sum(filename, local_path)
-            LOGGER.info("Deploying %s", filename)
-            try:
-                ssh.sftp.put(full_local_path, full_remote_path)
-            except IOError as error:
-                LOGGER.error("Could not find %s to deploy.", full_local_path)
-                if retry <= deploy_attempts:
-                    retry += 1
-                    LOGGER.warning("Deploy retry: %s", retry)
-                    deploy(folder, ssh, retry)
-                else:
-                    LOGGER.error(error)
-                    raise
-            LOGGER.info("Deployed %s", filename)
-            if checksum(local_checksum_path, full_remote_path, ssh):
-                ssh.sftp.chmod(full_remote_path, 0o755)
-                LOGGER.info("Checksums match, the deployment of %s "
-                            "was successful.", filename)
-            else:
-                LOGGER.error("Checksums do not match, the deployment of %s "
-                             "was unsuccessful.", filename)
 
-def remove(folder, ssh):
-    """ Remove a  folder from a specified host. Sets up an ssh connection with
-       the SSHConnector class, then uses that connection to loop through a
-       listing of files to remove. Finally, it removes the empty directory.
+def run_host(host, args, connect, relay=None):
+    """Connect to one host and deploy or remove the folder there. Errors are
+       logged and recorded instead of raised, so one bad host can not stop
+       the rest of the fleet.
     Globals:
         LOGGER, DEPLOY_CONFIG
     Arguments:
-        folder - the folder to be removed
-        ssh - the ssh connection
+        host - the host being acted on
+        args - the parsed command line arguments
+        connect - called with the host, returns its SSHConnector
+        relay - a host already holding the verified folder, to send the
+                changed files from instead of from here
     Returns:
-        none
+        A dictionary with the host, its status (ok, skipped or failed),
+        the duration in seconds and the error, if any
     """
-    local_path = DEPLOY_CONFIG.get("Deploy Config", "local_path") + folder
-    remote_path = DEPLOY_CONFIG.get("Deploy Config", "remote_path") + folder
+    result = {"host": host, "status": "ok", "duration": 0.0, "retries": 0,
+              "error": None}
+    start = time.time()
+    with mxorc_logger.context(host=host):
+        act_on_host(host, args, connect, result, relay)
+    result["duration"] = time.time() - start
+    METRICS.result(host, result["status"], result["duration"])
+    return result
 
-    # get a listing of all the files of the specified folder on the local path
-    try:
-        files = [filename for filename in listdir(local_path) if isfile(join(local_path, filename))]
-    except OSError:
-        LOGGER.error("%s does not exist.", local_path)
-        raise
-    # remove every file in the list of files
-    for filename in files:
-        full_remote_path = remote_path + "/" + filename
-        try:
-            LOGGER.info("Removing %s", filename)
-            ssh.sftp.remove(full_remote_path)
-            LOGGER.info("Successfully removed %s", filename)
-        except IOError:
-            LOGGER.warning("Can't remove %s, it may not exist.", full_remote_path)
 
+def act_on_host(host, args, connect, result, relay=None):
+    """Deploy or remove the folder on one host, recording the outcome
+    Globals:
+        LOGGER
+    Arguments:
+        host - the host being acted on
+        args - the parsed command line arguments
+        connect - called with the host, returns its SSHConnector
+        result - the host's result, updated in place
+        relay - a host already holding the verified folder, if any
+    Returns:
+        none
+    """
     try:
-        ssh.ssh.exec_command("rm -rf " + remote_path, timeout=int(
-            DEPLOY_CONFIG.get("Deploy Config", "timeout")))
-    except IOError:
-        LOGGER.warning("Cannot remove %s, it may not exist.", remote_path)
+        # the connections are closed on the way out to prevent hanging
+        with connect(host) as ssh:
+            if args.deploy:
+                manifest = args.manifests.take(
+                    host, settings().remote_path + args.folder,
+                    args.recursive) if args.manifests else None
+                source = connect_relay(relay, connect)
+                try:
+                    stats = deploy(args.folder, ssh, bundle=args.bundle,
+                                   window=args.window,
+                                   recursive=args.recursive, store=args.store,
+                                   staged=args.staged, relay=source,
+                                   manifest=manifest)
+                finally:
+                    if source is not None:
+                        source.close()
+                result["retries"] = stats["retries"]
+                if stats["failed"]:
+                    result["status"] = "failed"
+                    result["error"] = "%d file(s) failed verification" % (
+                        stats["failed"])
+                elif not stats["deployed"] and not stats["pruned"]:
+                    result["status"] = "skipped"
+            elif args.remove:
+                remove(args.folder, ssh, recursive=args.recursive,
+                       staged=args.staged)
+                if args.store:
+                    collect_garbage(ssh)
+            elif args.gc:
+                collect_garbage(ssh)
+            elif args.rollback:
+                rollback(args.folder, ssh)
+    # pylint: disable=broad-except
+    except Exception as error:
+        LOGGER.error("Failed to act on %s: %s", host, error)
+        result["status"] = "failed"
+        result["error"] = str(error) or error.__class__.__name__
 
 
-def md5sum(filename, path):
-    """Creates an md5 from a file for a checksum
+def plan_host(host, args, connect):
+    """Connect to one host and plan the deploy of the folder there, keeping
+       the host's manifest in args.manifests. Errors are logged and recorded
+       instead of raised.
     Globals:
-        none
+        LOGGER, DEPLOY_CONFIG
     Arguments:
-        file - the file's name
-        path - an absolute path to file's directory
+        host - the host being planned for
+        args - the parsed command line arguments
+        connect - called with the host, returns its SSHConnector
     Returns:
-        none
+        A dictionary with the host, its status (ok or failed), the error, if
+        any, the files to add, change and remove and the number unchanged
     """
-    full_file_path = path  + "/" + filename
-    full_md5_path = path + "/" + filename + ".md5"
-    md5_file = open(full_md5_path, "w+b")
-    md5_hash = md5()
+    result = {"host": host, "status": "ok", "error": None, "add": [],
+              "change": [], "remove": [], "unchanged": 0}
+    with mxorc_logger.context(host=host):
+        try:
+            with connect(host) as ssh:
+                planned = plan(args.folder, ssh, recursive=args.recursive,
+                               staged=args.staged)
+            args.manifests.put(host, settings().remote_path + args.folder,
+                               args.recursive, planned)
+            for key in ("add", "change", "remove", "unchanged"):
+                result[key] = planned[key]
+        # pylint: disable=broad-except
+        except Exception as error:
+            LOGGER.error("Failed to plan for %s: %s", host, error)
+            result["status"] = "failed"
+            result["error"] = str(error) or error.__class__.__name__
+    return result
 
-    with open(full_file_path, "rb") as file_handle:
-        for chunk in iter(lambda: file_handle.read(128 * md5_hash.block_size), b""):
-            md5_hash.update(chunk)
 
-    md5_file.write(str(md5_hash.hexdigest()))
-    md5_file.close()
+def format_plan(results):
+    """Lay a plan out host by host, each file to add, change or remove on a
+       line of its own
+    Globals:
+        none
+    Arguments:
+        results - the results returned by plan_host
+    Returns:
+        The plan, as a string
+    """
+    lines = []
+    for result in results:
+        if result["status"] == "failed":
+            lines.append("%s: failed, %s" % (result["host"], result["error"]))
+            continue
+        lines.append("%s: %d to add, %d to change, %d to remove, %d "
+                     "unchanged" % (result["host"], len(result["add"]),
+                                    len(result["change"]),
+                                    len(result["remove"]),
+                                    result["unchanged"]))
+        for sign, key in (("+", "add"), ("~", "change"), ("-", "remove")):
+            lines.extend("    %s %s" % (sign, filename)
+                         for filename in result[key])
+    lines.append("%d of %d hosts would change." % (
+        sum(1 for result in results if result["add"] or result["change"] or
+            result["remove"]), len(results)))
+    return "\n".join(lines)
 
 
-def checksum(local_checksum, remote_file, ssh):
-    """Whether or not the local checksum matches the remote checksum
+def connect_relay(relay, connect):
+    """Connect to the host feeding this one, a host that can not be reached
+       is skipped and the files are sent from here
     Globals:
-        LOGGER, DEPLOY_CONFIG
+        LOGGER
     Arguments:
-        local_checksum - the local checksum
-        remote_file - the remote file to generate a checksum with
-        ssh - the ssh connection
+        relay - the feeding host, or None
+        connect - called with a host, returns its SSHConnector
     Returns:
-        True - if the checksums match
-        False - if the checksums do not match or cannot be determined to be
-                matching
+        The feeding host's SSHConnector, or None
     """
-    # build remote checksum command, execute it and capture all streams
-    generate_remote_checksum = ("md5sum " + remote_file + " | "
-                                "awk '{ print $1 }' | tr -d '\n' |"
-                                "tee " + remote_file + ".md5")
+    if relay is None:
+        return None
     try:
-        # pylint: disable=unused-variable
-        rmt_cs_stdin, rmt_cs_stdout, rmt_cs_stderr = ssh.ssh.exec_command(
-            generate_remote_checksum, timeout=int(DEPLOY_CONFIG.get(
-                "Deploy Config", "timeout")))
-    except SSHException:
-        LOGGER.warning("Failed to open remote checksum at %s", remote_file)
-        LOGGER.warning("Could not validate deployment.")
-        return False
+        return connect(relay)
+    # pylint: disable=broad-except
+    except Exception as error:
+        LOGGER.warning("Could not connect to the relay %s, deploying "
+                       "directly: %s", relay, error)
+        return None
 
-    # the actual check, notice it only returns true or false and does not stop
-    # exectuion of the program
-    try:
-        local_checksum_contents = open(local_checksum, "rb").read()
-    except IOError:
-        LOGGER.warning("%s could not be read.", local_checksum)
-        return False
-    remote_checksum_contents = rmt_cs_stdout.read()
-    remote_checksum_error = rmt_cs_stderr.read()
 
-    if not remote_checksum_error:
-        LOGGER.debug("Local checksum %s", local_checksum_contents)
-        LOGGER.debug("Remote checksum %s", remote_checksum_contents)
-        return bool(local_checksum_contents == remote_checksum_contents)
-    LOGGER.warning("The following error occured reading the checksum : \n"
-                   "%s", remote_checksum_error)
-    return False
+def log_summary(results):
+    """Log one line per host with its status, duration and upload retries
+    Globals:
+        LOGGER
+    Arguments:
+        results - the results returned by run_host
+    Returns:
+        none
+    """
+    width = max(len(result["host"]) for result in results)
+    LOGGER.info("Summary of %d host(s):", len(results))
+    for result in results:
+        line = "%-*s  %-7s  %7.2fs  %d retries" % (
+            width, result["host"], result["status"], result["duration"],
+            result["retries"])
+        if result["error"]:
+            LOGGER.error("%s  %s", line, result["error"])
+        else:
+            LOGGER.info(line)
+
+class Connector(object):
+
+    """ A connection to a host as deploy uses it: commands run on the host,
+        SFTP sessions, and what is learned about the host while connected.
+        Subclasses open the channels, SSHConnector over its own transport
+        and mxorc_agent.AgentConnector through the sessions an agent holds.
+    """
+
+    def __init__(self, user, host, port):
+        """Connector initialization, the state shared by every connector
+        Globals:
+            DEPLOY_CONFIG
+        Arguments:
+            self
+            user - the user being connected to
+            host - the host being connected to
+            port - the SSH port
+        Returns:
+            none
+        """
+        self.user = user
+        self.host = host
+        self.port = port
+        self.timeout = settings().timeout
+        self.sftp = None
+        self.commands = {}
+        # the checksum algorithm agreed on with the host by its first manifest
+        self.algorithm = None
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def exec_command(self, command, timeout=None):
+        """Start a command on the host
+        Globals:
+            none
+        Arguments:
+            self
+            command - the command to execute
+            timeout - the channel timeout, defaults to the configured timeout
+        Returns:
+            The stdin, stdout and stderr of the command, as file like objects
+            whose channel can shutdown_write and recv_exit_status
+        """
+        raise NotImplementedError
+
+    def run(self, command, data=None, timeout=None):
+        """Execute a command and wait for it to finish
+        Globals:
+            none
+        Arguments:
+            self
+            command - the command to execute
+            data - optional bytes written to the command's stdin
+            timeout - the channel timeout, defaults to the configured timeout
+        Returns:
+            The exit status, stdout and stderr of the command
+        """
+        METRICS.count(self.host, "round_trips")
+        stdin, stdout, stderr = self.exec_command(command, timeout)
+        if data:
+            stdin.write(data)
+            stdin.flush()
+        stdin.channel.shutdown_write()
+        output = stdout.read()
+        error = stderr.read()
+        return stdout.channel.recv_exit_status(), output, error
+
+    def open_sftp(self):
+        """Open another SFTP session to the host
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            A paramiko SFTPClient, the caller has to close it
+        """
+        raise NotImplementedError
+
+    def reconnect(self, generation):
+        """Replace the connection the caller failed on, unless another
+           thread already did
+        Globals:
+            none
+        Arguments:
+            self
+            generation - the connection generation the caller failed on
+        Returns:
+            none
+        """
+        raise NotImplementedError
+
+    def has_command(self, name):
+        """Whether a command is available on the remote host, the answer is
+           remembered for the life of the connection
+        Globals:
+            none
+        Arguments:
+            self
+            name - the command's name
+        Returns:
+            True - if the command is on the remote PATH
+            False - if it is not
+        """
+        if name not in self.commands:
+            status, _, _ = self.run("command -v %s" % quote(name))
+            self.commands[name] = not status
+        return self.commands[name]
+
+    def close(self):
+        """Close the connection
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        raise NotImplementedError
+
+
+class SSHConnector(Connector):
+
+    """ Creates a single authenticated SSH transport, then runs both the
+        command channels and the SFTP session over it, which allows for
+        directly using paramiko. Only starts the instance with some error
+        checking. Other errors related to execution of commands should be
+        caught where those commands are called.
+    """
+
+    def __init__(self, user, host, key, port=None, inventory=None):
+        """SSH initializaton
+        Globals:
+            LOGGER, DEPLOY_CONFIG
+        Arguments:
+            self
+            host - the host being connected to
+            user - the user being connected to
+            key - the SSH key used for connectivity
+            port - the SSH port, defaults to the host's port in the inventory,
+                   then the configured port or 22
+            inventory - an Inventory to connect by the host's cached address
+                        and to check the host key against, if any
+        Returns:
+            none
+        """
+        default_port = settings().port
+        if inventory is not None:
+            default_port = inventory.port(host, default_port)
+        Connector.__init__(self, user, host, int(port or default_port))
+        self.key = key
+        self.inventory = inventory
+        self.address = inventory.address(host) if inventory else host
+        self.transport = None
+        with METRICS.span(host, "connect"):
+            self.connect()
+
+    def connect(self):
+        """Open and authenticate the transport, then the SFTP session on it
+        Globals:
+            LOGGER, DEPLOY_CONFIG
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        # imported here, so the command line does not wait for it
+        import paramiko
+        host, user, key = self.host, self.user, self.key
+
+        # Build the transport, catch a bad key and a failed connection
+        LOGGER.info("Attempting to make SSH connection to %s:%d as %s.", host,
+                    self.port, user)
+        try:
+            sock = socket.create_connection((self.address, self.port),
+                                            self.timeout)
+        except gaierror as error:
+            LOGGER.error("Your connection details are malconfigured.")
+            LOGGER.error(error)
+            raise
+        except socket.error as error:
+            LOGGER.error("Cannot connect to %s on port %d.", host, self.port)
+            LOGGER.error(error)
+            raise
+
+        self.transport = paramiko.Transport(sock)
+        self.transport.banner_timeout = (settings().banner_timeout or
+                                         self.timeout)
+        self.transport.auth_timeout = settings().auth_timeout or self.timeout
+        try:
+            self.transport.start_client(timeout=self.timeout)
+            if self.inventory is not None:
+                self.inventory.verify_key(
+                    host, self.transport.get_remote_server_key())
+            LOGGER.debug("Authenticating with a %s key.", key.get_name())
+            self.transport.auth_publickey(user, key)
+        except AttributeError as error:
+            self.close()
+            LOGGER.error("Cannot connect to %s with the user %s, no key was "
+                         "provided. Use paramiko.RSAKey.from_private_key(open"
+                         "(SERVICE_KEY_FILENAME)) to turn a key file into an "
+                         "usable key.", host, user)
+            LOGGER.error(error)
+            raise
+        except paramiko.ssh_exception.AuthenticationException as error:
+            self.close()
+            LOGGER.error("Cannot connect to %s with the user %s, the ssh"
+                         " authentication failed.", host, user)
+            LOGGER.error(error)
+            raise
+        except paramiko.SSHException as error:
+            self.close()
+            LOGGER.error("Cannot connect to %s with the user %s, the transport"
+                         " negotiation failed.", host, user)
+            LOGGER.error(error)
+            raise
+        LOGGER.info("Successfully made SSH connection to %s as %s.", host, user)
+
+        # open the SFTP session on the same, already authenticated, transport
+        self.sftp = self.open_sftp()
+        LOGGER.info("Sucessfully made SFTP connection to %s as %s.", host, user)
+
+        self.generation += 1
+        LOGGER.info("Successfully set up connections.")
+
+    def reconnect(self, generation):
+        """Connect again if the transport dropped, unless another thread
+           already did since the caller last saw the connection
+        Globals:
+            LOGGER
+        Arguments:
+            self
+            generation - the connection generation the caller failed on
+        Returns:
+            none
+        """
+        with self.lock:
+            if generation != self.generation or self.transport.is_active():
+                return
+            LOGGER.warning("The connection to %s dropped, reconnecting.",
+                           self.host)
+            self.close()
+            with METRICS.span(self.host, "reconnect"):
+                self.connect()
+
+    def exec_command(self, command, timeout=None):
+        """Execute a command on a new channel of the shared transport
+        Globals:
+            none
+        Arguments:
+            self
+            command - the command to execute
+            timeout - the channel timeout, defaults to the configured timeout
+        Returns:
+            The stdin, stdout and stderr of the command, as file like objects
+        """
+        channel = self.transport.open_session(timeout=self.timeout)
+        channel.settimeout(timeout or self.timeout)
+        channel.exec_command(command)
+        return (channel.makefile("wb"), channel.makefile("r"),
+                channel.makefile_stderr("r"))
+
+    def open_sftp(self):
+        """Open another SFTP session on the shared transport, so several
+           files can be in flight at once
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            A paramiko SFTPClient, the caller has to close it
+        """
+        import paramiko
+        sftp = paramiko.SFTPClient.from_transport(self.transport)
+        sftp.get_channel().settimeout(self.timeout)
+        return sftp
+
+    def close(self):
+        """Close the SFTP session and the transport underneath it
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        if self.sftp is not None:
+            self.sftp.close()
+        if self.transport is not None:
+            self.transport.close()
+
+
+def deploy(folder, ssh, bundle=False, window=None, recursive=False,
+           store=False, staged=False, relay=None, manifest=None):
+    """Deploy a folder to specified host. Uses the ssh connection to fetch a
+       manifest of the remote folder in one round trip, uploads only the
+       files whose checksum differs, then validates every uploaded file with
+       one more batched checksum.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        folder - the folder being deployed
+        ssh - the ssh connection
+        bundle - whether to stream the changed files as one compressed tar
+                 instead of uploading them one by one
+        window - the most files uploaded at once, defaults to the configured
+                 upload_window
+        recursive - whether to deploy the whole tree under the folder, remote
+                    files no longer present locally are then removed
+        store - whether to upload each unique content once into the host's
+                blob store and link the folder's files to it
+        staged - whether to deploy into a new release, seeded with links to
+                 the current one, and switch the folder's symlink to it once
+                 verified, so consumers never see a half updated folder
+        relay - the ssh connection of a host already holding the verified
+                folder, it then sends the changed files over its own SSH
+                connection to this host, and the uploads from here are only
+                for what it could not send
+        manifest - the remote folder's manifest taken while planning, from
+                   ManifestCache.take, saves fetching it again
+    Returns:
+        A dictionary counting the files deployed, unchanged, failed and
+        pruned, and the upload retries
+    """
+    local_path = settings().local_path + folder
+    remote_path = settings().remote_path + folder
+    folder_path = remote_path.rstrip("/")
+    stats = {"deployed": 0, "unchanged": 0, "failed": 0, "pruned": 0,
+             "retries": 0}
+
+    # get a listing of all the files of the specified folder on the local path
+    with METRICS.span(ssh.host, "list") as span:
+        try:
+            files = list_files(local_path, recursive)
+        except OSError:
+            LOGGER.error("%s does not exist.", local_path)
+            raise
+        span.add(len(files))
+
+    # create parts of the path not included in the argument, and fetch the
+    # checksums of everything already deployed in the same round trip, which
+    # also settles the algorithm the host checksums with
+    with METRICS.span(ssh.host, "manifest") as span:
+        if manifest is None:
+            remote_hashes = remote_manifest(remote_path, ssh,
+                                            create=not staged,
+                                            recursive=recursive)
+        else:
+            LOGGER.info("Using the manifest of %s planned %ds ago.",
+                        remote_path, time.time() - manifest["taken"])
+            remote_hashes = manifest["files"]
+            ssh.algorithm = ssh.algorithm or manifest["algorithm"]
+            # a folder holding nothing may not exist yet
+            if not remote_hashes and not staged:
+                ssh.run("mkdir -p %s" % quote(remote_path))
+        span.add(len(remote_hashes))
+    LOGGER.info("Created remote folder %s", remote_path)
+
+    # don't deploy checksums left behind by older versions, only rehash
+    # files that changed since they were last hashed
+    algorithm = ssh.algorithm or "md5"
+    with METRICS.span(ssh.host, "hash") as span:
+        local_hashes = local_digests(local_path, files, algorithm)
+        span.add(len(local_hashes))
+
+    # don't deploy anything already deployed and up to date
+    changed = []
+    for filename in sorted(local_hashes):
+        if remote_hashes.get(filename) == local_hashes[filename]:
+            LOGGER.warning("Checksums match, the deployment of %s unnecessary",
+                           filename)
+            stats["unchanged"] += 1
+        else:
+            changed.append(filename)
+
+    # a synced tree or a release holds nothing that is gone locally
+    stale = sorted(set(remote_hashes) - set(local_hashes)) \
+        if recursive or staged else []
+    if staged and (changed or stale):
+        with METRICS.span(ssh.host, "stage"):
+            remote_path = stage_release(folder_path, ssh)
+    if stale:
+        for filename in stale:
+            LOGGER.info("Removing %s, it no longer exists locally.", filename)
+        with METRICS.span(ssh.host, "prune") as span:
+            stats["pruned"] = remove_files(stale, remote_path, ssh)
+            span.add(stats["pruned"])
+
+    if not changed:
+        if staged and stats["pruned"]:
+            with METRICS.span(ssh.host, "activate"):
+                activate_release(folder_path, remote_path, ssh)
+        return stats
+
+    # send, verify and make executable only what changed
+    push_files(changed, local_hashes, local_path, remote_path, ssh, algorithm,
+               stats, remote_hashes, bundle=bundle, window=window,
+               store=store, relay=relay,
+               relay_path=settings().remote_path + folder)
+
+    # switch over only to a fully verified release
+    if staged:
+        with METRICS.span(ssh.host, "activate"):
+            if stats["failed"]:
+                discard_release(folder_path, remote_path, ssh)
+            else:
+                activate_release(folder_path, remote_path, ssh)
+    return stats
+
+
+def local_digests(local_path, files, algorithm):
+    """The checksums of a local folder's files, leaving out the checksums
+       left behind by older versions, only rehashing files that changed
+       since they were last hashed
+    Globals:
+        LOGGER
+    Arguments:
+        local_path - the local folder
+        files - the names of the files inside it
+        algorithm - the name of the algorithm
+    Returns:
+        A dictionary of file name to checksum
+    """
+    for filename in files:
+        if str(filename).endswith(".md5"):
+            LOGGER.info("%s is a checksum, and will not be deployed.",
+                        filename)
+    cache = hash_cache(local_path)
+    local_hashes = cache.digests([filename for filename in files
+                                  if not filename.endswith(".md5")],
+                                 algorithm)
+    cache.save()
+    return local_hashes
+
+
+def plan(folder, ssh, recursive=False, staged=False):
+    """Work out what a deploy of a folder would change on a host, with the
+       one command fetching the remote manifest and without writing
+       anything, on either end
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        folder - the folder to deploy
+        ssh - the ssh connection
+        recursive - whether the deploy would cover the whole tree under the
+                    folder, and remove remote files deleted locally
+        staged - whether the deploy would go into a new release, which
+                 leaves out remote files deleted locally too
+    Returns:
+        A dictionary with the names of the files to add, change and remove,
+        the number unchanged, and the manifest, algorithm and time it was
+        taken, to hand to ManifestCache.put
+    """
+    local_path = settings().local_path + folder
+    remote_path = settings().remote_path + folder
+    files = list_files(local_path, recursive)
+    taken = time.time()
+    with METRICS.span(ssh.host, "manifest") as span:
+        remote_hashes = remote_manifest(remote_path, ssh, recursive=recursive)
+        span.add(len(remote_hashes))
+    with METRICS.span(ssh.host, "hash") as span:
+        local_hashes = local_digests(local_path, files, ssh.algorithm or "md5")
+        span.add(len(local_hashes))
+    changed = [filename for filename in sorted(local_hashes)
+               if remote_hashes.get(filename) != local_hashes[filename]]
+    stale = sorted(set(remote_hashes) - set(local_hashes)) \
+        if recursive or staged else []
+    return {"add": [filename for filename in changed
+                    if filename not in remote_hashes],
+            "change": [filename for filename in changed
+                       if filename in remote_hashes],
+            "remove": stale, "unchanged": len(local_hashes) - len(changed),
+            "algorithm": ssh.algorithm, "files": remote_hashes,
+            "taken": taken}
+
+
+def push_files(changed, local_hashes, local_path, remote_path, ssh,
+               algorithm, stats, remote_hashes=None, bundle=False,
+               window=None, store=False, relay=None, relay_path=None):
+    """Send changed files to a host, verify them and make them executable,
+       counting them as deployed or failed
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        changed - the names of the changed files inside the local folder
+        local_hashes - a dictionary of file name to local checksum
+        local_path - the local folder holding the files
+        remote_path - the remote folder to deploy into
+        ssh - the ssh connection
+        algorithm - the algorithm the local checksums were made with
+        stats - the deploy's counts, updated in place
+        remote_hashes - the checksums of the files already on the host, if
+                        known, every changed file is otherwise assumed to be
+                        there and in a folder that may not exist yet
+        bundle - whether to stream the files as one compressed tar first
+        window - the most files uploaded at once
+        store - whether to go through the host's blob store
+        relay - the ssh connection of a host to send the files from first
+        relay_path - the folder holding the files on that host
+    Returns:
+        none
+    """
+    # create only the directories not already known to hold deployed files
+    known = set(dirname(filename) for filename in remote_hashes or ())
+    with METRICS.span(ssh.host, "mkdir"):
+        make_directories(set(dirname(filename) for filename in changed) - known,
+                         remote_path, ssh)
+
+    if store:
+        # linking falls back to copying into the file, which must not write
+        # through a hardlink shared with a blob or an earlier release
+        unlink_files([filename for filename in changed
+                      if remote_hashes is None or filename in remote_hashes],
+                     remote_path, ssh)
+        verified, given_up, retries = deploy_from_store(
+            changed, local_hashes, local_path, remote_path, ssh, algorithm,
+            window)
+    else:
+        verified, given_up, retries = upload_and_verify(
+            changed, local_hashes, local_path, remote_path, ssh, algorithm,
+            bundle, window, relay, relay_path)
+    stats["retries"] += retries
+
+    for filename in changed:
+        if filename in verified:
+            LOGGER.info("Checksums match, the deployment of %s "
+                        "was successful.", filename)
+            stats["deployed"] += 1
+        else:
+            if filename not in given_up:
+                LOGGER.error("Checksums do not match, the deployment of %s "
+                             "was unsuccessful.", filename)
+            stats["failed"] += 1
+
+
+def watch(hosts, args, connect):
+    """Deploy the folder, then keep the connections open and push every
+       change to the hosts until interrupted. The folder is polled by stat,
+       a change is pushed once the folder was quiet for watch_debounce
+       seconds, and only the changed and deleted files are sent, verified
+       and removed. A host a push failed on gets a full deploy next time.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        hosts - the hosts to deploy to
+        args - the parsed command line arguments
+        connect - called with a host, returns its SSHConnector
+    Returns:
+        0 - if the watch was interrupted with every host in sync
+        1 - if any host was not
+    """
+    config = settings()
+    local_path = config.local_path + args.folder
+
+    def open_host(host):
+        """Connect to one host, a host that can not be reached is left out"""
+        with mxorc_logger.context(host=host):
+            try:
+                return connect(host)
+            # pylint: disable=broad-except
+            except Exception as error:
+                LOGGER.error("Failed to connect to %s: %s", host, error)
+                return None
+
+    connections = [ssh for ssh in fan_out(open_host, hosts, args.parallel)
+                   if ssh is not None]
+    dirty = set(connections)
+
+    def full_deploy(ssh):
+        """Deploy the whole folder to a host that may be out of sync"""
+        with mxorc_logger.context(host=ssh.host):
+            try:
+                stats = deploy(args.folder, ssh, bundle=args.bundle,
+                               window=args.window, recursive=args.recursive,
+                               store=args.store)
+                if not stats["failed"]:
+                    dirty.discard(ssh)
+            # pylint: disable=broad-except
+            except Exception as error:
+                LOGGER.error("Failed to deploy to %s: %s", ssh.host, error)
+
+    def push(ssh, changed, deleted):
+        """Push the latest changes to a host in sync with the previous ones"""
+        with mxorc_logger.context(host=ssh.host):
+            try:
+                stats = push_changes(args.folder, ssh, changed, deleted, args)
+                if stats["failed"]:
+                    dirty.add(ssh)
+            # pylint: disable=broad-except
+            except Exception as error:
+                LOGGER.error("Failed to push to %s: %s", ssh.host, error)
+                dirty.add(ssh)
+
+    try:
+        synced = snapshot(local_path, args.recursive)
+        while connections:
+            fan_out(full_deploy, [ssh for ssh in connections if ssh in dirty],
+                    args.parallel)
+            LOGGER.info("Watching %s for changes.", local_path)
+            current = wait_for_change(local_path, args.recursive, synced,
+                                      config.watch_interval,
+                                      config.watch_debounce)
+            changed, deleted = diff_snapshots(synced, current)
+            synced = current
+            fan_out(lambda ssh: push(ssh, changed, deleted),
+                    [ssh for ssh in connections if ssh not in dirty],
+                    args.parallel)
+    except KeyboardInterrupt:
+        LOGGER.info("Stopped watching %s.", local_path)
+    except OSError as error:
+        LOGGER.error("Could not watch %s: %s", local_path, error)
+        return 1
+    finally:
+        for ssh in connections:
+            ssh.close()
+    return int(bool(dirty) or len(connections) < len(hosts))
+
+
+def snapshot(local_path, recursive=False):
+    """The size and modification time of every file of a local folder, to
+       tell changed files apart without reading them
+    Globals:
+        none
+    Arguments:
+        local_path - the local folder
+        recursive - whether to descend into subdirectories
+    Returns:
+        A dictionary of file name to (size, mtime), checksums left behind by
+        older versions are left out
+    Raises:
+        OSError - if the folder does not exist
+    """
+    files = {}
+    for filename in list_files(local_path, recursive):
+        if filename.endswith(".md5"):
+            continue
+        try:
+            stat = os.stat(join(local_path, filename))
+        except OSError:
+            # deleted while listing, the next poll will tell
+            continue
+        files[filename] = (stat.st_size, getattr(stat, "st_mtime_ns",
+                                                 stat.st_mtime))
+    return files
+
+
+def diff_snapshots(previous, current):
+    """The files that changed and were deleted between two snapshots
+    Globals:
+        none
+    Arguments:
+        previous - the older snapshot
+        current - the newer snapshot
+    Returns:
+        The sorted lists of changed, including new, and deleted file names
+    """
+    changed = sorted(filename for filename in current
+                     if previous.get(filename) != current[filename])
+    deleted = sorted(set(previous) - set(current))
+    return changed, deleted
+
+
+def wait_for_change(local_path, recursive, previous, interval, debounce):
+    """Poll a local folder until it differs from a snapshot and then stays
+       unchanged for debounce seconds, so an editor's save or a copy of
+       many files is pushed once
+    Globals:
+        LOGGER
+    Arguments:
+        local_path - the local folder
+        recursive - whether to descend into subdirectories
+        previous - the snapshot to compare with
+        interval - seconds between polls
+        debounce - seconds the folder must stay unchanged
+    Returns:
+        The new snapshot
+    """
+    current = previous
+    settled = None
+    while True:
+        time.sleep(interval)
+        try:
+            latest = snapshot(local_path, recursive)
+        except OSError:
+            # a folder that is briefly gone, such as while being replaced,
+            # must not delete everything on the hosts
+            LOGGER.debug("%s can not be read, waiting for it.", local_path)
+            continue
+        if latest != current:
+            current, settled = latest, time.time()
+        elif settled is not None and time.time() - settled >= debounce:
+            return current
+
+
+def push_changes(folder, ssh, changed, deleted, args):
+    """Send changed files to a host and remove deleted ones, without
+       fetching the remote manifest, the host is known to hold the rest
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        folder - the folder being watched
+        ssh - the ssh connection
+        changed - the names of the changed or added files
+        deleted - the names of the deleted files
+        args - the parsed command line arguments
+    Returns:
+        A dictionary counting the files deployed, failed and pruned, and the
+        upload retries
+    """
+    local_path = settings().local_path + folder
+    remote_path = settings().remote_path + folder
+    stats = {"deployed": 0, "unchanged": 0, "failed": 0, "pruned": 0,
+             "retries": 0}
+    if deleted:
+        for filename in deleted:
+            LOGGER.info("Removing %s, it no longer exists locally.", filename)
+        with METRICS.span(ssh.host, "prune") as span:
+            stats["pruned"] = remove_files(deleted, remote_path, ssh)
+            span.add(stats["pruned"])
+            if stats["pruned"] < len(deleted):
+                stats["failed"] += len(deleted) - stats["pruned"]
+    if changed:
+        algorithm = ssh.algorithm or "md5"
+        with METRICS.span(ssh.host, "hash") as span:
+            cache = hash_cache(local_path)
+            local_hashes = cache.digests(changed, algorithm)
+            cache.save()
+            span.add(len(local_hashes))
+        push_files(changed, local_hashes, local_path, remote_path, ssh,
+                   algorithm, stats, bundle=args.bundle, window=args.window,
+                   store=args.store)
+    return stats
+
+
+def release_root(folder_path):
+    """The remote folder holding the releases of a staged folder, next to it
+    Globals:
+        none
+    Arguments:
+        folder_path - the remote folder, a symlink to its current release
+    Returns:
+        The path of the releases folder
+    """
+    return folder_path + ".releases"
+
+
+def stage_release(folder_path, ssh):
+    """Create a new release of a staged folder with a single command, seeded
+       with hardlinks to the files the folder serves now, so only changed
+       files need uploading. Changed files are removed before being written,
+       the links never let an upload reach into the current release.
+    Globals:
+        LOGGER
+    Arguments:
+        folder_path - the remote folder, a symlink to its current release or
+                      a plain folder deployed before releases were staged
+        ssh - the ssh connection
+    Returns:
+        The path of the new release
+    Raises:
+        IOError - if the release could not be created
+    """
+    now = time.time()
+    release = "%s-%06d" % (time.strftime("%Y%m%d-%H%M%S", time.gmtime(now)),
+                           int(now % 1 * 1000000))
+    release_path = join(release_root(folder_path), release)
+    status, _, error = ssh.run(
+        "mkdir -p %s && { [ ! -d %s ] || cp -al %s/. %s/; }" % (
+            quote(release_path), quote(folder_path), quote(folder_path),
+            quote(release_path)))
+    if status:
+        raise IOError("Could not stage release %s: %s" % (
+            release_path, error.strip()))
+    LOGGER.info("Staging release %s", release_path)
+    return release_path
+
+
+def activate_release(folder_path, release_path, ssh):
+    """Switch a staged folder to a release with a single command. The
+       current symlink of the releases folder is replaced by a rename, and
+       releases beyond the newest releases_kept previous ones are deleted.
+       A plain folder deployed before releases were staged is replaced by a
+       symlink to the current one, that first switch is not atomic.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        folder_path - the remote folder
+        release_path - the verified release
+        ssh - the ssh connection
+    Returns:
+        none
+    Raises:
+        IOError - if the folder could not be switched
+    """
+    root = release_root(folder_path)
+    release = basename(release_path)
+    name = basename(folder_path)
+    status, _, error = ssh.run(
+        "cd %s && ln -sfn %s .current.tmp && mv -T .current.tmp current && "
+        "cd %s && { [ -L %s ] || { rm -rf -- %s && ln -s -- %s %s; }; } && "
+        "cd %s && ls -1 | grep -vx -e current -e %s | sort -r | "
+        "tail -n +%d | while read -r old; do rm -rf -- \"$old\"; done" % (
+            quote(root), quote(release), quote(dirname(folder_path)),
+            quote(name), quote(name), quote(name + ".releases/current"),
+            quote(name), quote(root), quote(release),
+            settings().releases_kept + 1))
+    if status:
+        raise IOError("Could not switch %s to release %s: %s" % (
+            folder_path, release, error.strip()))
+    LOGGER.info("Switched %s to release %s", folder_path, release)
+
+
+def discard_release(folder_path, release_path, ssh):
+    """Delete a release that failed verification, leaving the current one
+       in place
+    Globals:
+        LOGGER
+    Arguments:
+        folder_path - the remote folder
+        release_path - the unverified release
+        ssh - the ssh connection
+    Returns:
+        none
+    """
+    LOGGER.error("Release %s failed verification, %s still serves the "
+                 "previous one.", basename(release_path), folder_path)
+    status, _, error = ssh.run("rm -rf -- %s" % quote(release_path))
+    if status:
+        LOGGER.warning("Could not delete release %s: %s", release_path, error)
+
+
+def rollback(folder, ssh):
+    """Switch a staged folder back to the newest release older than its
+       current one, with a single command
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        folder - the staged folder
+        ssh - the ssh connection
+    Returns:
+        The name of the release now current
+    Raises:
+        IOError - if there is no older release to switch to
+    """
+    folder_path = (settings().remote_path + folder).rstrip("/")
+    with METRICS.span(ssh.host, "activate"):
+        status, output, error = ssh.run(
+            "cd %s && current=$(readlink current) && previous=$(ls -1 | "
+            "grep -vx current | sort | awk -v current=\"$current\" "
+            "'$0 < current' | tail -n 1) && [ -n \"$previous\" ] && "
+            "ln -sfn \"$previous\" .current.tmp && "
+            "mv -T .current.tmp current && echo \"$previous\"" % (
+                quote(release_root(folder_path))))
+    if status:
+        raise IOError("No release of %s older than the current one %s" % (
+            folder_path, error.strip()))
+    release = output.strip()
+    LOGGER.info("Rolled %s back to release %s", folder_path, release)
+    return release
+
+
+def upload_and_verify(filenames, local_hashes, local_path, remote_path, ssh,
+                      algorithm, bundle=False, window=None, relay=None,
+                      relay_path=None):
+    """Upload files, or bundle them, then verify them with one batched
+       checksum, uploading the ones that do not match again. Uploads go to a
+       temporary name beside each file and only replace it once verified,
+       so a file is never missing or half written on the host, and a
+       hardlink it may be is replaced instead of written through. Bundled
+       and relayed files are replaced by tar as it extracts them.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        filenames - the names of the files inside the local folder
+        local_hashes - a dictionary of file name to local checksum
+        local_path - the local folder holding the files
+        remote_path - the remote folder to upload into
+        ssh - the ssh connection
+        algorithm - the algorithm the local checksums were made with
+        bundle - whether to stream the files as one compressed tar first
+        window - the most files uploaded at once
+        relay - the ssh connection of a host to send the files from first
+        relay_path - the folder holding the files on that host
+    Returns:
+        The sets of files verified and given up on, and the number of retries
+    """
+    changed = filenames
+    parts = dict((filename, part_name(filename)) for filename in changed)
+    deploy_attempts = settings().deploy_attempts
+    retries = 0
+    streamed = False
+    if relay is not None:
+        with METRICS.span(ssh.host, "relay") as span:
+            streamed = relay_files(changed, relay_path, remote_path, relay,
+                                   ssh)
+            span.add(len(changed) if streamed else 0)
+    elif bundle:
+        with METRICS.span(ssh.host, "bundle") as span:
+            streamed = upload_bundle(changed, local_path, remote_path, ssh)
+            span.add(len(changed) if streamed else 0)
+    to_upload = [] if streamed else list(changed)
+    to_verify = list(changed)
+    verified, given_up = set(), set()
+    for attempt in range(deploy_attempts + 1):
+        # only the files that still failed after their retries are given up
+        with METRICS.span(ssh.host, "upload") as span:
+            for upload in upload_files(to_upload, local_path, remote_path,
+                                       ssh, window, parts) if to_upload else []:
+                retries += upload["attempts"] - 1
+                if upload["error"]:
+                    LOGGER.error("Could not deploy %s after %d attempts: %s",
+                                 upload["filename"], upload["attempts"],
+                                 upload["error"])
+                    to_verify.remove(upload["filename"])
+                    given_up.add(upload["filename"])
+                else:
+                    span.add(1, upload["size"])
+
+        # validate everything uploaded at once, a pipelined write can fail
+        # without the upload noticing, so mismatches are deployed again
+        names = dict((filename, parts[filename] if filename in to_upload
+                      else filename) for filename in to_verify)
+        matched = checksum(dict((names[filename], local_hashes[filename])
+                                for filename in to_verify),
+                           remote_path, ssh, algorithm) if to_verify else ()
+        uploads = [filename for filename in to_verify
+                   if filename in to_upload and names[filename] in matched]
+        verified.update(filename for filename in to_verify
+                        if filename not in to_upload
+                        and names[filename] in matched)
+        if uploads:
+            with METRICS.span(ssh.host, "chmod") as span:
+                verified.update(install_files(
+                    dict((filename, parts[filename]) for filename in uploads),
+                    remote_path, ssh))
+                span.add(len(uploads))
+        to_upload = to_verify = [filename for filename in to_verify
+                                 if filename not in verified]
+        if not to_verify or attempt == deploy_attempts:
+            break
+        LOGGER.warning("Checksums do not match, deploying %s again.",
+                       ", ".join(to_verify))
+        retries += len(to_verify)
+
+    return verified, given_up, retries
+
+
+def part_name(filename):
+    """The temporary name a file is uploaded as before it replaces the file
+    Globals:
+        none
+    Arguments:
+        filename - the file's name inside the remote folder
+    Returns:
+        A hidden name beside the file
+    """
+    return join(dirname(filename), ".%s.part" % basename(filename))
+
+
+def deploy_from_store(filenames, local_hashes, local_path, remote_path, ssh,
+                      algorithm, window=None):
+    """Put the content of files into the host's blob store, uploading only
+       what it does not hold yet, then link the files to their blobs and
+       verify them with one batched checksum
+    Globals:
+        LOGGER
+    Arguments:
+        filenames - the names of the files inside the local folder
+        local_hashes - a dictionary of file name to local checksum
+        local_path - the local folder holding the files
+        remote_path - the remote folder to link the files into
+        ssh - the ssh connection
+        algorithm - the algorithm the local checksums were made with, it
+                    also names the blobs
+        window - the most blobs uploaded at once
+    Returns:
+        The sets of files verified and given up on, and the number of retries
+    """
+    store = blob_store(algorithm)
+    stored, lost, retries = store_blobs(filenames, local_hashes, local_path,
+                                        store, ssh, algorithm, window)
+    linkable = [filename for filename in filenames
+                if local_hashes[filename] in stored]
+    with METRICS.span(ssh.host, "link") as span:
+        link_files(dict((filename, local_hashes[filename])
+                        for filename in linkable), remote_path, store, ssh)
+        span.add(len(linkable))
+    verified = checksum(dict((filename, local_hashes[filename])
+                             for filename in linkable),
+                        remote_path, ssh, algorithm) if linkable else set()
+    given_up = set(filename for filename in filenames
+                   if local_hashes[filename] in lost)
+    return verified, given_up, retries
+
+
+def blob_store(algorithm):
+    """The remote folder holding the blobs named by one algorithm
+    Globals:
+        DEPLOY_CONFIG
+    Arguments:
+        algorithm - the algorithm naming the blobs
+    Returns:
+        The remote folder's path
+    """
+    return join(settings().remote_path, settings().blob_store_dir, algorithm)
+
+
+def store_blobs(filenames, local_hashes, local_path, store, ssh, algorithm,
+                window=None):
+    """Upload the content of files the blob store does not hold yet, once
+       per checksum. A blob is uploaded under a temporary name and only
+       renamed to its checksum once the remote copy hashes to it, so a blob
+       under its final name is always intact.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        filenames - the names of the files inside the local folder
+        local_hashes - a dictionary of file name to local checksum
+        local_path - the local folder holding the files
+        store - the remote blob folder of the checksums' algorithm
+        ssh - the ssh connection
+        algorithm - the algorithm the local checksums were made with
+        window - the most blobs uploaded at once
+    Returns:
+        The set of checksums the store now holds, the set of checksums whose
+        upload was given up on and the number of retries
+    """
+    sources = {}
+    for filename in sorted(filenames):
+        sources.setdefault(local_hashes[filename], filename)
+    # a blob counts as present only when its content still hashes to its name
+    with METRICS.span(ssh.host, "store") as span:
+        present = remote_manifest(store, ssh, sources.keys(), create=True,
+                                  algorithm=algorithm)
+        stored = set(digest for digest in sources
+                     if present.get(digest) == digest)
+        span.add(len(stored))
+    missing = sorted(set(sources) - stored)
+    if stored:
+        LOGGER.info("The blob store already holds %d of %d blobs.",
+                    len(stored), len(sources))
+
+    deploy_attempts = settings().deploy_attempts
+    given_up = set()
+    retries = 0
+    for attempt in range(deploy_attempts + 1):
+        if not missing:
+            break
+        uploaded = []
+        with METRICS.span(ssh.host, "upload") as span:
+            for upload in upload_files(
+                    [sources[digest] for digest in missing], local_path,
+                    store, ssh, window,
+                    remote_names=dict((sources[digest], digest + ".part")
+                                      for digest in missing)):
+                digest = local_hashes[upload["filename"]]
+                retries += upload["attempts"] - 1
+                if upload["error"]:
+                    LOGGER.error("Could not store %s after %d attempts: %s",
+                                 upload["filename"], upload["attempts"],
+                                 upload["error"])
+                    given_up.add(digest)
+                else:
+                    uploaded.append(digest)
+                    span.add(1, upload["size"])
+
+        with METRICS.span(ssh.host, "store") as span:
+            parts = remote_manifest(store, ssh, [digest + ".part"
+                                                 for digest in uploaded],
+                                    algorithm=algorithm) if uploaded else {}
+            intact = publish_blobs([digest for digest in uploaded
+                                    if parts.get(digest + ".part") == digest],
+                                   store, ssh)
+            stored.update(intact)
+            span.add(len(intact))
+        missing = [digest for digest in uploaded if digest not in intact]
+        if missing and attempt < deploy_attempts:
+            LOGGER.warning("Checksums do not match, storing %s again.",
+                           ", ".join(sources[digest] for digest in missing))
+            retries += len(missing)
+    return stored, given_up, retries
+
+
+def publish_blobs(digests, store, ssh):
+    """Give verified blobs their final name and mode with a single command
+    Globals:
+        LOGGER
+    Arguments:
+        digests - the checksums of the blobs uploaded under a temporary name
+        store - the remote blob folder
+        ssh - the ssh connection
+    Returns:
+        The set of checksums now held under their final name
+    """
+    published = set()
+    for batch in chunks(sorted(digests), MANIFEST_BATCH):
+        status, _, error = ssh.run("cd %s && chmod 755 -- %s && %s" % (
+            quote(store), " ".join(quote(digest + ".part") for digest in batch),
+            " && ".join("mv -f -- %s %s" % (quote(digest + ".part"),
+                                            quote(digest))
+                        for digest in batch)))
+        if status:
+            LOGGER.warning("Could not publish blobs in %s: %s", store, error)
+        else:
+            published.update(batch)
+    return published
+
+
+def link_files(file_hashes, remote_path, store, ssh):
+    """Hardlink many remote files to their blobs with a single command,
+       copying the blob where the store is on another filesystem
+    Globals:
+        LOGGER
+    Arguments:
+        file_hashes - a dictionary of file name inside the remote folder to
+                      the checksum naming its blob
+        remote_path - the remote folder to link the files into
+        store - the remote blob folder
+        ssh - the ssh connection
+    Returns:
+        none
+    """
+    for batch in chunks(sorted(file_hashes), MANIFEST_BATCH):
+        status, _, error = ssh.run("cd %s && %s" % (
+            quote(remote_path), "; ".join(
+                "{ ln -f -- %s %s 2>/dev/null || cp -p -- %s %s; }" % (
+                    (quote(join(store, file_hashes[name])), quote(name)) * 2)
+                for name in batch)))
+        if status:
+            LOGGER.warning("Could not link files in %s: %s", remote_path,
+                           error)
+
+
+def unlink_files(filenames, remote_path, ssh):
+    """Remove many remote files with a single command, so the files written
+       in their place are new ones and never a blob shared through a link
+    Globals:
+        LOGGER
+    Arguments:
+        filenames - the names of the files inside the remote folder
+        remote_path - the remote folder holding the files
+        ssh - the ssh connection
+    Returns:
+        none
+    """
+    for batch in chunks(sorted(filenames), MANIFEST_BATCH):
+        status, _, error = ssh.run("cd %s && rm -f -- %s" % (
+            quote(remote_path), " ".join(quote(name) for name in batch)))
+        if status:
+            LOGGER.warning("Could not replace files in %s: %s", remote_path,
+                           error)
+
+
+def relay_files(filenames, source_path, remote_path, relay, ssh):
+    """Have a host holding the files send them to this one as a tar stream
+       over its own SSH connection, so they never cross the link of the host
+       running the deploy. Modes are kept, the sender's copies are already
+       executable.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        filenames - the names of the files inside the folder
+        source_path - the folder holding the files on the sending host
+        remote_path - the folder to extract into on this host
+        relay - the sending host's ssh connection
+        ssh - this host's ssh connection
+    Returns:
+        True if every file was sent, False if they should be uploaded
+    """
+    from paramiko import SSHException
+    config = settings()
+    receive = quote("cd %s && tar -xpf -" % quote(remote_path))
+    # the pipeline prints nothing until it is done, so it is given the relay
+    # timeout rather than the per-command one, and records its shell's pid
+    # to be killed by if it has to be given up on
+    pid_file = "${TMPDIR:-/tmp}/mxorc_relay.%d.%s.%d.pid" % (
+        os.getpid(), quote(ssh.host), ssh.port)
+    for batch in chunks(sorted(filenames), MANIFEST_BATCH):
+        LOGGER.info("Relaying %d files from %s", len(batch), relay.host)
+        METRICS.count(relay.host, "round_trips")
+        channel = None
+        try:
+            stdin, stdout, stderr = relay.exec_command(
+                "echo $$ > %s && cd %s && tar -cf - -- %s | ssh %s -p %d %s "
+                "%s; status=$?; rm -f %s; exit $status" % (
+                    pid_file, quote(source_path),
+                    " ".join(quote(name) for name in batch),
+                    config.relay_ssh_options, ssh.port,
+                    quote("%s@%s" % (ssh.user, ssh.host)), receive,
+                    pid_file), config.relay_timeout)
+            channel = stdout.channel
+            stdin.channel.shutdown_write()
+            stdout.read()
+            error = stderr.read()
+            status = channel.recv_exit_status()
+        except (IOError, SSHException) as failure:
+            status = 1
+            error = ("%s: %s" % (type(failure).__name__, failure)).rstrip(": ")
+            stop_relay(relay, channel, pid_file)
+        if status:
+            LOGGER.warning("Could not relay files from %s, uploading them "
+                           "instead: %s", relay.host, error)
+            return False
+    return True
+
+
+def stop_relay(relay, channel, pid_file):
+    """Make sure a relay given up on is no longer writing to the receiving
+       host before its files are uploaded there, by closing its channel and
+       killing its pipeline
+    Globals:
+        LOGGER
+    Arguments:
+        relay - the sending host's ssh connection
+        channel - the relay command's channel, None if it never started
+        pid_file - the file the relay command recorded its shell's pid in
+    Returns:
+        none
+    """
+    from paramiko import SSHException
+    if channel is not None:
+        channel.close()
+    # a shell started by sshd leads its own process group, otherwise only
+    # its children, the tar and ssh of the pipeline, are there to kill
+    try:
+        relay.run("pid=$(cat %s 2>/dev/null) && "
+                  "{ kill -TERM -- -$pid 2>/dev/null || "
+                  "{ pkill -TERM -P $pid; kill -TERM $pid; }; }; rm -f %s" %
+                  (pid_file, pid_file))
+    except (IOError, SSHException) as error:
+        LOGGER.warning("Could not stop the relay on %s: %s", relay.host,
+                       ("%s: %s" % (type(error).__name__, error)).rstrip(": "))
+
+
+def upload_files(filenames, local_path, remote_path, ssh, window=None,
+                 remote_names=None):
+    """Upload files over SFTP, keeping up to window files in flight at once,
+       each on its own SFTP session of the shared transport. A failed file is
+       retried on its own with exponential backoff and jitter, resuming from
+       the size already on the remote host and reconnecting if the transport
+       dropped.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        filenames - the names of the files inside the local folder
+        local_path - the local folder holding the files
+        remote_path - the remote folder to upload into
+        ssh - the ssh connection
+        window - the most files uploaded at once, defaults to the configured
+                 upload_window
+        remote_names - a dictionary of file name to the name to upload it
+                       as, files left out keep their name
+    Returns:
+        A list with a dictionary per file holding its filename, its size, the
+        number of attempts it took and the last error, None when it was
+        uploaded
+    """
+    deploy_attempts = settings().deploy_attempts
+    window = max(1, min(window or settings().upload_window, len(filenames)))
+    retryable = retryable_errors()
+    idle = Queue.Queue()
+    idle.put((ssh.generation, ssh.sftp))
+    opened = []
+    remote_names = remote_names or {}
+    log_context = mxorc_logger.current_context()
+
+    def checkout():
+        """Take an idle SFTP session of the current connection, or open one"""
+        try:
+            generation, sftp = idle.get_nowait()
+            if generation == ssh.generation and not sftp.sock.closed:
+                return generation, sftp
+        except Queue.Empty:
+            pass
+        generation, sftp = ssh.generation, ssh.open_sftp()
+        opened.append(sftp)
+        return generation, sftp
+
+    def upload(filename):
+        """Upload one file in the caller's log context"""
+        with mxorc_logger.context(**log_context):
+            return upload_file(filename)
+
+    def upload_file(filename):
+        """Upload one file, retrying it until it succeeds or runs out of
+           attempts"""
+        full_local_path = join(local_path, filename)
+        full_remote_path = join(remote_path,
+                                remote_names.get(filename, filename))
+        result = {"filename": filename, "size": os.path.getsize(full_local_path),
+                  "attempts": 0, "error": None}
+        offset = 0
+        while True:
+            result["attempts"] += 1
+            # opening and closing the remote file each wait for a reply
+            METRICS.count(ssh.host, "round_trips", 2)
+            generation, sftp = ssh.generation, None
+            try:
+                generation, sftp = checkout()
+                if offset:
+                    LOGGER.info("Resuming %s from byte %d", filename, offset)
+                    resume_upload(sftp, full_local_path, full_remote_path,
+                                  offset)
+                else:
+                    LOGGER.info("Deploying %s", filename)
+                    sftp.put(full_local_path, full_remote_path, confirm=False)
+                idle.put((generation, sftp))
+                LOGGER.info("Deployed %s", filename)
+                result["error"] = None
+                return result
+            except retryable as error:
+                result["error"] = error
+                if sftp is not None:
+                    idle.put((generation, sftp))
+            if result["attempts"] > deploy_attempts:
+                return result
+
+            delay = backoff(result["attempts"])
+            LOGGER.warning("Deploy retry of %s in %.1fs, attempt %d failed: "
+                           "%s", filename, delay, result["attempts"],
+                           result["error"])
+            time.sleep(delay)
+            try:
+                ssh.reconnect(generation)
+                offset = remote_offset(ssh.sftp, full_local_path,
+                                       full_remote_path)
+            except retryable as error:
+                LOGGER.warning("Could not prepare the retry of %s: %s",
+                               filename, error)
+                offset = 0
+
+    if window == 1:
+        results = [upload(filename) for filename in filenames]
+    else:
+        pool = ThreadPool(window)
+        try:
+            results = pool.map(upload, filenames, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    for sftp in opened:
+        sftp.close()
+    return results
+
+
+def retryable_errors():
+    """The errors after which a single file upload is worth retrying
+    Globals:
+        none
+    Arguments:
+        none
+    Returns:
+        A tuple of exception classes
+    """
+    from paramiko import SSHException
+    return (IOError, EOFError, SSHException)
+
+
+def backoff(attempt):
+    """How long to wait before retrying, growing exponentially with the
+       attempt up to retry_backoff_max, with full jitter so hosts and files
+       failing together do not retry in lockstep
+    Globals:
+        DEPLOY_CONFIG
+    Arguments:
+        attempt - the number of the attempt that just failed, from 1
+    Returns:
+        The delay in seconds
+    """
+    base = settings().retry_backoff
+    ceiling = settings().retry_backoff_max
+    return random.uniform(0, min(ceiling, base * 2 ** (attempt - 1)))
+
+
+def remote_offset(sftp, full_local_path, full_remote_path):
+    """Where an interrupted upload can resume, the size of a partial remote
+       copy that is smaller than the local file
+    Globals:
+        none
+    Arguments:
+        sftp - an sftp session
+        full_local_path - the local file being uploaded
+        full_remote_path - the remote file being written
+    Returns:
+        The remote size, or 0 to upload the whole file again
+    """
+    try:
+        remote_size = sftp.stat(full_remote_path).st_size
+    except IOError:
+        return 0
+    if 0 < remote_size < os.path.getsize(full_local_path):
+        return remote_size
+    return 0
+
+
+def resume_upload(sftp, full_local_path, full_remote_path, offset):
+    """Append the rest of a local file to a partial remote copy, the batched
+       checksum afterwards catches a partial copy that did not match
+    Globals:
+        none
+    Arguments:
+        sftp - an sftp session
+        full_local_path - the local file being uploaded
+        full_remote_path - the remote file being written
+        offset - the number of bytes already on the remote host
+    Returns:
+        none
+    """
+    with open(full_local_path, "rb") as local_file:
+        local_file.seek(offset)
+        with sftp.open(full_remote_path, "ab") as remote_file:
+            remote_file.set_pipelined(True)
+            for chunk in iter(lambda: local_file.read(32768), b""):
+                remote_file.write(chunk)
+
+
+def upload_bundle(filenames, local_path, remote_path, ssh):
+    """Stream files as a single compressed tar over one command channel into
+       tar on the remote host, setting their mode to 755 while extracting
+    Globals:
+        LOGGER
+    Arguments:
+        filenames - the names of the files inside the local folder
+        local_path - the local folder holding the files
+        remote_path - the existing remote folder to extract into
+        ssh - the ssh connection
+    Returns:
+        True - if the bundle was extracted
+        False - if the remote host lacks tar or the extraction failed, the
+                files should then be uploaded one by one
+    """
+    from paramiko import SSHException
+    if not ssh.has_command("tar"):
+        LOGGER.warning("%s has no tar, deploying files one by one.", ssh.host)
+        return False
+
+    # compress while sending, so neither the archive nor its memory wait on
+    # the size of the files
+    LOGGER.info("Deploying %d files as a bundle.", len(filenames))
+    METRICS.count(ssh.host, "round_trips")
+    try:
+        stdin, stdout, stderr = ssh.exec_command(
+            "cd %s && tar -xzpf - --no-same-owner" % quote(remote_path))
+        archive = tarfile.open(fileobj=stdin, mode="w|gz")
+        for filename in filenames:
+            info = archive.gettarinfo(join(local_path, filename),
+                                      arcname=filename)
+            info.mode = 0o755
+            info.uid = info.gid = 0
+            info.uname = info.gname = ""
+            with open(join(local_path, filename), "rb") as file_handle:
+                archive.addfile(info, file_handle)
+        archive.close()
+        stdin.flush()
+        stdin.channel.shutdown_write()
+        stdout.read()
+        error = stderr.read()
+        status = stdout.channel.recv_exit_status()
+    except (SSHException, socket.error, EOFError) as failure:
+        status, error = -1, failure
+    if status:
+        LOGGER.warning("Could not extract the bundle in %s, deploying files "
+                       "one by one: %s", remote_path, error)
+        return False
+    LOGGER.info("Deployed %s", ", ".join(filenames))
+    return True
+
+
+def remove(folder, ssh, recursive=False, staged=False):
+    """ Remove a folder from a specified host with a single command, which
+       lists the files it deletes from the host itself, so the local copy is
+       not needed and may already be retired.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        folder - the folder to be removed
+        ssh - the ssh connection
+        recursive - whether to log the files of nested folders too, the
+                    whole tree is removed either way
+        staged - whether the folder is a symlink to staged releases, it is
+                 then unlinked at once and its releases deleted after
+    Returns:
+        The number of files removed
+    Raises:
+        IOError - if the folder could not be removed
+    """
+    folder_path = (settings().remote_path + folder).rstrip("/")
+    targets = [folder_path, release_root(folder_path)] if staged else \
+        [folder_path]
+
+    # list what is about to go for the log, then delete it, in one round trip
+    with METRICS.span(ssh.host, "remove") as span:
+        status, output, error = ssh.run(
+            "(cd %s && find . %s-type f ! -name '*.md5') 2>/dev/null; "
+            "rm -rf -- %s" % (
+                quote(folder_path + "/"), "" if recursive else "-maxdepth 1 ",
+                " ".join(quote(target) for target in targets)))
+        if status:
+            raise IOError("Cannot remove %s: %s" % (folder_path,
+                                                    error.strip()))
+        files = [line[2:] if line.startswith("./") else line
+                 for line in output.splitlines()]
+        span.add(len(files))
+    if not files:
+        LOGGER.warning("%s held no files, it may not exist.", folder_path)
+    for filename in files:
+        LOGGER.info("Removed %s", filename)
+    LOGGER.info("Removed %s%s", folder_path,
+                " and its releases" if staged else "")
+    return len(files)
+
+
+def collect_garbage(ssh):
+    """Delete the blobs of the host's blob store that no deployed file links
+       to anymore, with a single command. Blobs younger than blob_gc_grace
+       minutes are kept, a deploy running at the same time may be about to
+       link them.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        ssh - the ssh connection
+    Returns:
+        The number of blobs deleted
+    """
+    from paramiko import SSHException
+    store = join(settings().remote_path, settings().blob_store_dir)
+    grace = settings().blob_gc_grace
+    with METRICS.span(ssh.host, "gc") as span:
+        try:
+            status, output, error = ssh.run(
+                "cd %s 2>/dev/null || exit 0; find . -type f -links 1 %s"
+                "-print -delete | wc -l" % (
+                    quote(store), "-mmin +%d " % grace if grace else ""))
+        except SSHException as error:
+            status, output = 1, ""
+        if status:
+            LOGGER.warning("Could not collect the garbage of %s: %s", store,
+                           error)
+            return 0
+        deleted = int(output.strip() or 0)
+        span.add(deleted)
+    LOGGER.info("Deleted %d unreferenced blobs from %s", deleted, store)
+    return deleted
+
+
+def remove_files(filenames, remote_path, ssh):
+    """Remove many remote files with a single command, then the directories
+       left empty by them
+    Globals:
+        LOGGER
+    Arguments:
+        filenames - the names of the files inside the remote folder
+        remote_path - the remote folder holding the files
+        ssh - the ssh connection
+    Returns:
+        The number of files that could be removed
+    """
+    removed = 0
+    for batch in chunks(sorted(filenames), MANIFEST_BATCH):
+        status, _, error = ssh.run(
+            "cd %s && rm -f -- %s && find . -mindepth 1 -type d -empty "
+            "-delete" % (quote(remote_path),
+                         " ".join(quote(name) for name in batch)))
+        if status:
+            LOGGER.warning("Could not remove files in %s: %s", remote_path,
+                           error)
+        else:
+            removed += len(batch)
+    return removed
+
+
+def make_directories(directories, remote_path, ssh):
+    """Create many remote directories with a single command
+    Globals:
+        LOGGER
+    Arguments:
+        directories - the directories relative to the remote folder, the
+                      folder itself ("") is skipped
+        remote_path - the remote folder
+        ssh - the ssh connection
+    Returns:
+        none
+    """
+    for batch in chunks(sorted(directory for directory in directories
+                               if directory), MANIFEST_BATCH):
+        LOGGER.info("Creating remote folders %s", ", ".join(batch))
+        status, _, error = ssh.run("cd %s && mkdir -p -- %s" % (
+            quote(remote_path), " ".join(quote(name) for name in batch)))
+        if status:
+            LOGGER.warning("Could not create folders in %s: %s", remote_path,
+                           error)
+
+
+def list_files(local_path, recursive=False):
+    """List the regular files of a local folder, walking it once
+    Globals:
+        none
+    Arguments:
+        local_path - the local folder
+        recursive - whether to descend into subdirectories, symlinked
+                    directories are not followed
+    Returns:
+        A sorted list of paths relative to the folder, using / separators
+    Raises:
+        OSError - if the folder does not exist
+    """
+    files = []
+    pending = [""]
+    while pending:
+        relative = pending.pop()
+        for name, is_directory, is_file in directory_entries(
+                join(local_path, relative)):
+            if is_file:
+                files.append(relative + name)
+            elif is_directory and recursive:
+                pending.append(relative + name + "/")
+    return sorted(files)
+
+
+def directory_entries(path):
+    """The entries of a directory, with os.scandir's cached types where it
+       is available
+    Globals:
+        none
+    Arguments:
+        path - the directory
+    Returns:
+        A list of (name, is a directory and not a symlink, is a file)
+    """
+    if scandir is None:
+        return [(name, isdir(join(path, name)) and not islink(join(path, name)),
+                 isfile(join(path, name))) for name in listdir(path)]
+    return [(entry.name, entry.is_dir(follow_symlinks=False), entry.is_file())
+            for entry in scandir(path)]
+
+
+def md5sum(filename, path):
+    """Creates an md5 from a file for a checksum
+    Globals:
+        none
+    Arguments:
+        file - the file's name
+        path - an absolute path to file's directory
+    Returns:
+        The hex digest of the file
+    """
+    return hashsum(filename, path, "md5")
+
+
+def hashsum(filename, path, algorithm):
+    """Checksum a file, mapping large files into memory instead of reading
+       them through a buffer
+    Globals:
+        HASH_ALGORITHMS, MMAP_THRESHOLD, HASH_CHUNK
+    Arguments:
+        filename - the file's name
+        path - an absolute path to file's directory
+        algorithm - the name of the algorithm, a key of HASH_ALGORITHMS
+    Returns:
+        The hex digest of the file
+    """
+    full_file_path = path  + "/" + filename
+    file_hash = HASH_ALGORITHMS[algorithm][1]()
+
+    # hashlib releases the GIL while hashing large chunks, so files hashed
+    # on several threads are hashed on several cores
+    with METRICS.span(None, "hashsum") as span:
+        with open(full_file_path, "rb") as file_handle:
+            size = os.fstat(file_handle.fileno()).st_size
+            if size >= MMAP_THRESHOLD:
+                mapped = mmap.mmap(file_handle.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+                try:
+                    for offset in range(0, size, HASH_CHUNK):
+                        file_hash.update(buffer(mapped, offset, HASH_CHUNK))
+                finally:
+                    mapped.close()
+            else:
+                for chunk in iter(lambda: file_handle.read(HASH_CHUNK), b""):
+                    file_hash.update(chunk)
+        span.add(1, size)
+
+    return file_hash.hexdigest()
+
+
+def hash_cache(local_path):
+    """Get the hash cache of a local folder, shared by every host
+    Globals:
+        HASH_CACHES, HASH_CACHES_LOCK
+    Arguments:
+        local_path - the local folder being deployed
+    Returns:
+        The folder's HashCache
+    """
+    local_path = abspath(local_path)
+    with HASH_CACHES_LOCK:
+        if local_path not in HASH_CACHES:
+            HASH_CACHES[local_path] = HashCache(local_path)
+        return HASH_CACHES[local_path]
+
+
+class HashCache(object):
+
+    """ Remembers the checksums of every file in a local folder, one per
+        algorithm, keyed by the file's name, size and modification time, so
+        unchanged files are not read again. The cache is one JSON file per
+        folder, kept outside of the folder in the configured hash_cache_dir.
+    """
+
+    # files modified this recently may still be written to within the same
+    # mtime tick, so their checksums are not remembered
+    RACY_SECONDS = 2
+
+    def __init__(self, local_path):
+        """Hash cache initialization, loads the cache file when there is one
+        Globals:
+            LOGGER, DEPLOY_CONFIG
+        Arguments:
+            self
+            local_path - the absolute path of the local folder
+        Returns:
+            none
+        """
+        self.local_path = local_path
+        self.cache_path = join(settings().hash_cache_dir,
+                               md5(local_path).hexdigest() + ".json")
+        self.lock = threading.Lock()
+        self.hashing = threading.Lock()
+        self.entries = {}
+        self.seen = set()
+        self.dirty = False
+        try:
+            with open(self.cache_path) as cache_file:
+                cached = json.load(cache_file)
+            if cached.get("local_path") == local_path:
+                self.entries = cached["files"]
+        except (IOError, ValueError, KeyError):
+            LOGGER.debug("No usable hash cache at %s.", self.cache_path)
+        # older caches held a single md5 per file
+        for entry in self.entries.values():
+            if not isinstance(entry[2], dict):
+                entry[2] = {"md5": entry[2]}
+
+    def digest(self, filename, algorithm="md5"):
+        """The checksum of a file, only read from disk when it changed
+        Globals:
+            none
+        Arguments:
+            self
+            filename - the file's name inside the local folder
+            algorithm - the name of the algorithm
+        Returns:
+            The hex digest of the file
+        """
+        return self.digests([filename], algorithm)[filename]
+
+    def digests(self, filenames, algorithm="md5"):
+        """The checksums of many files, the ones that changed are hashed at
+           the same time on hash_workers threads. Only one host hashes a
+           folder at a time, the others then find its results cached.
+        Globals:
+            none
+        Arguments:
+            self
+            filenames - the files' names inside the local folder
+            algorithm - the name of the algorithm
+        Returns:
+            A dictionary of file name to hex digest
+        """
+        with self.hashing:
+            file_digests = {}
+            missing = []
+            for filename in filenames:
+                stat = os.stat(join(self.local_path, filename))
+                mtime_ns = getattr(stat, "st_mtime_ns",
+                                   int(stat.st_mtime * 10 ** 9))
+                with self.lock:
+                    self.seen.add(filename)
+                    entry = self.entries.get(filename)
+                if (entry and entry[0] == stat.st_size and
+                        entry[1] == mtime_ns and algorithm in entry[2]):
+                    file_digests[filename] = entry[2][algorithm]
+                else:
+                    missing.append((filename, stat, mtime_ns))
+
+            workers = min(settings().hash_workers, len(missing))
+            hashed = fan_out(lambda item: hashsum(item[0], self.local_path,
+                                                  algorithm), missing, workers)
+            for (filename, stat, mtime_ns), file_digest in zip(missing,
+                                                                hashed):
+                file_digests[filename] = file_digest
+                with self.lock:
+                    if time.time() - stat.st_mtime <= self.RACY_SECONDS:
+                        self.entries.pop(filename, None)
+                        continue
+                    entry = self.entries.get(filename)
+                    if not entry or entry[:2] != [stat.st_size, mtime_ns]:
+                        entry = [stat.st_size, mtime_ns, {}]
+                        self.entries[filename] = entry
+                    entry[2][algorithm] = file_digest
+                    self.dirty = True
+            return file_digests
+
+    def save(self):
+        """Write the cache file if anything changed, forgetting files that
+           were not asked for. Failures are logged, the cache is only an
+           optimization.
+        Globals:
+            LOGGER
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        with self.lock:
+            for filename in set(self.entries) - self.seen:
+                del self.entries[filename]
+                self.dirty = True
+            if not self.dirty:
+                return
+            temporary_path = "%s.%d.tmp" % (self.cache_path, os.getpid())
+            try:
+                if not isdir(dirname(self.cache_path)):
+                    os.makedirs(dirname(self.cache_path))
+                with open(temporary_path, "w") as cache_file:
+                    json.dump({"local_path": self.local_path,
+                               "files": self.entries}, cache_file)
+                os.rename(temporary_path, self.cache_path)
+                self.dirty = False
+            except (IOError, OSError) as error:
+                LOGGER.warning("Could not save the hash cache %s: %s",
+                               self.cache_path, error)
+
+
+class ManifestCache(object):
+
+    """ The remote manifests fetched while planning, keyed by host and
+        remote folder, so the deploy approved from the plan starts from them
+        instead of fetching them again. Entries are only trusted for ttl
+        seconds and serve a single deploy, which changes the folder. Changes
+        made on a host after its manifest was taken go unnoticed until then.
+        The cache is one JSON file.
+    """
+
+    def __init__(self, path, ttl=300):
+        """Manifest cache initialization, loads the cache file when there is
+           one
+        Globals:
+            LOGGER
+        Arguments:
+            self
+            path - the cache file
+            ttl - seconds a manifest is trusted after being taken
+        Returns:
+            none
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(path) as cache_file:
+                self.entries = json.load(cache_file)["manifests"]
+        except (IOError, ValueError, KeyError):
+            LOGGER.debug("No usable manifest cache at %s.", path)
+
+    def put(self, host, remote_path, recursive, planned):
+        """Remember the manifest of a planned folder
+        Globals:
+            none
+        Arguments:
+            self
+            host - the host planned for
+            remote_path - the remote folder
+            recursive - whether the manifest covers the whole tree
+            planned - the plan returned by plan
+        Returns:
+            none
+        """
+        with self.lock:
+            self.entries["%s:%s" % (host, remote_path)] = {
+                "taken": planned["taken"], "recursive": recursive,
+                "algorithm": planned["algorithm"], "files": planned["files"]}
+            self.dirty = True
+
+    def take(self, host, remote_path, recursive):
+        """Hand out the manifest of a folder once, if it is still fresh
+        Globals:
+            none
+        Arguments:
+            self
+            host - the host being deployed to
+            remote_path - the remote folder
+            recursive - whether the deploy covers the whole tree
+        Returns:
+            A dictionary with the time it was taken, the algorithm and the
+            checksum per file name, or None
+        """
+        with self.lock:
+            entry = self.entries.pop("%s:%s" % (host, remote_path), None)
+            if entry is None:
+                return None
+            self.dirty = True
+        if entry["recursive"] != recursive or \
+                not 0 <= time.time() - entry["taken"] < self.ttl:
+            return None
+        return entry
+
+    def save(self):
+        """Write the cache file if anything changed, dropping expired
+           manifests. Failures are logged, the cache is only an optimization.
+        Globals:
+            LOGGER
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        with self.lock:
+            now = time.time()
+            for key, entry in list(self.entries.items()):
+                if not 0 <= now - entry["taken"] < self.ttl:
+                    del self.entries[key]
+                    self.dirty = True
+            if not self.dirty:
+                return
+            temporary_path = "%s.%d.tmp" % (self.path, os.getpid())
+            try:
+                if dirname(self.path) and not isdir(dirname(self.path)):
+                    os.makedirs(dirname(self.path))
+                with open(temporary_path, "w") as cache_file:
+                    json.dump({"manifests": self.entries}, cache_file)
+                os.rename(temporary_path, self.path)
+                self.dirty = False
+            except (IOError, OSError) as error:
+                LOGGER.warning("Could not save the manifest cache %s: %s",
+                               self.path, error)
+
+
+def remote_manifest(remote_path, ssh, filenames=None, create=False,
+                    recursive=False, algorithm=None):
+    """Fetch the checksums of many remote files with a single command. The
+       first manifest of a connection also picks the most preferred
+       algorithm the host has a command for, and records it on ssh.
+    Globals:
+        LOGGER, HASH_ALGORITHMS
+    Arguments:
+        remote_path - the remote folder holding the files
+        ssh - the ssh connection
+        filenames - the names to checksum, defaults to every regular file
+                    directly inside the remote folder
+        create - whether to create the remote folder first
+        recursive - whether the default covers the whole tree under the
+                    remote folder
+        algorithm - the algorithm to use, defaults to the one agreed on
+                    with the host
+    Returns:
+        A dictionary of file name to checksum, files that are missing or
+        could not be read are left out
+    """
+    if filenames is None:
+        listing = ["find . %s-type f ! -name '*.md5' -exec \"$tool\" {} +" % (
+            "" if recursive else "-maxdepth 1 ")]
+    else:
+        # keep each command line well below the remote ARG_MAX
+        listing = ["\"$tool\" -- " + " ".join(quote(name) for name in batch)
+                   for batch in chunks(sorted(filenames), MANIFEST_BATCH)]
+    # the first tool found wins, its name leads the output
+    algorithm = algorithm or ssh.algorithm
+    tools = [HASH_ALGORITHMS[name][0] for name in
+             ([algorithm] if algorithm else settings().hash_algorithms)]
+    command = ("for tool in %s; do command -v \"$tool\" >/dev/null 2>&1 && "
+               "break; done; echo \"$tool\"; cd %s 2>/dev/null && "
+               "{ %s; } 2>/dev/null" % (" ".join(tools), quote(remote_path),
+                                        "; ".join(listing) or "true"))
+    if create:
+        command = "mkdir -p %s; %s" % (quote(remote_path), command)
+
+    from paramiko import SSHException
+    config = settings()
+    try:
+        # hashing a large folder prints nothing for long stretches, so the
+        # manifest gets a timeout of its own instead of the per-command one
+        # pylint: disable=unused-variable
+        status, output, error = ssh.run(command,
+                                        timeout=config.manifest_timeout)
+    except socket.timeout:
+        LOGGER.warning("Reading the remote checksums in %s took longer than "
+                       "manifest_timeout, %d seconds", remote_path,
+                       config.manifest_timeout)
+        return {}
+    except (SSHException, socket.error) as error:
+        LOGGER.warning("Failed to read the remote checksums in %s: %s",
+                       remote_path, error)
+        return {}
+
+    lines = output.splitlines()
+    if algorithm is None and lines:
+        for name, (tool, _) in HASH_ALGORITHMS.items():
+            if tool == lines[0]:
+                LOGGER.info("Checksumming with %s on %s.", tool, ssh.host)
+                ssh.algorithm = name
+    manifest = {}
+    for line in lines[1:]:
+        # md5sum escapes names holding a backslash or newline, flagged by a
+        # leading backslash
+        escaped = line.startswith("\\")
+        digest, _, name = line[int(escaped):].partition("  ")
+        if escaped:
+            name = ESCAPE_PATTERN.sub(unescape, name)
+        if name.startswith("./"):
+            name = name[2:]
+        if digest and name:
+            manifest[name] = digest
+    return manifest
+
+
+def checksum(local_hashes, remote_path, ssh, algorithm="md5"):
+    """Which of the deployed files match their local checksum
+    Globals:
+        LOGGER
+    Arguments:
+        local_hashes - a dictionary of file name to local checksum
+        remote_path - the remote folder the files were deployed to
+        ssh - the ssh connection
+        algorithm - the algorithm the local checksums were made with
+    Returns:
+        The set of file names whose remote checksum matches, files that can
+        not be determined to be matching are left out
+    """
+    # the actual check, notice it only returns the matches and does not stop
+    # exectuion of the program
+    with METRICS.span(ssh.host, "checksum") as span:
+        remote_hashes = remote_manifest(remote_path, ssh, local_hashes.keys(),
+                                        algorithm=algorithm)
+        verified = set()
+        for filename, local_checksum in local_hashes.items():
+            LOGGER.debug("Local checksum of %s %s", filename, local_checksum)
+            LOGGER.debug("Remote checksum of %s %s", filename,
+                         remote_hashes.get(filename))
+            if remote_hashes.get(filename) == local_checksum:
+                verified.add(filename)
+        span.add(len(local_hashes))
+    return verified
+
+
+def install_files(parts, remote_path, ssh):
+    """Make verified uploads executable and move them over the files they
+       replace with a single command
+    Globals:
+        LOGGER
+    Arguments:
+        parts - a dictionary of file name inside the remote folder to the
+                temporary name it was uploaded as
+        remote_path - the remote folder holding the files
+        ssh - the ssh connection
+    Returns:
+        The set of file names now replaced
+    """
+    installed = set()
+    for batch in chunks(sorted(parts), MANIFEST_BATCH):
+        status, _, error = ssh.run("cd %s && chmod 755 -- %s && %s" % (
+            quote(remote_path), " ".join(quote(parts[name]) for name in batch),
+            " && ".join("mv -f -- %s %s" % (quote(parts[name]), quote(name))
+                        for name in batch)))
+        if status:
+            LOGGER.warning("Could not replace files in %s: %s", remote_path,
+                           error)
+        else:
+            installed.update(batch)
+    return installed
+
+
+def unescape(match):
+    """Undo one md5sum escape sequence
+    Globals:
+        none
+    Arguments:
+        match - the ESCAPE_PATTERN match
+    Returns:
+        The unescaped character
+    """
+    return "\n" if match.group(1) == "n" else match.group(1)
+
+
+def chunks(items, size):
+    """Split a list into consecutive lists of at most size items
+    Globals:
+        none
+    Arguments:
+        items - the list to split
+        size - the most items in each list
+    Returns:
+        A generator of lists
+    """
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
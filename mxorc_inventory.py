@@ -0,0 +1,273 @@
+"""Keeps an inventory of hosts, their resolved addresses and pinned host keys."""
+import os
+import socket
+import threading
+import time
+import ConfigParser
+from multiprocessing.pool import ThreadPool
+from os.path import dirname, isdir
+import mxorc_logger
+
+LOGGER = mxorc_logger.get_logger(name="mxorc_inventory")
+
+
+class Inventory(object):
+
+    """ An INI file with a section per host, recording the host's group and
+        SSH port, kept by the operators and never written. What is learned
+        about the hosts, the address each last resolved to, when it was
+        resolved and its pinned host key, is kept in a state file of the
+        same layout next to it. Hosts are resolved in bulk before a run, then
+        connected to by their cached address and checked against their key.
+    """
+
+    # the options learned about hosts, read from the state file first, so
+    # values left in the inventory by older versions still count
+    STATE_OPTIONS = ("address", "resolved", "host_key")
+
+    def __init__(self, path, resolve_ttl=300, probe_timeout=3,
+                 state_path=None):
+        """Inventory initialization, reads the inventory and state files if
+           they exist
+        Globals:
+            none
+        Arguments:
+            self
+            path - the inventory file
+            resolve_ttl - seconds a resolved address is trusted without
+                          resolving it again
+            probe_timeout - seconds to wait for a host to accept a connection
+                            during the pre-flight pass
+            state_path - the state file, defaults to the inventory file with
+                         .state appended
+        Returns:
+            none
+        """
+        self.path = path
+        self.state_path = state_path or "%s.state" % path
+        self.resolve_ttl = resolve_ttl
+        self.probe_timeout = probe_timeout
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.config = ConfigParser.RawConfigParser()
+        self.config.read(path)
+        self.state = ConfigParser.RawConfigParser()
+        self.state.read(self.state_path)
+
+    def get(self, host, option, default=None):
+        """Read an option of a host
+        Globals:
+            none
+        Arguments:
+            self
+            host - the host's name
+            option - the option's name
+            default - the value to use when the option is not recorded
+        Returns:
+            The recorded value as a string, or the default
+        """
+        with self.lock:
+            if option in self.STATE_OPTIONS and \
+                    self.state.has_option(host, option):
+                return self.state.get(host, option)
+            if self.config.has_option(host, option):
+                return self.config.get(host, option)
+        return default
+
+    def set(self, host, option, value):
+        """Record an option of a host. Learned options are saved to the state
+           file, the others only hold for this run.
+        Globals:
+            none
+        Arguments:
+            self
+            host - the host's name
+            option - the option's name
+            value - the value to record
+        Returns:
+            none
+        """
+        with self.lock:
+            if self.get(host, option) == str(value):
+                return
+            config = self.state if option in self.STATE_OPTIONS \
+                else self.config
+            if not config.has_section(host):
+                config.add_section(host)
+            config.set(host, option, str(value))
+            self.dirty = self.dirty or config is self.state
+
+    def hosts(self, group=None):
+        """The hosts in the inventory
+        Globals:
+            none
+        Arguments:
+            self
+            group - only return hosts of this group, "all" or None for every
+                    host
+        Returns:
+            A list of host names, in inventory order
+        """
+        with self.lock:
+            return [host for host in self.config.sections()
+                    if group in (None, "all") or self.get(host, "group") == group]
+
+    def address(self, host):
+        """The address to connect to for a host
+        Globals:
+            none
+        Arguments:
+            self
+            host - the host's name
+        Returns:
+            The cached address, or the name itself when it was never resolved
+        """
+        return self.get(host, "address", host)
+
+    def port(self, host, default=22):
+        """The SSH port of a host
+        Globals:
+            none
+        Arguments:
+            self
+            host - the host's name
+            default - the port to use when none is recorded
+        Returns:
+            The port, as an int
+        """
+        return int(self.get(host, "port", default))
+
+    def resolve(self, host):
+        """Resolve a host, unless its cached address is still fresh. When
+           resolution fails a cached address is kept, so a flaky resolver
+           does not fail a known host.
+        Globals:
+            LOGGER
+        Arguments:
+            self
+            host - the host's name
+        Returns:
+            The address to connect to
+        Raises:
+            socket.gaierror - if the host can not be resolved and was never
+                              resolved before
+        """
+        resolved = float(self.get(host, "resolved", 0))
+        if self.get(host, "address") and time.time() - resolved < self.resolve_ttl:
+            return self.address(host)
+        try:
+            address = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)[0][4][0]
+        except socket.gaierror:
+            if not self.get(host, "address"):
+                raise
+            LOGGER.warning("Could not resolve %s, using its cached address %s.",
+                           host, self.address(host))
+            return self.address(host)
+        if address != self.get(host, "address"):
+            LOGGER.info("%s resolved to %s.", host, address)
+        self.set(host, "address", address)
+        self.set(host, "resolved", int(time.time()))
+        return address
+
+    def preflight(self, hosts, default_port=22, max_parallel=32):
+        """Resolve every host and check it accepts connections on its SSH
+           port, all hosts at once, so unreachable hosts are found up front
+           instead of one timeout at a time during a run
+        Globals:
+            LOGGER
+        Arguments:
+            self
+            hosts - the hosts' names
+            default_port - the port of hosts without a recorded one
+            max_parallel - the most hosts checked at the same time
+        Returns:
+            A dictionary of host name to the error that failed it, hosts that
+            passed are left out
+        """
+        def check(host):
+            """Resolve and probe one host"""
+            try:
+                address = self.resolve(host)
+                probe = socket.create_connection(
+                    (address, self.port(host, default_port)),
+                    self.probe_timeout)
+                probe.close()
+            except socket.error as error:
+                LOGGER.error("%s failed the pre-flight check: %s", host, error)
+                return host, error
+            return host, None
+
+        if not hosts:
+            return {}
+        pool = ThreadPool(min(max_parallel, len(hosts)))
+        try:
+            results = pool.map(check, hosts, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        self.save()
+        return dict((host, error) for host, error in results if error)
+
+    def verify_key(self, host, key):
+        """Check a server's key against the one pinned for the host, pinning
+           it if the host has none yet
+        Globals:
+            LOGGER
+        Arguments:
+            self
+            host - the host's name
+            key - the key the server presented
+        Returns:
+            none
+        Raises:
+            paramiko.BadHostKeyException - if the key does not match
+        """
+        import paramiko
+        from paramiko.hostkeys import HostKeyEntry
+        presented = "%s %s" % (key.get_name(), key.get_base64())
+        with self.lock:
+            pinned = self.get(host, "host_key")
+            if pinned is None:
+                LOGGER.warning("Pinning the %s host key of %s.",
+                               key.get_name(), host)
+                self.set(host, "host_key", presented)
+                return
+        if pinned != presented:
+            LOGGER.error("The host key of %s does not match its pinned key.",
+                         host)
+            try:
+                entry = HostKeyEntry.from_line("%s %s" % (host, pinned))
+            except (paramiko.SSHException, ValueError, TypeError):
+                entry = None
+            if entry is None or entry.key is None:
+                raise paramiko.SSHException("The host key of %s does not "
+                                            "match its pinned key." % host)
+            raise paramiko.BadHostKeyException(host, key, entry.key)
+
+    def save(self):
+        """Write the state file if anything was learned. Failures are logged,
+           the state is rebuilt on the next run, pinning keys again.
+        Globals:
+            LOGGER
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            temporary_path = "%s.%d.tmp" % (self.state_path, os.getpid())
+            try:
+                if dirname(self.state_path) and \
+                        not isdir(dirname(self.state_path)):
+                    os.makedirs(dirname(self.state_path))
+                with open(temporary_path, "w") as state_file:
+                    state_file.write("# Written by mxorc_deploy, hosts are "
+                                     "kept in %s.\n" % self.path)
+                    self.state.write(state_file)
+                os.rename(temporary_path, self.state_path)
+                self.dirty = False
+            except (IOError, OSError) as error:
+                LOGGER.warning("Could not save the host state %s: %s",
+                               self.state_path, error)
@@ -1,11 +1,28 @@
 """A python logger to catch all messages from failover scripts"""
-from os.path import join, dirname
+from os.path import join, dirname, isfile
+import atexit
+import copy
+import json
 import logging
-import logging.config
+import threading
+import time
+import Queue
 
 THIS_DIRECTORY = dirname(__file__)
+LOGGER_CONFIG = join(THIS_DIRECTORY, "conf/mxorc_logger.conf")
 
-logging.config.fileConfig(join(THIS_DIRECTORY, "conf/mxorc_logger.conf"))
+# whether configure() already ran
+CONFIGURED = False
+
+# what a full queue does with a new record
+OVERFLOW_POLICIES = ("block", "drop_new", "drop_old")
+
+# the context fields of the current thread, such as the host worked on
+CONTEXT = threading.local()
+
+# the running QueueListener, if queued logging is enabled
+LISTENER = None
+LISTENER_LOCK = threading.Lock()
 
 def get_logger(name="mxorc_logger"):
     """Get the logging object and name it according to user input
@@ -18,3 +35,323 @@ def get_logger(name="mxorc_logger"):
         A Logger object, named according to user input
     """
     return logging.getLogger(str(name))
+
+
+def configure():
+    """Apply the logging config, once. Entry points call this when they
+       start working, so importing a module or printing --help does not pay
+       for it.
+
+    Globals:
+        CONFIGURED, LISTENER_LOCK
+    Arguments:
+        none
+    Returns:
+        none
+    """
+    global CONFIGURED
+    with LISTENER_LOCK:
+        if CONFIGURED:
+            return
+        CONFIGURED = True
+        # fall back to plain console logging where the site config is not
+        # deployed, such as when running the local test suite
+        if isfile(LOGGER_CONFIG):
+            from logging.config import fileConfig
+            fileConfig(LOGGER_CONFIG, disable_existing_loggers=False)
+        else:
+            logging.basicConfig(level=logging.INFO)
+
+
+def start_queue(max_size=10000, overflow="block", json_output=False):
+    """Move every configured handler behind one bounded queue, drained by a
+       single listener thread, so logging threads only pay for an enqueue.
+       The queue is flushed when the program exits.
+
+    Globals:
+        LISTENER, LISTENER_LOCK
+    Arguments:
+        max_size: The most records waiting in the queue, 0 for no bound
+        overflow: What a full queue does with a new record, block waits for
+                  room, drop_new discards the new record and drop_old discards
+                  the oldest waiting one
+        json_output: Whether records are written as one JSON object per line
+    Returns:
+        The QueueListener, also when queued logging was already enabled
+    """
+    global LISTENER
+    configure()
+    if overflow not in OVERFLOW_POLICIES:
+        raise ValueError("overflow must be one of %s" % ", ".join(
+            OVERFLOW_POLICIES))
+    with LISTENER_LOCK:
+        if LISTENER is None:
+            LISTENER = QueueListener(max_size, overflow, json_output)
+            LISTENER.start()
+        return LISTENER
+
+
+def stop_queue():
+    """Flush the queue, stop the listener and give every logger its
+       handlers back
+
+    Globals:
+        LISTENER, LISTENER_LOCK
+    Arguments:
+        none
+    Returns:
+        none
+    """
+    global LISTENER
+    with LISTENER_LOCK:
+        if LISTENER is not None:
+            LISTENER.stop()
+            LISTENER = None
+
+atexit.register(stop_queue)
+
+
+class context(object):
+
+    """ Adds fields, such as the host being worked on, to every record logged
+        by the current thread while it is entered. Threads started inside
+        do not inherit them, pass current_context() along to them.
+    """
+
+    # pylint: disable=invalid-name
+    def __init__(self, **fields):
+        self.fields = fields
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = current_context()
+        merged = dict(self.previous)
+        merged.update(self.fields)
+        CONTEXT.fields = merged
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        CONTEXT.fields = self.previous
+
+
+def current_context():
+    """The context fields of the current thread
+
+    Globals:
+        CONTEXT
+    Arguments:
+        none
+    Returns:
+        A dictionary of field name to value
+    """
+    return getattr(CONTEXT, "fields", {})
+
+
+class QueueHandler(logging.Handler):
+
+    """ Puts a copy of records on the listener's queue, along with the
+        handlers they were meant for. The message is rendered here, so
+        arguments changed after the call can not change what is logged. The
+        record itself goes on to the handlers of parent loggers untouched.
+    """
+
+    def __init__(self, listener, targets):
+        logging.Handler.__init__(self)
+        self.listener = listener
+        self.targets = targets
+
+    def handle(self, record):
+        """Enqueue without taking the handler lock, the queue has its own"""
+        passed = self.filter(record)
+        if passed:
+            self.emit(record)
+        return passed
+
+    def emit(self, record):
+        try:
+            queued = copy.copy(record)
+            queued.msg = record.getMessage()
+            queued.args = None
+            if record.exc_info:
+                queued.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                queued.exc_info = None
+            queued.context = current_context()
+            self.listener.put((self.targets, queued))
+        # pylint: disable=broad-except
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+
+    """ Owns the queue and the thread writing its records to the handlers
+        they were meant for. Dropped records are counted and reported in the
+        log once the queue has room again.
+    """
+
+    def __init__(self, max_size=10000, overflow="block", json_output=False):
+        """Queue listener initialization
+        Globals:
+            none
+        Arguments:
+            self
+            max_size - the most records waiting, 0 for no bound
+            overflow - block, drop_new or drop_old
+            json_output - whether records are written as JSON lines
+        Returns:
+            none
+        """
+        self.queue = Queue.Queue(max_size)
+        self.overflow = overflow
+        self.json_output = json_output
+        self.dropped = 0
+        self.reported = 0
+        self.lock = threading.Lock()
+        self.swapped = []
+        self.thread = None
+
+    def start(self):
+        """Put a QueueHandler in place of the handlers of every logger that
+           has some, then start draining the queue
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        loggers = [logging.getLogger()] + [
+            logger for logger in logging.Logger.manager.loggerDict.values()
+            if isinstance(logger, logging.Logger)]
+        for logger in loggers:
+            if not logger.handlers:
+                continue
+            targets = list(logger.handlers)
+            if self.json_output:
+                for handler in targets:
+                    self.swapped.append((handler, handler.formatter))
+                    handler.setFormatter(JSONFormatter())
+            self.swapped.append((logger, targets))
+            logger.handlers = [QueueHandler(self, targets)]
+        self.thread = threading.Thread(target=self.run, name="log-listener")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, item):
+        """Enqueue a record, following the overflow policy when full
+        Globals:
+            none
+        Arguments:
+            self
+            item - the target handlers and the record
+        Returns:
+            none
+        """
+        if self.overflow == "block":
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+            return
+        except Queue.Full:
+            pass
+        if self.overflow == "drop_old":
+            try:
+                oldest = self.queue.get_nowait()
+            except Queue.Empty:
+                oldest = ()
+            if oldest is None:
+                # never the stop sentinel, stop() would wait for it forever,
+                # and nothing queued after it gets written anyway
+                self.queue.put(None)
+            else:
+                try:
+                    self.queue.put_nowait(item)
+                except Queue.Full:
+                    pass
+        with self.lock:
+            self.dropped += 1
+
+    def run(self):
+        """Write records until the stop sentinel is read
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            targets, record = item
+            # the text formats know nothing of the context, name the host
+            if "host" in record.context and not self.json_output:
+                record.msg = "%s: %s" % (record.context["host"], record.msg)
+            self.write(targets, record)
+            if self.dropped != self.reported:
+                with self.lock:
+                    dropped, self.reported = self.dropped - self.reported, \
+                        self.dropped
+                warning = logging.LogRecord(
+                    "mxorc_logger", logging.WARNING, __file__, 0,
+                    "Dropped %d log records, the log queue was full.",
+                    (dropped,), None)
+                self.write(targets, warning)
+
+    @staticmethod
+    def write(targets, record):
+        """Hand a record to the handlers it was meant for, a failing handler
+           must not stop the listener"""
+        for handler in targets:
+            if record.levelno >= handler.level:
+                try:
+                    handler.handle(record)
+                # pylint: disable=broad-except
+                except Exception:
+                    handler.handleError(record)
+
+    def stop(self):
+        """Write everything still queued, then give the loggers their
+           handlers back
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.queue.put(None)
+        self.thread.join()
+        for owner, previous in reversed(self.swapped):
+            if isinstance(owner, logging.Logger):
+                owner.handlers = previous
+            else:
+                owner.setFormatter(previous)
+                owner.flush()
+        self.swapped = []
+
+
+class JSONFormatter(logging.Formatter):
+
+    """ Formats a record as one JSON object, with the context fields of the
+        thread that logged it at the top level.
+    """
+
+    def format(self, record):
+        message = {"time": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                         time.gmtime(record.created)) +
+                           ".%03dZ" % record.msecs,
+                   "level": record.levelname,
+                   "logger": record.name,
+                   "thread": record.threadName,
+                   "message": record.getMessage()}
+        fields = getattr(record, "context", None)
+        message.update(current_context() if fields is None else fields)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            message["exception"] = record.exc_text
+        return json.dumps(message, sort_keys=True)
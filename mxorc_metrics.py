@@ -0,0 +1,301 @@
+"""Times the phases of a run per host and exports them as a JSON run report
+   or a Prometheus textfile collector file."""
+import json
+import os
+import re
+import threading
+import time
+from os.path import dirname, isdir
+import mxorc_logger
+
+LOGGER = mxorc_logger.get_logger(name="mxorc_metrics")
+
+# the host recorded for work done locally, shared by every host
+LOCAL = "local"
+
+# the characters escaped inside a Prometheus label value
+LABEL_ESCAPES = re.compile(r'[\\"\n]')
+
+
+class Recorder(object):
+
+    """ Collects timing spans and counters per host and phase. A disabled
+        recorder hands out one shared span that records nothing, so spans
+        can stay in place at no noticeable cost.
+    """
+
+    def __init__(self, enabled=False):
+        """Recorder initialization
+        Globals:
+            none
+        Arguments:
+            self
+            enabled - whether spans and counters are recorded
+        Returns:
+            none
+        """
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.results = {}
+
+    def span(self, host, phase):
+        """Time a phase for a host, to be used as a context manager
+        Globals:
+            none
+        Arguments:
+            self
+            host - the host the phase works on, None for local work
+            phase - the phase's name
+        Returns:
+            A Span, its add method counts the items and bytes handled
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, host or LOCAL, phase)
+
+    def record(self, host, phase, seconds, items=0, size=0):
+        """Add a finished span
+        Globals:
+            none
+        Arguments:
+            self
+            host - the host the phase worked on
+            phase - the phase's name
+            seconds - how long it took
+            items - the number of files or commands it handled
+            size - the number of bytes it handled
+        Returns:
+            none
+        """
+        with self.lock:
+            totals = self.phases.setdefault(host, {}).setdefault(
+                phase, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                        "items": 0, "bytes": 0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["max_seconds"] = max(totals["max_seconds"], seconds)
+            totals["items"] += items
+            totals["bytes"] += size
+
+    def count(self, host, counter, amount=1):
+        """Add to a counter of a host
+        Globals:
+            none
+        Arguments:
+            self
+            host - the host counted for, None for local work
+            counter - the counter's name, such as round_trips
+            amount - how much to add
+        Returns:
+            none
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            counters = self.counters.setdefault(host or LOCAL, {})
+            counters[counter] = counters.get(counter, 0) + amount
+
+    def result(self, host, status, seconds):
+        """Record how a host ended
+        Globals:
+            none
+        Arguments:
+            self
+            host - the host's name
+            status - ok, skipped or failed
+            seconds - how long the host took from connecting to finishing
+        Returns:
+            none
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.results[host] = {"status": status, "seconds": seconds}
+
+    def report(self):
+        """Everything recorded so far
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            A dictionary of the run's start and duration, and per host its
+            status, duration, phases and counters
+        """
+        with self.lock:
+            hosts = {}
+            for host in set(self.phases) | set(self.counters) | set(self.results):
+                hosts[host] = dict(self.results.get(host, {}))
+                hosts[host]["phases"] = dict(
+                    (phase, dict(totals))
+                    for phase, totals in self.phases.get(host, {}).items())
+                hosts[host]["counters"] = dict(self.counters.get(host, {}))
+            return {"started": self.started,
+                    "seconds": time.time() - self.started,
+                    "hosts": hosts}
+
+    def write_report(self, path):
+        """Write the run report as JSON
+        Globals:
+            LOGGER
+        Arguments:
+            self
+            path - the file to write
+        Returns:
+            none
+        """
+        write_atomically(path, json.dumps(self.report(), indent=2,
+                                          sort_keys=True) + "\n")
+
+    def write_textfile(self, path, prefix="mxorc_deploy"):
+        """Write the run as a Prometheus textfile collector file, one gauge
+           per host and phase, so latency percentiles can be taken over runs
+        Globals:
+            LOGGER
+        Arguments:
+            self
+            path - the file to write, it should end in .prom
+            prefix - the prefix of every metric name
+        Returns:
+            none
+        """
+        report = self.report()
+        families = (
+            ("host_seconds", "Seconds a host took from connecting to "
+             "finishing."),
+            ("host_success", "Whether the host ended ok or skipped."),
+            ("phase_seconds", "Seconds spent in a phase."),
+            ("phase_max_seconds", "Longest single span of a phase."),
+            ("phase_calls", "Spans recorded for a phase."),
+            ("phase_items", "Files or commands handled in a phase."),
+            ("phase_bytes", "Bytes handled in a phase."),
+            ("counter", "Per host counters, such as round trips."))
+        samples = dict((name, []) for name, _ in families)
+        for host, values in sorted(report["hosts"].items()):
+            if "status" in values:
+                samples["host_seconds"].append(
+                    ({"host": host}, values["seconds"]))
+                samples["host_success"].append(
+                    ({"host": host}, int(values["status"] != "failed")))
+            for phase, totals in sorted(values["phases"].items()):
+                labels = {"host": host, "phase": phase}
+                samples["phase_seconds"].append((labels, totals["seconds"]))
+                samples["phase_max_seconds"].append(
+                    (labels, totals["max_seconds"]))
+                samples["phase_calls"].append((labels, totals["calls"]))
+                samples["phase_items"].append((labels, totals["items"]))
+                samples["phase_bytes"].append((labels, totals["bytes"]))
+            for counter, value in sorted(values["counters"].items()):
+                samples["counter"].append(
+                    ({"host": host, "counter": counter}, value))
+
+        lines = []
+        for name, description in families:
+            metric = "%s_%s" % (prefix, name)
+            lines.append("# HELP %s %s" % (metric, description))
+            lines.append("# TYPE %s gauge" % metric)
+            for labels, value in samples[name]:
+                lines.append("%s{%s} %s" % (metric, ",".join(
+                    '%s="%s"' % (label, escape_label(labels[label]))
+                    for label in sorted(labels)), repr(float(value))))
+        lines.append("# HELP %s_last_run_seconds Unix time the last run "
+                     "finished." % prefix)
+        lines.append("# TYPE %s_last_run_seconds gauge" % prefix)
+        lines.append("%s_last_run_seconds %s" % (prefix, repr(time.time())))
+        write_atomically(path, "\n".join(lines) + "\n")
+
+
+class Span(object):
+
+    """ Times one phase from entering to leaving it."""
+
+    __slots__ = ("recorder", "host", "phase", "items", "size", "start")
+
+    def __init__(self, recorder, host, phase):
+        self.recorder = recorder
+        self.host = host
+        self.phase = phase
+        self.items = 0
+        self.size = 0
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.record(self.host, self.phase, time.time() - self.start,
+                             self.items, self.size)
+
+    def add(self, items=0, size=0):
+        """Count items and bytes handled by the phase
+        Globals:
+            none
+        Arguments:
+            self
+            items - the number of files or commands handled
+            size - the number of bytes handled
+        Returns:
+            none
+        """
+        self.items += items
+        self.size += size
+
+
+class NullSpan(object):
+
+    """ Stands in for a Span while recording is disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def add(self, items=0, size=0):
+        """Ignore the counts"""
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def escape_label(value):
+    """Escape a Prometheus label value
+    Globals:
+        LABEL_ESCAPES
+    Arguments:
+        value - the label's value
+    Returns:
+        The escaped value
+    """
+    return LABEL_ESCAPES.sub(
+        lambda match: "\\n" if match.group(0) == "\n" else "\\" + match.group(0),
+        str(value))
+
+
+def write_atomically(path, contents):
+    """Replace a file in one step, so collectors never read half of it.
+       Failures are logged, metrics never fail a run.
+    Globals:
+        LOGGER
+    Arguments:
+        path - the file to write
+        contents - the text to write
+    Returns:
+        none
+    """
+    temporary_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        if dirname(path) and not isdir(dirname(path)):
+            os.makedirs(dirname(path))
+        with open(temporary_path, "w") as output:
+            output.write(contents)
+        os.rename(temporary_path, path)
+    except (IOError, OSError) as error:
+        LOGGER.warning("Could not write the metrics to %s: %s", path, error)
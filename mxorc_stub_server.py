@@ -0,0 +1,511 @@
+"""An in-process SSH and SFTP server backed by a local directory, standing in
+   for a real host when testing and benchmarking mxorc_deploy."""
+import errno
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import paramiko
+from paramiko import (SFTPAttributes, SFTPHandle, SFTPServer,
+                      SFTPServerInterface)
+from paramiko.sftp import SFTP_FAILURE, SFTP_OK
+import mxorc_deploy
+import mxorc_logger
+
+LOGGER = mxorc_logger.get_logger(name="mxorc_stub_server")
+
+# generating a host key is slow, every server shares one
+HOST_KEY = paramiko.RSAKey.generate(1024)
+
+
+class StubServer(object):
+
+    """ Listens on a free local port and serves SSH sessions. Commands run in
+        a local shell and SFTP works on the local file system. Paths under
+        the alias are mapped into the server's root, so several servers can
+        pretend to share one remote_path while keeping separate trees.
+
+        Conditions can be injected while the server runs:
+            latency - seconds added to every command and SFTP request
+            bandwidth - the most bytes per second written over SFTP or sent
+                        to a command's stdin, None for no cap
+            fail_writes - the number of upcoming SFTP writes to fail
+            drop_writes - the number of upcoming SFTP writes that close every
+                          connection instead
+            hide_commands - names of commands the shell should not find
+
+        The counters record connections, commands, SFTP requests, SFTP writes
+        and the bytes received. Requests are the round trips the client
+        waited on, writes are pipelined so they only pay for bandwidth.
+    """
+
+    def __init__(self, root, alias=None, latency=0.0, bandwidth=None):
+        """Stub server initialization, starts listening right away
+        Globals:
+            none
+        Arguments:
+            self
+            root - the local directory holding the server's files
+            alias - a remote path mapped to root, if any
+            latency - seconds added to every request
+            bandwidth - the most bytes per second received, None for no cap
+        Returns:
+            none
+        """
+        self.root = root
+        self.alias = alias
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_writes = 0
+        self.drop_writes = 0
+        self.hide_commands = []
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.reset()
+        self.transports = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        self.running = True
+        accepter = threading.Thread(target=self.accept, name="stub-accept")
+        accepter.daemon = True
+        accepter.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def reset(self):
+        """Zero the counters
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        with self.lock:
+            self.counters = {"connections": 0, "commands": 0, "requests": 0,
+                             "writes": 0, "bytes": 0}
+
+    def count(self, counter, amount=1):
+        """Add to a counter
+        Globals:
+            none
+        Arguments:
+            self
+            counter - the counter's name
+            amount - how much to add
+        Returns:
+            none
+        """
+        with self.lock:
+            self.counters[counter] += amount
+
+    def delay(self):
+        """Wait out the injected latency
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+    def local(self, path):
+        """Map a path the client sent to the local file system
+        Globals:
+            none
+        Arguments:
+            self
+            path - the client's path
+        Returns:
+            The local path
+        """
+        if self.alias and path.startswith(self.alias):
+            return self.root + path[len(self.alias):]
+        if not path.startswith("/"):
+            return os.path.join(self.root, path)
+        return path
+
+    def command(self, command):
+        """Map the paths of a command the client sent to the local file
+           system
+        Globals:
+            none
+        Arguments:
+            self
+            command - the client's command
+        Returns:
+            The local command
+        """
+        if self.alias:
+            command = command.replace(self.alias, self.root)
+        for name in self.hide_commands:
+            command = re.sub(r"\b%s\b" % re.escape(name), name + "_hidden",
+                             command)
+        return command
+
+    def take(self, counter):
+        """Consume one of an injected failure counter
+        Globals:
+            none
+        Arguments:
+            self
+            counter - fail_writes or drop_writes
+        Returns:
+            True - if a failure should be injected
+            False - if not
+        """
+        with self.lock:
+            if getattr(self, counter) > 0:
+                setattr(self, counter, getattr(self, counter) - 1)
+                return True
+        return False
+
+    def accept(self):
+        """Serve connections until stopped
+        Globals:
+            LOGGER
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        while self.running:
+            try:
+                client = self.listener.accept()[0]
+            except socket.error:
+                return
+            self.count("connections")
+            try:
+                transport = paramiko.Transport(client)
+                transport.add_server_key(HOST_KEY)
+                transport.set_subsystem_handler("sftp", SFTPServer,
+                                                StubSFTPInterface, self)
+                transport.start_server(server=StubInterface(self))
+                self.transports.append(transport)
+            # a probe that only opens the port ends the handshake early
+            except (paramiko.SSHException, EOFError, socket.error) as error:
+                LOGGER.debug("Connection dropped during handshake: %s", error)
+
+    def stop(self):
+        """Stop listening and close every connection
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.running = False
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class StubInterface(paramiko.ServerInterface):
+
+    """ Accepts any public key and runs exec requests in a local shell."""
+
+    def __init__(self, server):
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        self.server.count("commands")
+        self.server.count("requests")
+        runner = threading.Thread(target=self.run, args=(channel, command))
+        runner.daemon = True
+        runner.start()
+        return True
+
+    def run(self, channel, command):
+        """Run a command, relaying stdin, stdout, stderr and the exit status
+        Globals:
+            none
+        Arguments:
+            self
+            channel - the exec channel
+            command - the command the client sent
+        Returns:
+            none
+        """
+        self.server.delay()
+        process = subprocess.Popen(["/bin/sh", "-c",
+                                    self.server.command(command)],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+
+        def feed():
+            """Copy the channel into the command's stdin"""
+            try:
+                for data in iter(lambda: channel.recv(32768), b""):
+                    self.server.count("bytes", len(data))
+                    if self.server.bandwidth:
+                        time.sleep(float(len(data)) / self.server.bandwidth)
+                    process.stdin.write(data)
+            except (IOError, OSError, socket.error):
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except (IOError, OSError):
+                    pass
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        error = []
+        reader = threading.Thread(
+            target=lambda: error.append(process.stderr.read()))
+        reader.daemon = True
+        reader.start()
+        output = process.stdout.read()
+        reader.join()
+        process.wait()
+        try:
+            channel.sendall(output)
+            channel.sendall_stderr(error[0])
+            # a command killed by a signal exits the way a shell reports it
+            channel.send_exit_status(process.returncode if
+                                     process.returncode >= 0 else
+                                     128 - process.returncode)
+        except socket.error:
+            pass
+        channel.close()
+
+
+class StubHandle(SFTPHandle):
+
+    """ An open file, writes go through the server's injected conditions."""
+
+    def __init__(self, server, local_file, flags):
+        SFTPHandle.__init__(self, flags)
+        self.server = server
+        self.readfile = local_file
+        self.writefile = local_file
+
+    def write(self, offset, data):
+        self.server.count("writes")
+        self.server.count("bytes", len(data))
+        if self.server.bandwidth:
+            time.sleep(float(len(data)) / self.server.bandwidth)
+        if self.server.take("drop_writes"):
+            for transport in self.server.transports:
+                transport.close()
+            return SFTP_FAILURE
+        if self.server.take("fail_writes"):
+            return SFTP_FAILURE
+        return SFTPHandle.write(self, offset, data)
+
+    def read(self, offset, length):
+        self.server.count("requests")
+        return SFTPHandle.read(self, offset, length)
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+class StubSFTPInterface(SFTPServerInterface):
+
+    """ Serves SFTP requests from the local file system."""
+
+    def __init__(self, server, stub, *args, **kwargs):
+        SFTPServerInterface.__init__(self, server, *args, **kwargs)
+        self.stub = stub
+
+    def request(self, path):
+        """Count a request and map its path"""
+        self.stub.count("requests")
+        self.stub.delay()
+        return self.stub.local(path)
+
+    def canonicalize(self, path):
+        return os.path.normpath(os.path.join("/", path))
+
+    def list_folder(self, path):
+        path = self.request(path)
+        try:
+            listing = []
+            for name in os.listdir(path):
+                attributes = SFTPAttributes.from_stat(
+                    os.lstat(os.path.join(path, name)))
+                attributes.filename = name
+                listing.append(attributes)
+            return listing
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.request(path)))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self.request(path)))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    def open(self, path, flags, attr):
+        path = self.request(path)
+        try:
+            descriptor = os.open(path, flags | getattr(os, "O_BINARY", 0),
+                                 0o644)
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        return StubHandle(self.stub, os.fdopen(descriptor, mode), flags)
+
+    def remove(self, path):
+        return self.call(os.remove, self.request(path))
+
+    def rename(self, oldpath, newpath):
+        return self.call(os.rename, self.request(oldpath),
+                         self.stub.local(newpath))
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        return self.call(os.mkdir, self.request(path))
+
+    def rmdir(self, path):
+        return self.call(os.rmdir, self.request(path))
+
+    def chattr(self, path, attr):
+        path = self.request(path)
+        if attr.st_mode is not None:
+            return self.call(os.chmod, path, attr.st_mode)
+        return SFTP_OK
+
+    def symlink(self, target_path, path):
+        return self.call(os.symlink, target_path, self.request(path))
+
+    def readlink(self, path):
+        try:
+            return os.readlink(self.request(path))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    @staticmethod
+    def call(function, *args):
+        """Call a file system function, converting its errors to SFTP codes"""
+        try:
+            function(*args)
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno or errno.EIO)
+        return SFTP_OK
+
+
+class StubHostTestCase(unittest.TestCase):
+
+    """ Runs a test against stub servers with Deploy Config options of its
+        own. Every test gets a temporary directory, and afterwards the
+        servers it served are stopped, the directory deleted and the section
+        put back as it was, so no test sees the options of another.
+    """
+
+    def setUp(self):
+        """ Create the directory and save the section.
+        Globals:
+            DEPLOY_CONFIG
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.directory = tempfile.mkdtemp()
+        self.stub_servers = []
+        config = mxorc_deploy.load_config()
+        if not config.has_section("Deploy Config"):
+            config.add_section("Deploy Config")
+        self.saved_options = config.items("Deploy Config", raw=True)
+        self.configure(timeout="10")
+
+    def tearDown(self):
+        """ Stop the servers, delete the directory and put the section back.
+        Globals:
+            DEPLOY_CONFIG
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        for server in self.stub_servers:
+            server.stop()
+        shutil.rmtree(self.directory)
+        config = mxorc_deploy.DEPLOY_CONFIG
+        for option in config.options("Deploy Config"):
+            config.remove_option("Deploy Config", option)
+        for option, value in self.saved_options:
+            config.set("Deploy Config", option, value)
+        mxorc_deploy.reset_settings()
+
+    def configure(self, **options):
+        """ Set Deploy Config options for this test.
+        Globals:
+            DEPLOY_CONFIG
+        Arguments:
+            self
+            options - option names and values
+        Returns:
+            none
+        """
+        for option, value in options.items():
+            mxorc_deploy.DEPLOY_CONFIG.set("Deploy Config", option, value)
+        mxorc_deploy.reset_settings()
+
+    def serve(self, root, alias=None):
+        """ Start a server stopped after the test.
+        Globals:
+            none
+        Arguments:
+            self
+            root - the local directory served
+            alias - the remote path mapped into root, if any
+        Returns:
+            The StubServer
+        """
+        server = StubServer(root, alias)
+        self.stub_servers.append(server)
+        return server
@@ -0,0 +1,379 @@
+"""Starts, stops or restarts a Tomcat instance across many hosts in waves,
+   each wave gated on the instance's status before the next one begins."""
+import argparse
+import json
+import sys
+import time
+import ConfigParser
+from pipes import quote
+import mxorc_deploy
+import mxorc_inventory
+import mxorc_logger
+from mxorc_tc_status import INSTANCE_PATTERN, SCAN, parse_scan
+
+LOGGER = mxorc_logger.get_logger(name="mxorc_tc_control")
+
+# separates the status scan from the control script's output
+MARKER = "--- mxorc_tc_control ---"
+
+# printed once the checks passed, what fails after it is the control script
+SCRIPT_MARKER = "--- swa-control.sh ---"
+
+# the status scan, its stderr dropped, then the checks of mxorc_tc_start.sh
+# and mxorc_tc_stop.sh and the control script's subcommands, their stderr
+# sent along with their output after the marker, each subcommand only run
+# if the one before succeeded, the exit status is the first failure's
+CONTROL = r"""
+{
+%(scan)s
+} 2>/dev/null
+echo %(marker)s
+{
+instance_dir=%(directory)s
+control="$instance_dir/bin/swa-control.sh"
+if [ ! -d "$instance_dir" ]; then
+    echo "Instance Directory could not be found."; exit 2
+fi
+if [ ! -e "$control" ]; then
+    echo "swa-control.sh could not be found."; exit 3
+fi
+echo %(script_marker)s
+%(commands)s
+} 2>&1
+"""
+
+# the control script's subcommands run for each action
+ACTIONS = {"start": ("start",), "stop": ("stop",),
+           "restart": ("stop", "start")}
+
+# what the exit statuses of the checks mean, as mxorc_tc_start.sh and
+# mxorc_tc_stop.sh document them, the control script's are its own
+EXIT_STATUSES = {2: "no_instance", 3: "no_control_script"}
+
+COLUMNS = (("host", "HOST"), ("status", "STATUS"), ("exit_code", "EXIT"),
+           ("pid", "PID"), ("seconds", "SECONDS"), ("output", "OUTPUT"))
+
+
+def main():
+    """The main function, parses args then rolls the action over the hosts
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        none
+    Returns:
+        0 - if the action succeeded and the instance is healthy on every host
+        1 - if not
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=sorted(ACTIONS),
+                        help="What to do with the instance.")
+    parser.add_argument("instance",
+                        help="The instance to act on, eg. SWAMPBoard-B "
+                        "WorkOrderExport_1.0.26-A")
+    parser.add_argument("-t", "--target", action="append", default=[],
+                        help="The host(s) to act on, in rolling order. May "
+                        "be repeated or given as a comma separated list.")
+    parser.add_argument("-i", "--inventory",
+                        help="File listing hosts to act on, one per line.")
+    parser.add_argument("-g", "--group", action="append", default=[],
+                        help="Act on every host of this group in the host "
+                        "inventory, \"all\" for every host. May be repeated.")
+    parser.add_argument("-b", "--batch-size", type=int,
+                        help="Hosts acted on per wave, defaults to "
+                        "rolling_batch_size in the config.")
+    parser.add_argument("-p", "--parallel", type=int,
+                        help="Maximum number of hosts of a wave acted on at "
+                        "once, defaults to max_parallel in the config.")
+    parser.add_argument("--max-failures", type=int,
+                        help="Failed hosts tolerated before no further wave "
+                        "is started, defaults to rolling_max_failures in the "
+                        "config.")
+    parser.add_argument("--health-timeout", type=int,
+                        help="Seconds a wave may take to become healthy, "
+                        "defaults to rolling_health_timeout in the config.")
+    parser.add_argument("--settle", type=int,
+                        help="Seconds a started instance must have been up to "
+                        "count as healthy, defaults to rolling_settle in the "
+                        "config.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the results as JSON instead of a table.")
+    parser.add_argument("--no-agent", action="store_true",
+                        help="Connect directly even if an agent is running.")
+    args = parser.parse_args()
+    if not INSTANCE_PATTERN.match(args.instance):
+        parser.error("%s is not an instance name, such as SWAMPBoard-B"
+                     % args.instance)
+    for name in ("batch_size", "parallel"):
+        if getattr(args, name) is not None and getattr(args, name) < 1:
+            parser.error("--%s must be at least 1" % name.replace("_", "-"))
+
+    try:
+        config = mxorc_deploy.settings()
+        user = config.user
+    except (ConfigParser.Error, ValueError) as error:
+        parser.error("%s: %s" % (mxorc_deploy.DEPLOY_CONFIG_PATH, error))
+    mxorc_logger.configure()
+
+    host_inventory = mxorc_inventory.Inventory(
+        config.host_inventory_path, resolve_ttl=config.resolve_ttl,
+        probe_timeout=config.probe_timeout,
+        state_path=config.host_state_path)
+    hosts = mxorc_deploy.parse_targets(
+        args.target + [",".join(host_inventory.hosts(group))
+                       for group in args.group], args.inventory)
+    if not hosts:
+        parser.error("at least one host is required, use -t, -i or -g")
+    connect = mxorc_deploy.connector(user, host_inventory,
+                                     use_agent=not args.no_agent)
+
+    results = roll(
+        hosts, connect, args.action, args.instance,
+        batch_size=args.batch_size or config.rolling_batch_size,
+        max_parallel=args.parallel or config.max_parallel,
+        max_failures=(config.rolling_max_failures if args.max_failures is None
+                      else args.max_failures),
+        health_timeout=(config.rolling_health_timeout
+                        if args.health_timeout is None
+                        else args.health_timeout),
+        settle=config.rolling_settle if args.settle is None else args.settle)
+    host_inventory.save()
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(format_table(results))
+    return int(any(result["status"] != "ok" for result in results))
+
+
+def roll(hosts, connect, action, instance, batch_size=1, max_parallel=8,
+         max_failures=0, health_timeout=120, settle=0):
+    """Act on an instance wave by wave. Every host is connected to once, up
+       front, and that session serves the action and every status check. A
+       wave starts as soon as the previous one is healthy, and none does
+       once more than max_failures hosts failed, hosts that could not be
+       connected to included.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        hosts - the hosts to act on, in rolling order
+        connect - called with a host, returns its SSHConnector
+        action - start, stop or restart
+        instance - the instance's name
+        batch_size - the hosts per wave
+        max_parallel - the most hosts of a wave acted on at the same time
+        max_failures - the failed hosts tolerated
+        health_timeout - seconds a wave may take to become healthy
+        settle - seconds a started instance must have been up
+    Returns:
+        A list with a dictionary per host holding the host, the action, the
+        instance, its status (ok, no_instance, no_control_script, failed,
+        unhealthy, unreachable or skipped), the control script's exit status
+        and output, the instance's pid and the seconds the host took
+    """
+    results = dict((host, {"host": host, "action": action,
+                           "instance": instance, "status": "skipped",
+                           "exit_code": None, "output": "", "pid": None,
+                           "seconds": 0.0}) for host in hosts)
+    sessions = open_sessions(hosts, connect, max_parallel, results)
+    previous = {}
+    failures = len(hosts) - len(sessions)
+    try:
+        reachable = [host for host in hosts if host in sessions]
+        for start in range(0, len(reachable), batch_size):
+            if failures > max_failures:
+                LOGGER.error("%d hosts failed, %d are left alone.", failures,
+                             len(reachable) - start)
+                break
+            wave = reachable[start:start + batch_size]
+            LOGGER.info("Running %s of %s on %s.", action, instance,
+                        ", ".join(wave))
+            started = time.time()
+            mxorc_deploy.fan_out(
+                lambda host: previous.update({host: control(
+                    sessions[host], action, instance, results[host])}),
+                wave, max_parallel)
+            await_health(sessions, [host for host in wave
+                                    if results[host]["status"] == "acted"],
+                         action, instance, results, previous, started,
+                         health_timeout, settle, max_parallel)
+            failures += sum(1 for host in wave
+                            if results[host]["status"] != "ok")
+    finally:
+        for ssh in sessions.values():
+            ssh.close()
+    return [results[host] for host in hosts]
+
+
+def open_sessions(hosts, connect, max_parallel, results):
+    """Connect to every host at once
+    Globals:
+        LOGGER
+    Arguments:
+        hosts - the hosts to connect to
+        connect - called with a host, returns its SSHConnector
+        max_parallel - the most connections made at the same time
+        results - the results per host, unreachable ones are updated
+    Returns:
+        A dictionary of host to SSHConnector, for the hosts connected to
+    """
+    def open_host(host):
+        """Connect to one host, recording why it could not be"""
+        with mxorc_logger.context(host=host):
+            try:
+                return connect(host)
+            # pylint: disable=broad-except
+            except Exception as error:
+                LOGGER.error("Failed to connect to %s: %s", host, error)
+                results[host]["status"] = "unreachable"
+                results[host]["output"] = str(error) or \
+                    error.__class__.__name__
+                return None
+
+    sessions = mxorc_deploy.fan_out(open_host, hosts, max_parallel)
+    return dict((host, ssh) for host, ssh in zip(hosts, sessions)
+                if ssh is not None)
+
+
+def control(ssh, action, instance, result):
+    """Run the action with a single command, which also scans for the
+       instance's processes beforehand, so a restart can tell a new one. A
+       restart does not start an instance it failed to stop.
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        ssh - the host's ssh connection
+        action - start, stop or restart
+        instance - the instance's name
+        result - the host's result, updated in place, its status is acted
+                 when the control script succeeded
+    Returns:
+        The pids the instance had before the action
+    """
+    config = mxorc_deploy.settings()
+    script = "\"$control\""
+    if config.tomcat_control_user:
+        script = "sudo -nu %s %s" % (quote(config.tomcat_control_user),
+                                     script)
+    command = CONTROL % {
+        "scan": SCAN, "marker": quote(MARKER),
+        "script_marker": quote(SCRIPT_MARKER),
+        "directory": quote("%s/%s" % (config.tomcat_servers_dir.rstrip("/"),
+                                      instance)),
+        "commands": " &&\n".join("%s %s" % (script, subcommand)
+                                 for subcommand in ACTIONS[action])}
+    with mxorc_logger.context(host=result["host"]):
+        try:
+            status, output, _ = ssh.run(command)
+        # pylint: disable=broad-except
+        except Exception as error:
+            LOGGER.error("Failed to %s %s on %s: %s", action, instance,
+                         result["host"], error)
+            result["status"] = "failed"
+            result["output"] = str(error) or error.__class__.__name__
+            return []
+        before, _, output = output.partition(MARKER + "\n")
+        checks, ran, output = output.partition(SCRIPT_MARKER + "\n")
+        result["exit_code"] = status
+        result["output"] = (checks + output).strip()
+        if status:
+            result["status"] = "failed" if ran else \
+                EXIT_STATUSES.get(status, "failed")
+            LOGGER.error("Could not %s %s on %s, %s: %s", action, instance,
+                         result["host"], result["status"], result["output"])
+        else:
+            result["status"] = "acted"
+        return [process["pid"] for process in parse_scan(before)
+                if process["name"] == instance]
+
+
+def await_health(sessions, hosts, action, instance, results, previous,
+                 started, timeout, settle, max_parallel=8):
+    """Check the status of the instance on hosts until every one is healthy
+       or the timeout passes. A stopped instance is healthy once none of its
+       processes is left, a started one once it runs, with a pid it did not
+       have before a restart, for at least settle seconds.
+    Globals:
+        DEPLOY_CONFIG
+    Arguments:
+        sessions - a dictionary of host to SSHConnector
+        hosts - the hosts acted on
+        action - start, stop or restart
+        instance - the instance's name
+        results - the results per host, updated in place to ok or unhealthy
+        previous - a dictionary of host to the pids before the action
+        started - when the action started
+        timeout - seconds to wait for the hosts to become healthy
+        settle - seconds a started instance must have been up
+        max_parallel - the most hosts checked at the same time
+    Returns:
+        none
+    """
+    def healthy(host):
+        """Whether the instance is in the wanted state on one host"""
+        try:
+            status, output, _ = sessions[host].run(SCAN)
+        # pylint: disable=broad-except
+        except Exception as error:
+            LOGGER.warning("Could not check %s on %s: %s", instance, host,
+                           error)
+            return False
+        processes = [process for process in parse_scan(output)
+                     if process["name"] == instance] if not status else None
+        if processes is None:
+            return False
+        if action == "stop":
+            return not processes
+        for process in processes:
+            if action == "restart" and process["pid"] in previous[host]:
+                continue
+            if process["uptime"] >= settle:
+                results[host]["pid"] = process["pid"]
+                return True
+        return False
+
+    deadline = started + timeout
+    interval = mxorc_deploy.settings().rolling_health_interval
+    pending = list(hosts)
+    while pending:
+        checks = mxorc_deploy.fan_out(healthy, pending, max_parallel)
+        now = time.time()
+        for host, ok in zip(pending, checks):
+            if ok:
+                results[host]["status"] = "ok"
+                results[host]["seconds"] = round(now - started, 1)
+        pending = [host for host, ok in zip(pending, checks) if not ok]
+        if pending and now + interval > deadline:
+            break
+        if pending:
+            time.sleep(interval)
+    for host in pending:
+        LOGGER.error("%s did not become healthy on %s within %ds.", instance,
+                     host, timeout)
+        results[host]["status"] = "unhealthy"
+        results[host]["seconds"] = round(time.time() - started, 1)
+
+
+def format_table(results):
+    """Lay the results out as a table, one row per host
+    Globals:
+        COLUMNS
+    Arguments:
+        results - the results returned by roll
+    Returns:
+        The table, as a string
+    """
+    rows = [[(str(result[key]) if result[key] not in (None, "") else "-")
+             .splitlines()[-1] for key, _ in COLUMNS] for result in results]
+    header = [title for _, title in COLUMNS]
+    widths = [max(len(cell) for cell in column)
+              for column in zip(header, *rows)]
+    lines = ["  ".join(cell.ljust(width) for cell, width in
+                       zip(row, widths)).rstrip()
+             for row in [header] + rows]
+    lines.append("%d of %d hosts ok." % (
+        sum(1 for result in results if result["status"] == "ok"),
+        len(results)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""Reports every running Tomcat instance across the fleet, from one /proc
+   scan per host run over the deploy tool's SSH layer."""
+import argparse
+import json
+import re
+import sys
+import time
+import ConfigParser
+import mxorc_deploy
+import mxorc_inventory
+import mxorc_logger
+
+LOGGER = mxorc_logger.get_logger(name="mxorc_tc_status")
+
+# an instance's name, as passed in -Dtomcat.name, such as
+# WorkOrderExport_1.2.3-A
+INSTANCE_PATTERN = re.compile(
+    r"^(?P<service>.+?)(?:_(?P<version>[0-9]+\.[0-9]+\.[0-9]+))?"
+    r"-(?P<instance>[A-Z])$")
+
+# prints the uptime, clock ticks per second and page size of the host, then
+# the pid, tomcat.name, start time in ticks and resident pages of every
+# process started with -Dtomcat.name, reading nothing but /proc. Processes
+# may exit while being read, stderr is redirected before the files are
+# opened so the shell does not report them
+SCAN = r"""
+echo "$(cut -d ' ' -f 1 /proc/uptime) $(getconf CLK_TCK) $(getconf PAGESIZE)"
+for process in /proc/[0-9]*; do
+    command=$(tr '\000' ' ' 2>/dev/null < "$process/cmdline") || continue
+    case "$command" in
+        *tomcat.name=*) ;;
+        *) continue ;;
+    esac
+    name=${command#*tomcat.name=}
+    name=${name%% *}
+    stat=$(cat "$process/stat" 2>/dev/null) || continue
+    set -- ${stat##*) }
+    echo "${process#/proc/} $name ${20} ${22}"
+done
+"""
+
+COLUMNS = (("host", "HOST"), ("service", "SERVICE"), ("version", "VERSION"),
+           ("instance", "INSTANCE"), ("pid", "PID"), ("uptime", "UPTIME"),
+           ("rss", "RSS"))
+
+
+def main():
+    """The main function, parses args then scans every target host at once
+       and prints one report
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        none
+    Returns:
+        0 - if every host could be scanned
+        1 - if any host could not
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("service", nargs="*",
+                        help="Only report instances of these services, "
+                        "eg. SWAMPBoard WorkOrderExport.")
+    parser.add_argument("-t", "--target", action="append", default=[],
+                        help="The host(s) to scan. May be repeated or given "
+                        "as a comma separated list.")
+    parser.add_argument("-i", "--inventory",
+                        help="File listing hosts to scan, one per line.")
+    parser.add_argument("-g", "--group", action="append", default=[],
+                        help="Scan every host of this group in the host "
+                        "inventory, \"all\" for every host. May be repeated.")
+    parser.add_argument("-p", "--parallel", type=int,
+                        help="Maximum number of hosts scanned at once, "
+                        "defaults to max_preflight in the config.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the report as JSON instead of a table.")
+    parser.add_argument("--no-agent", action="store_true",
+                        help="Connect directly even if an agent is running.")
+    args = parser.parse_args()
+    if args.parallel is not None and args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+
+    try:
+        config = mxorc_deploy.settings()
+        user = config.user
+    except (ConfigParser.Error, ValueError) as error:
+        parser.error("%s: %s" % (mxorc_deploy.DEPLOY_CONFIG_PATH, error))
+    mxorc_logger.configure()
+
+    host_inventory = mxorc_inventory.Inventory(
+        config.host_inventory_path, resolve_ttl=config.resolve_ttl,
+        probe_timeout=config.probe_timeout,
+        state_path=config.host_state_path)
+    hosts = mxorc_deploy.parse_targets(
+        args.target + [",".join(host_inventory.hosts(group))
+                       for group in args.group], args.inventory)
+    if not hosts:
+        parser.error("at least one host is required, use -t, -i or -g")
+    connect = mxorc_deploy.connector(user, host_inventory,
+                                     use_agent=not args.no_agent)
+
+    report = collect(hosts, connect, args.service,
+                     args.parallel or config.max_preflight)
+    host_inventory.save()
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_table(report))
+    return int(any(result["status"] == "failed"
+                   for result in report["hosts"].values()))
+
+
+def collect(hosts, connect, services=None, max_parallel=64):
+    """Scan every host at once
+    Globals:
+        none
+    Arguments:
+        hosts - the hosts to scan
+        connect - called with a host, returns its SSHConnector
+        services - only report instances of these services, all if empty
+        max_parallel - the most hosts scanned at the same time
+    Returns:
+        A dictionary of the collection time and, per host, its status, the
+        error if any, and its instances
+    """
+    results = mxorc_deploy.fan_out(
+        lambda host: scan_host(host, connect, services), hosts, max_parallel)
+    return {"collected": time.time(),
+            "hosts": dict((result["host"], result) for result in results)}
+
+
+def scan_host(host, connect, services=None):
+    """Scan one host, errors are recorded instead of raised
+    Globals:
+        LOGGER
+    Arguments:
+        host - the host to scan
+        connect - called with the host, returns its SSHConnector
+        services - only report instances of these services, all if empty
+    Returns:
+        A dictionary with the host, its status (ok or failed), the error and
+        the list of instances
+    """
+    result = {"host": host, "status": "ok", "error": None, "instances": []}
+    with mxorc_logger.context(host=host):
+        try:
+            with connect(host) as ssh:
+                status, output, error = ssh.run(SCAN)
+            if status:
+                raise IOError(error.strip() or "exit status %d" % status)
+            result["instances"] = [
+                instance for instance in parse_scan(output)
+                if not services or instance["service"] in services]
+        # pylint: disable=broad-except
+        except Exception as error:
+            LOGGER.error("Failed to scan %s: %s", host, error)
+            result["status"] = "failed"
+            result["error"] = str(error) or error.__class__.__name__
+    return result
+
+
+def parse_scan(output):
+    """Turn the output of the scan into instances
+    Globals:
+        INSTANCE_PATTERN
+    Arguments:
+        output - what the scan printed
+    Returns:
+        A list of dictionaries holding each instance's name, service,
+        version (None when unversioned), instance letter, pid, uptime in
+        seconds and resident memory in bytes, sorted by name and pid
+    """
+    lines = output.splitlines()
+    if not lines:
+        return []
+    uptime, ticks, page_size = lines[0].split()
+    uptime, ticks, page_size = float(uptime), int(ticks), int(page_size)
+    instances = []
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) != 4:
+            continue
+        pid, name, started, pages = fields
+        match = INSTANCE_PATTERN.match(name)
+        if match is None:
+            continue
+        instances.append({
+            "name": name,
+            "service": match.group("service"),
+            "version": match.group("version"),
+            "instance": match.group("instance"),
+            "pid": int(pid),
+            "uptime": max(0.0, round(uptime - float(started) / ticks, 1)),
+            "rss": int(pages) * page_size})
+    return sorted(instances, key=lambda instance: (instance["name"],
+                                                   instance["pid"]))
+
+
+def format_table(report):
+    """Lay the report out as a table, one row per instance, followed by the
+       hosts that could not be scanned
+    Globals:
+        COLUMNS
+    Arguments:
+        report - the report returned by collect
+    Returns:
+        The table, as a string
+    """
+    rows = []
+    failed = []
+    for host, result in sorted(report["hosts"].items()):
+        if result["status"] == "failed":
+            failed.append("%s: %s" % (host, result["error"]))
+        for instance in result["instances"]:
+            row = dict(instance, host=host)
+            row["version"] = row["version"] or "-"
+            row["uptime"] = format_uptime(row["uptime"])
+            row["rss"] = "%dM" % (row["rss"] // (1024 * 1024))
+            rows.append([str(row[key]) for key, _ in COLUMNS])
+    header = [title for _, title in COLUMNS]
+    widths = [max(len(cell) for cell in column)
+              for column in zip(header, *rows)]
+    lines = ["  ".join(cell.ljust(width) for cell, width in
+                       zip(row, widths)).rstrip()
+             for row in [header] + rows]
+    lines.append("%d instances on %d hosts." % (
+        len(rows), len(report["hosts"]) - len(failed)))
+    if failed:
+        lines.append("Could not scan %d hosts:" % len(failed))
+        lines.extend("    " + line for line in failed)
+    return "\n".join(lines)
+
+
+def format_uptime(seconds):
+    """Write an uptime the way ps does
+    Globals:
+        none
+    Arguments:
+        seconds - the uptime in seconds
+    Returns:
+        [days-]hours:minutes:seconds
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    return "%s%02d:%02d:%02d" % ("%d-" % days if days else "", hours, minutes,
+                                 seconds)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+"""Answers which versions of which Tomcat services are installed where, from
+   an index of every host's servers directory kept on this side."""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import ConfigParser
+from os.path import dirname, isdir
+from pipes import quote
+import mxorc_deploy
+import mxorc_inventory
+import mxorc_logger
+from mxorc_tc_status import INSTANCE_PATTERN
+
+LOGGER = mxorc_logger.get_logger(name="mxorc_tc_versions")
+
+# prints the host's time and the servers directory's mtime, then, unless the
+# mtime is the one already indexed, every directory inside it, without
+# forking per entry
+LIST = r"""
+cd %s 2>/dev/null || { echo missing; exit 0; }
+mtime=$(stat -c %%Y .)
+echo "$(date +%%s) $mtime"
+[ "$mtime" = %s ] && exit 0
+echo listing
+for entry in */; do echo "${entry%%/}"; done
+"""
+
+
+def main():
+    """The main function, parses args then brings the index up to date for
+       the target hosts and prints the matching instances
+    Globals:
+        LOGGER, DEPLOY_CONFIG
+    Arguments:
+        none
+    Returns:
+        0 - if every host's instances are known
+        1 - if any host could not be listed and was never indexed
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("service", nargs="*",
+                        help="Only list instances of these services, "
+                        "eg. SWAMPBoard WorkOrderExport.")
+    parser.add_argument("-t", "--target", action="append", default=[],
+                        help="The host(s) to look on. May be repeated or "
+                        "given as a comma separated list.")
+    parser.add_argument("-i", "--inventory",
+                        help="File listing hosts to look on, one per line.")
+    parser.add_argument("-g", "--group", action="append", default=[],
+                        help="Look on every host of this group in the host "
+                        "inventory, \"all\" for every host. May be repeated.")
+    parser.add_argument("--min", dest="minimum", type=parse_version,
+                        help="Only list versions from this one on, eg. 1.2.0.")
+    parser.add_argument("--max", dest="maximum", type=parse_version,
+                        help="Only list versions up to this one.")
+    parser.add_argument("-s", "--slot", action="append", default=[],
+                        help="Only list instances in this slot, eg. A. May be "
+                        "repeated.")
+    parser.add_argument("-p", "--parallel", type=int,
+                        help="Maximum number of hosts listed at once, "
+                        "defaults to max_preflight in the config.")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Check every host now, even if its index entry "
+                        "is younger than instance_index_ttl.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the instances as JSON instead of a table.")
+    parser.add_argument("--no-agent", action="store_true",
+                        help="Connect directly even if an agent is running.")
+    args = parser.parse_args()
+    if args.parallel is not None and args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+
+    try:
+        config = mxorc_deploy.settings()
+        user = config.user
+    except (ConfigParser.Error, ValueError) as error:
+        parser.error("%s: %s" % (mxorc_deploy.DEPLOY_CONFIG_PATH, error))
+    mxorc_logger.configure()
+
+    host_inventory = mxorc_inventory.Inventory(
+        config.host_inventory_path, resolve_ttl=config.resolve_ttl,
+        probe_timeout=config.probe_timeout,
+        state_path=config.host_state_path)
+    hosts = mxorc_deploy.parse_targets(
+        args.target + [",".join(host_inventory.hosts(group))
+                       for group in args.group], args.inventory)
+    if not hosts:
+        parser.error("at least one host is required, use -t, -i or -g")
+    connect = mxorc_deploy.connector(user, host_inventory,
+                                     use_agent=not args.no_agent)
+
+    index = InstanceIndex(config.instance_index_path, config.instance_index_ttl)
+    failed = index.refresh(hosts, connect, force=args.refresh,
+                           max_parallel=args.parallel or config.max_preflight)
+    index.save()
+    host_inventory.save()
+    instances = index.query(hosts, args.service, args.minimum, args.maximum,
+                            args.slot)
+    if args.json:
+        print(json.dumps(instances, indent=2, sort_keys=True))
+    else:
+        print(format_table(instances))
+    return int(bool(failed))
+
+
+def parse_version(value):
+    """Turn a dotted version into a tuple that compares by number
+    Globals:
+        none
+    Arguments:
+        value - the version, such as 1.10.2
+    Returns:
+        A tuple of ints
+    Raises:
+        ValueError - if a part is not a number
+    """
+    return tuple(int(part) for part in value.split("."))
+
+
+class InstanceIndex(object):
+
+    """ The instances found in every host's servers directory, with the
+        directory's mtime when it was listed and when that was last checked.
+        Hosts checked within ttl seconds are answered from the index alone,
+        older ones cost one command, which only lists the directory again
+        when its mtime moved. The index is one JSON file.
+    """
+
+    # a directory modified within this many seconds of being listed may
+    # still change within the same mtime tick, so it is listed again
+    RACY_SECONDS = 1
+
+    def __init__(self, path, ttl=60):
+        """Instance index initialization, loads the index file when there is
+           one
+        Globals:
+            LOGGER
+        Arguments:
+            self
+            path - the index file
+            ttl - seconds a host's entry is trusted without checking it
+        Returns:
+            none
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.dirty = False
+        try:
+            with open(path) as index_file:
+                self.hosts = json.load(index_file)["hosts"]
+        except (IOError, ValueError, KeyError):
+            LOGGER.debug("No usable instance index at %s.", path)
+
+    def refresh(self, hosts, connect, force=False, max_parallel=64):
+        """Bring the entries of hosts older than the ttl up to date, all at
+           once
+        Globals:
+            none
+        Arguments:
+            self
+            hosts - the hosts to look on
+            connect - called with a host, returns its SSHConnector
+            force - whether to check every host regardless of the ttl
+            max_parallel - the most hosts checked at the same time
+        Returns:
+            The hosts that could not be checked and were never indexed
+        """
+        now = time.time()
+        stale = [host for host in hosts
+                 if force or host not in self.hosts or
+                 now - self.hosts[host]["checked"] >= self.ttl]
+        results = mxorc_deploy.fan_out(
+            lambda host: self.check(host, connect), stale, max_parallel)
+        return [host for host, checked in zip(stale, results)
+                if not checked and host not in self.hosts]
+
+    def check(self, host, connect):
+        """Check one host's servers directory, listing it only if its mtime
+           moved. Errors are logged, a host's last entry is kept.
+        Globals:
+            LOGGER, DEPLOY_CONFIG
+        Arguments:
+            self
+            host - the host to check
+            connect - called with the host, returns its SSHConnector
+        Returns:
+            True - if the host's entry is up to date
+            False - if the host could not be checked
+        """
+        with self.lock:
+            entry = self.hosts.get(host)
+        known = entry["mtime"] if entry and entry["mtime"] is not None else -1
+        with mxorc_logger.context(host=host):
+            try:
+                with connect(host) as ssh:
+                    status, output, error = ssh.run(LIST % (
+                        quote(mxorc_deploy.settings().tomcat_servers_dir),
+                        known))
+                if status:
+                    raise IOError(error.strip() or "exit status %d" % status)
+            # pylint: disable=broad-except
+            except Exception as error:
+                LOGGER.error("Failed to list the instances on %s: %s", host,
+                             error)
+                return False
+        lines = output.splitlines()
+        if not lines or lines[0] == "missing":
+            entry = {"mtime": None, "instances": []}
+        else:
+            host_time, mtime = (int(field) for field in lines[0].split())
+            entry = dict(entry or {})
+            if len(lines) > 1 and lines[1] == "listing":
+                entry = {"mtime": mtime, "instances": parse_listing(lines[2:])}
+                LOGGER.info("Indexed %d instances on %s.",
+                            len(entry["instances"]), host)
+            # a directory this fresh may change again within its mtime tick
+            if host_time - mtime <= self.RACY_SECONDS:
+                entry["mtime"] = None
+        entry["checked"] = time.time()
+        with self.lock:
+            self.hosts[host] = entry
+            self.dirty = True
+        return True
+
+    def query(self, hosts=None, services=None, minimum=None, maximum=None,
+              slots=None):
+        """The indexed instances matching every given condition
+        Globals:
+            none
+        Arguments:
+            self
+            hosts - only instances on these hosts, all indexed hosts if empty
+            services - only instances of these services
+            minimum - only versions from this tuple on
+            maximum - only versions up to this tuple
+            slots - only instances in these slots
+        Returns:
+            A list of dictionaries holding each instance's host, name,
+            service, version and slot, sorted by host and name. Unversioned
+            instances are left out when a version bound is given.
+        """
+        found = []
+        with self.lock:
+            for host in sorted(hosts or self.hosts):
+                for instance in self.hosts.get(host, {}).get("instances", []):
+                    version = parse_version(instance["version"]) \
+                        if instance["version"] else None
+                    if services and instance["service"] not in services:
+                        continue
+                    if slots and instance["slot"] not in slots:
+                        continue
+                    if (minimum or maximum) and version is None:
+                        continue
+                    if minimum and version < minimum:
+                        continue
+                    if maximum and version > maximum:
+                        continue
+                    found.append(dict(instance, host=host))
+        return found
+
+    def save(self):
+        """Write the index file if anything changed. Failures are logged,
+           the index is only an optimization.
+        Globals:
+            LOGGER
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            temporary_path = "%s.%d.tmp" % (self.path, os.getpid())
+            try:
+                if dirname(self.path) and not isdir(dirname(self.path)):
+                    os.makedirs(dirname(self.path))
+                with open(temporary_path, "w") as index_file:
+                    json.dump({"hosts": self.hosts}, index_file)
+                os.rename(temporary_path, self.path)
+                self.dirty = False
+            except (IOError, OSError) as error:
+                LOGGER.warning("Could not save the instance index %s: %s",
+                               self.path, error)
+
+
+def parse_listing(names):
+    """Turn the directory names of a servers directory into instances
+    Globals:
+        INSTANCE_PATTERN
+    Arguments:
+        names - the directory names
+    Returns:
+        A list of dictionaries holding each instance's name, service,
+        version (None when unversioned) and slot, sorted by name
+    """
+    instances = []
+    for name in sorted(names):
+        match = INSTANCE_PATTERN.match(name)
+        if match is not None:
+            instances.append({"name": name,
+                              "service": match.group("service"),
+                              "version": match.group("version"),
+                              "slot": match.group("instance")})
+    return instances
+
+
+def format_table(instances):
+    """Lay instances out as a table, one row each
+    Globals:
+        none
+    Arguments:
+        instances - the instances returned by InstanceIndex.query
+    Returns:
+        The table, as a string
+    """
+    columns = (("host", "HOST"), ("service", "SERVICE"),
+               ("version", "VERSION"), ("slot", "SLOT"), ("name", "NAME"))
+    rows = [[str(instance[key] or "-") for key, _ in columns]
+            for instance in instances]
+    header = [title for _, title in columns]
+    widths = [max(len(cell) for cell in column)
+              for column in zip(header, *rows)]
+    lines = ["  ".join(cell.ljust(width) for cell, width in
+                       zip(row, widths)).rstrip()
+             for row in [header] + rows]
+    lines.append("%d instances." % len(rows))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
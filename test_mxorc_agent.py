@@ -0,0 +1,250 @@
+"""Runs the agent unit tests against local stand-in servers"""
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+import paramiko
+import mxorc_agent
+import mxorc_deploy
+import mxorc_logger
+from mxorc_stub_server import StubServer
+
+mxorc_logger.configure()
+
+KEY = paramiko.RSAKey.generate(1024)
+
+# the options the tests set, removed again afterwards
+OPTIONS = ("user", "timeout", "deploy_attempts", "local_path", "remote_path",
+           "private_key_path", "host_inventory_path", "hash_cache_dir",
+           "agent_socket")
+
+
+class AgentTestCase(unittest.TestCase):
+
+    """ Points the deploy config at temporary trees, a key file and an agent
+        socket, and serves the remote tree.
+    """
+
+    def setUp(self):
+        """ Create the trees, the key file and the server.
+        Globals:
+            DEPLOY_CONFIG
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.directory = tempfile.mkdtemp()
+        self.local_root = os.path.join(self.directory, "local") + "/"
+        self.remote_root = os.path.join(self.directory, "remote") + "/"
+        os.makedirs(os.path.join(self.local_root, "bash"))
+        os.makedirs(self.remote_root)
+        for index in range(3):
+            with open(os.path.join(self.local_root, "bash",
+                                   "script_%d.sh" % index), "w") as script:
+                script.write("echo %d\n" % index)
+        key_path = os.path.join(self.directory, "id_rsa")
+        KEY.write_private_key_file(key_path)
+        self.socket_path = os.path.join(self.directory, "agent.sock")
+
+        config = mxorc_deploy.load_config()
+        if not config.has_section("Deploy Config"):
+            config.add_section("Deploy Config")
+        for option, value in zip(OPTIONS, (
+                "tester", "10", "3", self.local_root, self.remote_root,
+                key_path, os.path.join(self.directory, "hosts.conf"),
+                os.path.join(self.directory, "cache"), self.socket_path)):
+            config.set("Deploy Config", option, value)
+        mxorc_deploy.reset_settings()
+        self.server = StubServer(self.remote_root)
+        self.pool = None
+        self.agent = None
+
+    def tearDown(self):
+        """ Stop the agent and the server, delete the trees and forget the
+            options set.
+        Globals:
+            DEPLOY_CONFIG
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        if self.agent is not None:
+            self.agent.shutdown()
+            self.agent.server_close()
+        if self.pool is not None:
+            self.pool.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+        for option in OPTIONS:
+            mxorc_deploy.DEPLOY_CONFIG.remove_option("Deploy Config", option)
+        mxorc_deploy.reset_settings()
+
+    def start_agent(self, **options):
+        """ Serve a session pool on the agent socket.
+        Globals:
+            none
+        Arguments:
+            self
+            options - passed on to the SessionPool
+        Returns:
+            none
+        """
+        self.pool = mxorc_agent.SessionPool(KEY, **options)
+        self.agent = mxorc_agent.listen(self.socket_path)
+        self.agent.pool = self.pool
+        serving = threading.Thread(target=self.agent.serve_forever)
+        serving.daemon = True
+        serving.start()
+
+    def connector(self):
+        """ Lease a session to the server from the agent.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            An AgentConnector
+        """
+        return mxorc_agent.AgentConnector("tester", "127.0.0.1",
+                                          self.server.port, self.socket_path)
+
+
+class TestListen(AgentTestCase):
+
+    """ Test binding the agent's socket."""
+
+    def test_private(self):
+        """ The socket and a directory created for it are this user's alone,
+            a directory others can reach is refused.
+        """
+        path = os.path.join(self.directory, "agent", "agent.sock")
+        mxorc_agent.listen(path).server_close()
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode),
+                         0o700)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode) & 0o077, 0)
+
+        os.chmod(os.path.dirname(path), 0o755)
+        self.assertRaises(ValueError, mxorc_agent.listen, path)
+
+
+class TestSessionPool(AgentTestCase):
+
+    """ Test keeping sessions."""
+
+    def test_lease(self):
+        """ A released session is leased again without connecting.
+        """
+        self.start_agent()
+        first = self.pool.lease("tester", "127.0.0.1", self.server.port)
+        self.pool.release("tester", "127.0.0.1", self.server.port)
+        second = self.pool.lease("tester", "127.0.0.1", self.server.port)
+        self.pool.release("tester", "127.0.0.1", self.server.port)
+        self.assertIs(first, second)
+        self.assertEqual(self.server.counters["connections"], 1)
+
+    def test_evict(self):
+        """ The least recently used idle session makes room, leased ones are
+            kept.
+        """
+        other = StubServer(self.remote_root)
+        try:
+            self.start_agent(max_sessions=1)
+            first = self.pool.lease("tester", "127.0.0.1", self.server.port)
+            second = self.pool.lease("tester", "127.0.0.1", other.port)
+            self.assertEqual(len(self.pool.sessions), 2)
+            self.pool.release("tester", "127.0.0.1", self.server.port)
+            self.pool.release("tester", "127.0.0.1", other.port)
+            self.assertIs(self.pool.lease("tester", "127.0.0.1", other.port),
+                          second)
+            self.assertEqual(list(self.pool.sessions),
+                             [("tester", "127.0.0.1", other.port)])
+            self.assertFalse(first.transport.is_active())
+        finally:
+            other.stop()
+
+    def test_idle_reap(self):
+        """ Sessions idle for longer than the idle timeout are closed.
+        """
+        self.start_agent(idle_timeout=0.2)
+        ssh = self.pool.lease("tester", "127.0.0.1", self.server.port)
+        self.pool.release("tester", "127.0.0.1", self.server.port)
+        deadline = time.time() + 5
+        while self.pool.sessions and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.pool.sessions, {})
+        self.assertFalse(ssh.transport.is_active())
+
+
+class TestAgentConnector(AgentTestCase):
+
+    """ Test working through the agent."""
+
+    def test_run(self):
+        """ Commands run over one held session, stdin and stderr included.
+        """
+        self.start_agent()
+        with self.connector() as ssh:
+            self.assertEqual(ssh.run("cat; echo oops >&2; exit 3", b"in"),
+                             (3, "in", "oops\n"))
+        with self.connector() as ssh:
+            self.assertEqual(ssh.run("echo again")[1], "again\n")
+            # a longer timeout than the connector's is waited for
+            ssh.timeout = 1
+            self.assertEqual(ssh.run("sleep 1.5; echo late", timeout=5)[1],
+                             "late\n")
+        self.assertEqual(self.server.counters["connections"], 1)
+
+    def test_exec_command(self):
+        """ A command's stdin is streamed and its streams read apart.
+        """
+        self.start_agent()
+        with self.connector() as ssh:
+            stdin, stdout, stderr = ssh.exec_command(
+                "wc -c; echo done >&2; exit 1")
+            for _ in range(4):
+                stdin.write(b"x" * 50000)
+            stdin.close()
+            self.assertEqual(stdout.read().strip(), "200000")
+            self.assertEqual(stderr.read(), "done\n")
+            self.assertEqual(stdout.channel.recv_exit_status(), 1)
+            self.assertTrue(ssh.has_command("tar"))
+
+    def test_deploy(self):
+        """ A deploy through the agent uploads over its SFTP relay.
+        """
+        self.start_agent()
+        with self.connector() as ssh:
+            stats = mxorc_deploy.deploy("bash", ssh)
+        self.assertEqual(stats["deployed"], 3)
+        with open(os.path.join(self.remote_root, "bash",
+                               "script_2.sh")) as deployed:
+            self.assertEqual(deployed.read(), "echo 2\n")
+
+    def test_connector_fallback(self):
+        """ Hosts are connected to directly when no agent answers.
+        """
+        inventory = mxorc_deploy.mxorc_inventory.Inventory(
+            os.path.join(self.directory, "hosts.conf"))
+        inventory.set("127.0.0.1", "port", str(self.server.port))
+        connect = mxorc_deploy.connector("tester", inventory)
+        with connect("127.0.0.1") as ssh:
+            self.assertIsInstance(ssh, mxorc_deploy.SSHConnector)
+
+        self.start_agent()
+        connect = mxorc_deploy.connector("tester", inventory)
+        with connect("127.0.0.1") as ssh:
+            self.assertIsInstance(ssh, mxorc_agent.AgentConnector)
+            self.assertEqual(ssh.run("echo agent")[1], "agent\n")
+        connect = mxorc_deploy.connector("tester", inventory,
+                                         use_agent=False)
+        with connect("127.0.0.1") as ssh:
+            self.assertIsInstance(ssh, mxorc_deploy.SSHConnector)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,6 +15,7 @@ DEPLOY_CONFIG = ConfigParser.ConfigParser()
 DEPLOY_CONFIG.read(os.path.join(THIS_DIRECTORY, "conf/mxorc_deploy.conf"))
 
 LOGGER = mxorc_logger.get_logger(name="mxorc_deploy_test")
+mxorc_logger.configure()
 
 USER = DEPLOY_CONFIG.get("Deploy Config", "user")
 HOST = "xldmxs10"
@@ -74,8 +75,7 @@ class TestConnection(unittest.TestCase):
         except SSHException:
             LOGGER.error("Proper SSH connection failed due to a SSHException.")
             self.fail()
-        ssh.ssh.close()
-        ssh.sftp.close()
+        ssh.close()
         LOGGER.info("Proper connection working.")
 
 
@@ -219,8 +219,7 @@ class TestCommands(unittest.TestCase):
         LOGGER.info("Malconfigured deployment responded as expected.")
 
         # clsoe connections to avoid hang ups
-        ssh.ssh.close()
-        ssh.sftp.close()
+        ssh.close()
 
 
     def remove(self):
@@ -272,11 +271,10 @@ class TestCommands(unittest.TestCase):
             self.fail()
         LOGGER.info("Proper nested folder removal succeeded.")
 
-        # test malconfigured deploy method
+        # a folder that is on neither side is nothing to remove
         LOGGER.info("Testing malconfigured folder removal.")
-        self.assertRaises(OSError, mxorc_deploy.remove, not_a_folder, ssh)
+        self.assertEqual(mxorc_deploy.remove(not_a_folder, ssh), 0)
         LOGGER.info("Malconfigured removal responded as expected.")
 
         # clsoe connections to avoid hang ups
-        ssh.ssh.close()
-        ssh.sftp.close()
+        ssh.close()
@@ -0,0 +1,1007 @@
+"""Runs the deploy unit tests against a local stand-in server"""
+import argparse
+import ConfigParser
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import paramiko
+import mxorc_deploy
+import mxorc_logger
+import mxorc_metrics
+from mxorc_deploy import SSHConnector
+from mxorc_stub_server import StubServer
+
+LOGGER = mxorc_logger.get_logger(name="mxorc_deploy_local_test")
+mxorc_logger.configure()
+
+KEY = paramiko.RSAKey.generate(1024)
+
+
+class StubTestCase(unittest.TestCase):
+
+    """ Points the deploy config at temporary local and remote trees and
+        connects to a stub server serving the remote one.
+    """
+
+    def setUp(self):
+        """ Create the trees, the server and the connection.
+        Globals:
+            LOGGER, DEPLOY_CONFIG
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.directory = tempfile.mkdtemp()
+        self.local_root = os.path.join(self.directory, "local") + "/"
+        self.remote_root = os.path.join(self.directory, "remote") + "/"
+        os.makedirs(os.path.join(self.local_root, "bash"))
+        os.makedirs(self.remote_root)
+        for index in range(5):
+            self.write("bash/script_%d.sh" % index, "echo %d\n" % index)
+
+        config = mxorc_deploy.load_config()
+        if not config.has_section("Deploy Config"):
+            config.add_section("Deploy Config")
+        # put back in tearDown, along with whatever a test set
+        self.saved_options = config.items("Deploy Config", raw=True)
+        for option, value in (("user", "tester"), ("timeout", "10"),
+                              ("deploy_attempts", "3"),
+                              ("retry_backoff", "0.01"),
+                              ("local_path", self.local_root),
+                              ("remote_path", self.remote_root),
+                              ("hash_cache_dir",
+                               os.path.join(self.directory, "cache"))):
+            config.set("Deploy Config", option, value)
+        mxorc_deploy.reset_settings()
+
+        self.server = StubServer(self.remote_root)
+        self.ssh = SSHConnector("tester", "127.0.0.1", KEY,
+                                port=self.server.port)
+        self.server.reset()
+
+    def tearDown(self):
+        """ Close the connection and server, delete the trees and put the
+            deploy config back as it was.
+        Globals:
+            DEPLOY_CONFIG
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.ssh.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+        config = mxorc_deploy.DEPLOY_CONFIG
+        for option in config.options("Deploy Config"):
+            config.remove_option("Deploy Config", option)
+        for option, value in self.saved_options:
+            config.set("Deploy Config", option, value)
+        mxorc_deploy.reset_settings()
+
+    def write(self, path, contents):
+        """ Write a local file, creating its directories.
+        Globals:
+            none
+        Arguments:
+            self
+            path - the path relative to the local root
+            contents - the file's contents
+        Returns:
+            none
+        """
+        full_path = os.path.join(self.local_root, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, "w") as local_file:
+            local_file.write(contents)
+
+    def assertDeployed(self, path):
+        """ Assert a remote file matches its local copy and is executable.
+        Globals:
+            none
+        Arguments:
+            self
+            path - the path relative to both roots
+        Returns:
+            none
+        """
+        remote_file = os.path.join(self.remote_root, path)
+        with open(os.path.join(self.local_root, path)) as local_file:
+            with open(remote_file) as deployed_file:
+                self.assertEqual(local_file.read(), deployed_file.read())
+        self.assertEqual(stat.S_IMODE(os.stat(remote_file).st_mode), 0o755)
+
+
+class TestDeploy(StubTestCase):
+
+    """ Test deploying folders."""
+
+    def test_deploy(self):
+        """ A first deploy uploads, verifies and marks every file executable.
+        """
+        stats = mxorc_deploy.deploy("bash", self.ssh)
+        self.assertEqual(stats["deployed"], 5)
+        self.assertEqual(stats["failed"], 0)
+        for index in range(5):
+            self.assertDeployed("bash/script_%d.sh" % index)
+
+    def test_redeploy_unchanged(self):
+        """ Redeploying an unchanged folder uploads nothing, in one command.
+        """
+        mxorc_deploy.deploy("bash", self.ssh)
+        self.server.reset()
+        stats = mxorc_deploy.deploy("bash", self.ssh)
+        self.assertEqual(stats["deployed"], 0)
+        self.assertEqual(stats["unchanged"], 5)
+        self.assertEqual(self.server.counters["commands"], 1)
+        self.assertEqual(self.server.counters["writes"], 0)
+
+    def test_hash_cache(self):
+        """ A later run reads only the files whose size or mtime changed,
+            and no checksum files are written next to any file.
+        """
+        local_path = os.path.join(self.local_root, "bash")
+        # files modified within the last seconds are always read again
+        for index in range(5):
+            os.utime(os.path.join(local_path, "script_%d.sh" % index),
+                     (time.time() - 60, time.time() - 60))
+        hashed = []
+
+        def hashsum(filename, path, algorithm):
+            """ Note every file read to be hashed."""
+            hashed.append(filename)
+            return original(filename, path, algorithm)
+
+        original = mxorc_deploy.hashsum
+        mxorc_deploy.hashsum = hashsum
+        try:
+            mxorc_deploy.deploy("bash", self.ssh)
+            self.assertEqual(len(hashed), 5)
+            # start over from the cache file, as the next run would
+            mxorc_deploy.HASH_CACHES.clear()
+            del hashed[:]
+            stats = mxorc_deploy.deploy("bash", self.ssh)
+            self.assertEqual((stats["unchanged"], hashed), (5, []))
+
+            self.write("bash/script_2.sh", "echo changed\n")
+            os.utime(os.path.join(local_path, "script_2.sh"),
+                     (time.time() - 30, time.time() - 30))
+            stats = mxorc_deploy.deploy("bash", self.ssh)
+            self.assertEqual((stats["deployed"], hashed), (1, ["script_2.sh"]))
+        finally:
+            mxorc_deploy.hashsum = original
+        for root in (self.local_root, self.remote_root):
+            for _, _, filenames in os.walk(root):
+                self.assertEqual([filename for filename in filenames
+                                  if filename.endswith(".md5")], [])
+
+    def test_deploy_changed_file(self):
+        """ Only the changed file is uploaded again.
+        """
+        mxorc_deploy.deploy("bash", self.ssh)
+        self.write("bash/script_3.sh", "echo changed\n")
+        stats = mxorc_deploy.deploy("bash", self.ssh)
+        self.assertEqual(stats["deployed"], 1)
+        self.assertEqual(stats["unchanged"], 4)
+        self.assertDeployed("bash/script_3.sh")
+
+    def test_commands_do_not_grow_with_files(self):
+        """ Manifest, verification and chmod are batched per folder.
+        """
+        for index in range(5, 60):
+            self.write("bash/script_%d.sh" % index, "echo %d\n" % index)
+        mxorc_deploy.deploy("bash", self.ssh)
+        self.assertEqual(self.server.counters["commands"], 3)
+
+    def test_replace_in_place(self):
+        """ A changed file stays in place until its upload is verified, and
+            replacing it leaves other links to the old file alone.
+        """
+        mxorc_deploy.deploy("bash", self.ssh)
+        remote_file = os.path.join(self.remote_root, "bash/script_0.sh")
+        link = os.path.join(self.directory, "link")
+        os.link(remote_file, link)
+        self.write("bash/script_0.sh", "echo changed\n")
+        self.server.fail_writes = 100
+        stats = mxorc_deploy.deploy("bash", self.ssh)
+        self.assertEqual(stats["failed"], 1)
+        with open(remote_file) as deployed_file:
+            self.assertEqual(deployed_file.read(), "echo 0\n")
+
+        self.server.fail_writes = 0
+        stats = mxorc_deploy.deploy("bash", self.ssh)
+        self.assertEqual(stats["deployed"], 1)
+        self.assertDeployed("bash/script_0.sh")
+        with open(link) as linked_file:
+            self.assertEqual(linked_file.read(), "echo 0\n")
+        self.assertEqual(sorted(os.listdir(os.path.dirname(remote_file))),
+                         ["script_%d.sh" % index for index in range(5)])
+
+    def test_bundle(self):
+        """ A bundle deploy extracts every file with its mode in one command.
+        """
+        stats = mxorc_deploy.deploy("bash", self.ssh, bundle=True)
+        self.assertEqual(stats["deployed"], 5)
+        self.assertEqual(self.server.counters["writes"], 0)
+        for index in range(5):
+            self.assertDeployed("bash/script_%d.sh" % index)
+
+    def test_bundle_without_tar(self):
+        """ A host without tar gets the files uploaded one by one.
+        """
+        self.server.hide_commands = ["tar"]
+        stats = mxorc_deploy.deploy("bash", self.ssh, bundle=True)
+        self.assertEqual(stats["deployed"], 5)
+        self.assertEqual(self.server.counters["writes"], 5)
+        for index in range(5):
+            self.assertDeployed("bash/script_%d.sh" % index)
+
+    def test_recursive(self):
+        """ A recursive deploy syncs nested folders and prunes removed files.
+        """
+        self.write("bash/nested/deeper/inner.sh", "echo inner\n")
+        self.write("bash/nested/gone.sh", "echo gone\n")
+        stats = mxorc_deploy.deploy("bash", self.ssh, recursive=True)
+        self.assertEqual(stats["deployed"], 7)
+        self.assertDeployed("bash/nested/deeper/inner.sh")
+
+        os.remove(os.path.join(self.local_root, "bash/nested/gone.sh"))
+        stats = mxorc_deploy.deploy("bash", self.ssh, recursive=True)
+        self.assertEqual(stats["pruned"], 1)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.remote_root, "bash/nested/gone.sh")))
+
+    def test_retry_failed_write(self):
+        """ A failed write is retried for that file only.
+        """
+        self.server.fail_writes = 1
+        stats = mxorc_deploy.deploy("bash", self.ssh, window=1)
+        self.assertEqual(stats["deployed"], 5)
+        self.assertEqual(stats["retries"], 1)
+
+    def test_reconnect_after_drop(self):
+        """ A dropped connection is reopened and the upload retried.
+        """
+        self.server.drop_writes = 1
+        stats = mxorc_deploy.deploy("bash", self.ssh, window=1)
+        self.assertEqual(stats["deployed"], 5)
+        self.assertGreaterEqual(stats["retries"], 1)
+        self.assertEqual(self.server.counters["connections"], 1)
+
+    def test_missing_folder(self):
+        """ Deploying a folder that does not exist raises an OSError.
+        """
+        self.assertRaises(OSError, mxorc_deploy.deploy, "fake_bash",
+                          self.ssh)
+
+
+class TestPlan(StubTestCase):
+
+    """ Test planning deploys and applying them from the cached manifest."""
+
+    def test_plan(self):
+        """ A plan takes one command and writes nothing, the deploy it is
+            applied with skips the manifest and does what was planned.
+        """
+        mxorc_deploy.deploy("bash", self.ssh, recursive=True)
+        self.write("bash/script_3.sh", "echo changed\n")
+        self.write("bash/nested/script_5.sh", "echo 5\n")
+        os.remove(os.path.join(self.local_root, "bash/script_4.sh"))
+        self.server.reset()
+        planned = mxorc_deploy.plan("bash", self.ssh, recursive=True)
+        self.assertEqual(
+            (planned["add"], planned["change"], planned["remove"],
+             planned["unchanged"]),
+            (["nested/script_5.sh"], ["script_3.sh"], ["script_4.sh"], 3))
+        self.assertEqual(self.server.counters["commands"], 1)
+        self.assertEqual(self.server.counters["writes"], 0)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.remote_root, "bash/script_4.sh")))
+
+        cache_path = os.path.join(self.directory, "manifests.json")
+        remote_path = self.remote_root + "bash"
+        cache = mxorc_deploy.ManifestCache(cache_path)
+        cache.put("stub", remote_path, True, planned)
+        cache.save()
+        cache = mxorc_deploy.ManifestCache(cache_path)
+        self.assertIsNone(cache.take("stub", remote_path, False))
+        cache.put("stub", remote_path, True, planned)
+        manifest = cache.take("stub", remote_path, True)
+        self.assertIsNone(cache.take("stub", remote_path, True))
+
+        self.server.reset()
+        ssh = SSHConnector("tester", "127.0.0.1", KEY, port=self.server.port)
+        try:
+            stats = mxorc_deploy.deploy("bash", ssh, recursive=True,
+                                        manifest=manifest)
+        finally:
+            ssh.close()
+        self.assertEqual((stats["deployed"], stats["pruned"],
+                          stats["unchanged"]), (2, 1, 3))
+        self.assertDeployed("bash/script_3.sh")
+        self.assertDeployed("bash/nested/script_5.sh")
+        # prune, mkdir, checksum and chmod, no manifest
+        self.assertEqual(self.server.counters["commands"], 4)
+
+    def test_expired(self):
+        """ A manifest older than the ttl is not used.
+        """
+        planned = mxorc_deploy.plan("bash", self.ssh)
+        self.assertEqual(len(planned["add"]), 5)
+        cache = mxorc_deploy.ManifestCache(
+            os.path.join(self.directory, "manifests.json"), ttl=0)
+        cache.put("stub", self.remote_root + "bash", False, planned)
+        self.assertIsNone(cache.take("stub", self.remote_root + "bash",
+                                     False))
+
+
+class TestRemove(StubTestCase):
+
+    """ Test removing folders."""
+
+    def test_remove(self):
+        """ Removing a deployed folder deletes it from the host.
+        """
+        mxorc_deploy.deploy("bash", self.ssh)
+        self.server.reset()
+        self.assertEqual(mxorc_deploy.remove("bash", self.ssh), 5)
+        self.assertFalse(os.path.exists(os.path.join(self.remote_root,
+                                                     "bash")))
+        self.assertEqual(self.server.counters["requests"], 1)
+
+    def test_remove_without_local_copy(self):
+        """ A folder retired locally is still removed from the host.
+        """
+        self.write("bash/nested/inner.sh", "echo inner\n")
+        mxorc_deploy.deploy("bash", self.ssh, recursive=True)
+        shutil.rmtree(os.path.join(self.local_root, "bash"))
+        self.assertEqual(mxorc_deploy.remove("bash", self.ssh,
+                                             recursive=True), 6)
+        self.assertEqual(os.listdir(self.remote_root), [])
+        self.assertEqual(mxorc_deploy.remove("bash", self.ssh), 0)
+
+
+class TestStore(StubTestCase):
+
+    """ Test the content addressed blob store."""
+
+    def setUp(self):
+        """ Add a second folder sharing every file of the first.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        StubTestCase.setUp(self)
+        for index in range(5):
+            self.write("copy/script_%d.sh" % index, "echo %d\n" % index)
+        self.write("copy/script_5.sh", "echo 0\n")
+
+    def test_upload_unique_content_once(self):
+        """ Folders sharing content upload each blob once, as hardlinks.
+        """
+        stats = mxorc_deploy.deploy("bash", self.ssh, store=True)
+        self.assertEqual(stats["deployed"], 5)
+        self.assertEqual(self.server.counters["bytes"], 35)
+        stats = mxorc_deploy.deploy("copy", self.ssh, store=True)
+        self.assertEqual(stats["deployed"], 6)
+        self.assertEqual(self.server.counters["bytes"], 35)
+        self.assertDeployed("copy/script_5.sh")
+        for index in range(5):
+            self.assertDeployed("copy/script_%d.sh" % index)
+            self.assertTrue(os.path.samefile(
+                os.path.join(self.remote_root, "bash/script_%d.sh" % index),
+                os.path.join(self.remote_root, "copy/script_%d.sh" % index)))
+
+    def test_changed_file_keeps_blob(self):
+        """ Deploying a changed file replaces the link, not the shared blob.
+        """
+        mxorc_deploy.deploy("bash", self.ssh, store=True)
+        mxorc_deploy.deploy("copy", self.ssh, store=True)
+        self.write("copy/script_1.sh", "echo changed\n")
+        stats = mxorc_deploy.deploy("copy", self.ssh)
+        self.assertEqual(stats["deployed"], 1)
+        self.assertDeployed("copy/script_1.sh")
+        self.assertDeployed("bash/script_1.sh")
+
+    def test_garbage_collection(self):
+        """ Removing a folder leaves blobs others link to, gc deletes the
+            rest.
+        """
+        mxorc_deploy.DEPLOY_CONFIG.set("Deploy Config", "blob_gc_grace", "0")
+        mxorc_deploy.reset_settings()
+        mxorc_deploy.deploy("bash", self.ssh, store=True)
+        self.write("copy/script_6.sh", "echo 6\n")
+        mxorc_deploy.deploy("copy", self.ssh, store=True)
+        mxorc_deploy.remove("copy", self.ssh)
+        self.assertEqual(mxorc_deploy.collect_garbage(self.ssh), 1)
+        mxorc_deploy.remove("bash", self.ssh)
+        self.assertEqual(mxorc_deploy.collect_garbage(self.ssh), 5)
+
+
+class TestStaged(StubTestCase):
+
+    """ Test staged releases."""
+
+    def releases(self):
+        """ The releases of the staged bash folder, oldest first.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            A sorted list of release names
+        """
+        return sorted(name for name in os.listdir(
+            os.path.join(self.remote_root, "bash.releases"))
+                      if not name.startswith(".") and name != "current")
+
+    def test_switch_release(self):
+        """ A staged deploy switches the folder to a new, verified release
+            and leaves the previous one untouched.
+        """
+        mxorc_deploy.deploy("bash", self.ssh, staged=True)
+        self.assertTrue(os.path.islink(os.path.join(self.remote_root,
+                                                    "bash")))
+        self.assertDeployed("bash/script_0.sh")
+        self.write("bash/script_0.sh", "echo changed\n")
+        stats = mxorc_deploy.deploy("bash", self.ssh, staged=True)
+        self.assertEqual(stats["deployed"], 1)
+        self.assertDeployed("bash/script_0.sh")
+        first, second = self.releases()
+        with open(os.path.join(self.remote_root, "bash.releases", first,
+                               "script_0.sh")) as previous_file:
+            self.assertEqual(previous_file.read(), "echo 0\n")
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.remote_root, "bash.releases", first,
+                         "script_1.sh"),
+            os.path.join(self.remote_root, "bash.releases", second,
+                         "script_1.sh")))
+
+    def test_unchanged_keeps_release(self):
+        """ Nothing changed, no release is staged.
+        """
+        mxorc_deploy.deploy("bash", self.ssh, staged=True)
+        stats = mxorc_deploy.deploy("bash", self.ssh, staged=True)
+        self.assertEqual(stats["deployed"], 0)
+        self.assertEqual(len(self.releases()), 1)
+
+    def test_prune_and_rollback(self):
+        """ Old releases beyond releases_kept are deleted, a rollback
+            switches to the previous release.
+        """
+        mxorc_deploy.DEPLOY_CONFIG.set("Deploy Config", "releases_kept", "1")
+        mxorc_deploy.reset_settings()
+        for contents in ("echo a\n", "echo b\n", "echo c\n"):
+            self.write("bash/script_0.sh", contents)
+            mxorc_deploy.deploy("bash", self.ssh, staged=True)
+        self.assertEqual(len(self.releases()), 2)
+        self.assertEqual(mxorc_deploy.rollback("bash", self.ssh),
+                         self.releases()[0])
+        with open(os.path.join(self.remote_root,
+                               "bash/script_0.sh")) as deployed_file:
+            self.assertEqual(deployed_file.read(), "echo b\n")
+        self.assertRaises(IOError, mxorc_deploy.rollback, "bash", self.ssh)
+
+    def test_remove(self):
+        """ Removing a staged folder deletes the link and its releases.
+        """
+        mxorc_deploy.deploy("bash", self.ssh, staged=True)
+        mxorc_deploy.remove("bash", self.ssh, staged=True)
+        self.assertEqual(os.listdir(self.remote_root), [])
+
+
+class TestRelay(StubTestCase):
+
+    """ Test relaying files between hosts."""
+
+    def setUp(self):
+        """ Serve a second host, a leaf with its own tree behind the same
+            remote path, and let the first one reach it with ssh.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        StubTestCase.setUp(self)
+        key_path = os.path.join(self.directory, "id_rsa")
+        KEY.write_private_key_file(key_path)
+        mxorc_deploy.DEPLOY_CONFIG.set(
+            "Deploy Config", "relay_ssh_options",
+            "-i %s -o BatchMode=yes -o StrictHostKeyChecking=no "
+            "-o UserKnownHostsFile=/dev/null -o LogLevel=ERROR "
+            "-o PubkeyAcceptedAlgorithms=+ssh-rsa" % key_path)
+        mxorc_deploy.reset_settings()
+        self.leaf_root = os.path.join(self.directory, "leaf") + "/"
+        os.makedirs(self.leaf_root)
+        self.leaf = StubServer(self.leaf_root, alias=self.remote_root)
+        self.leaf_ssh = SSHConnector("tester", "127.0.0.1", KEY,
+                                     port=self.leaf.port)
+
+    def tearDown(self):
+        """ Close the leaf's connection and server too.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.leaf_ssh.close()
+        self.leaf.stop()
+        StubTestCase.tearDown(self)
+
+    def test_relay(self):
+        """ The leaf receives every file from the relay, none from here, and
+            is verified.
+        """
+        mxorc_deploy.deploy("bash", self.ssh)
+        self.leaf.reset()
+        stats = mxorc_deploy.deploy("bash", self.leaf_ssh, relay=self.ssh)
+        self.assertEqual(stats["deployed"], 5)
+        self.assertEqual(self.leaf.counters["writes"], 0)
+        for index in range(5):
+            leaf_file = os.path.join(self.leaf_root,
+                                     "bash/script_%d.sh" % index)
+            with open(leaf_file) as deployed_file:
+                self.assertEqual(deployed_file.read(), "echo %d\n" % index)
+            self.assertEqual(stat.S_IMODE(os.stat(leaf_file).st_mode), 0o755)
+
+    def test_relay_fallback(self):
+        """ Files the relay can not send are uploaded from here.
+        """
+        stats = mxorc_deploy.deploy("bash", self.leaf_ssh, relay=self.ssh)
+        self.assertEqual(stats["deployed"], 5)
+        self.assertEqual(self.leaf.counters["writes"], 5)
+
+    def test_relay_timeout(self):
+        """ A relay outlasting its timeout is killed before the files are
+            uploaded from here instead.
+        """
+        self.write("bash/large.sh", "#" * 200000 + "\n")
+        mxorc_deploy.deploy("bash", self.ssh)
+        mxorc_deploy.DEPLOY_CONFIG.set("Deploy Config", "relay_timeout", "1")
+        mxorc_deploy.reset_settings()
+        self.leaf.bandwidth = 100000
+        self.leaf.reset()
+        running = []
+
+        def upload_files(*arguments, **options):
+            """ Note whether the relay's shell or its ssh to the leaf still
+                run when the upload starts.
+            """
+            running.extend(
+                subprocess.call(["pgrep", "-f", pattern]) == 0
+                for pattern in ("mxorc_relay[.]%d[.]" % os.getpid(),
+                                "^ssh .* -p %d " % self.leaf.port))
+            return upload(*arguments, **options)
+
+        upload = mxorc_deploy.upload_files
+        mxorc_deploy.upload_files = upload_files
+        try:
+            stats = mxorc_deploy.deploy("bash", self.leaf_ssh,
+                                        relay=self.ssh)
+        finally:
+            mxorc_deploy.upload_files = upload
+        self.assertEqual(stats["deployed"], 6)
+        self.assertGreaterEqual(self.leaf.counters["writes"], 6)
+        self.assertEqual(running, [False, False])
+
+    def test_tree(self):
+        """ Every group gets its own seeds, the rest hang off a tree.
+        """
+        inventory = mxorc_deploy.mxorc_inventory.Inventory(
+            os.path.join(self.directory, "hosts.conf"))
+        hosts = ["a1", "b1", "a2", "a3", "a4", "a5", "b2"]
+        for host in hosts:
+            inventory.set(host, "group", host[0])
+        self.assertEqual(mxorc_deploy.relay_tree(hosts, inventory, 1, 2),
+                         {"a1": None, "a2": "a1", "a3": "a1", "a4": "a2",
+                          "a5": "a2", "b1": None, "b2": "b1"})
+
+
+class TestWatch(StubTestCase):
+
+    """ Test pushing the changes found while watching."""
+
+    def test_push_changes(self):
+        """ Changed and deleted files are pushed without a manifest.
+        """
+        local_path = os.path.join(self.local_root, "bash")
+        mxorc_deploy.deploy("bash", self.ssh)
+        synced = mxorc_deploy.snapshot(local_path)
+        self.write("bash/script_1.sh", "echo changed\n")
+        self.write("bash/script_5.sh", "echo 5\n")
+        os.remove(os.path.join(local_path, "script_4.sh"))
+        changed, deleted = mxorc_deploy.diff_snapshots(
+            synced, mxorc_deploy.snapshot(local_path))
+        self.assertEqual((changed, deleted),
+                         (["script_1.sh", "script_5.sh"], ["script_4.sh"]))
+
+        self.server.reset()
+        stats = mxorc_deploy.push_changes(
+            "bash", self.ssh, changed, deleted,
+            argparse.Namespace(bundle=False, window=None, store=False))
+        self.assertEqual((stats["deployed"], stats["pruned"]), (2, 1))
+        self.assertDeployed("bash/script_1.sh")
+        self.assertDeployed("bash/script_5.sh")
+        self.assertFalse(os.path.exists(
+            os.path.join(self.remote_root, "bash/script_4.sh")))
+        # remove, checksum and chmod
+        self.assertEqual(self.server.counters["commands"], 3)
+
+    def test_diff_snapshots(self):
+        """ New files and files of another size or mtime have changed.
+        """
+        previous = {"a": (1, 10), "b": (1, 10), "c": (1, 10), "d": (1, 10)}
+        current = {"a": (1, 10), "b": (2, 10), "c": (1, 11), "e": (1, 10)}
+        self.assertEqual(mxorc_deploy.diff_snapshots(previous, current),
+                         (["b", "c", "e"], ["d"]))
+
+    def test_missing_folder(self):
+        """ A folder that can not be read fails the watch with an error.
+        """
+        args = argparse.Namespace(folder="fake_bash", recursive=False,
+                                  parallel=1, bundle=False, window=None,
+                                  store=False)
+        connect = lambda host: SSHConnector("tester", "127.0.0.1", KEY,
+                                            port=self.server.port)
+        self.assertEqual(mxorc_deploy.watch(["127.0.0.1"], args, connect), 1)
+
+    def test_wait_for_change(self):
+        """ A change is returned once the folder has been quiet.
+        """
+        local_path = os.path.join(self.local_root, "bash")
+        synced = mxorc_deploy.snapshot(local_path)
+        writer = threading.Timer(0.1, self.write,
+                                 ("bash/script_5.sh", "echo 5\n"))
+        writer.start()
+        start = time.time()
+        current = mxorc_deploy.wait_for_change(local_path, False, synced,
+                                               0.02, 0.1)
+        writer.join()
+        self.assertIn("script_5.sh", current)
+        self.assertLess(time.time() - start, 1.0)
+
+
+class TestChecksum(StubTestCase):
+
+    """ Test the batched checksums."""
+
+    def test_negotiate_algorithm(self):
+        """ The first manifest picks the most preferred algorithm both sides
+            support, and deploys verify with it.
+        """
+        mxorc_deploy.DEPLOY_CONFIG.set("Deploy Config", "hash_algorithms",
+                                       "sha256,md5")
+        mxorc_deploy.reset_settings()
+        stats = mxorc_deploy.deploy("bash", self.ssh)
+        self.assertEqual(self.ssh.algorithm, "sha256")
+        self.assertEqual(stats["deployed"], 5)
+        cache = mxorc_deploy.hash_cache(os.path.join(self.local_root, "bash"))
+        self.assertEqual(cache.digest("script_0.sh", "sha256"),
+                         hashlib.sha256("echo 0\n").hexdigest())
+
+    def test_fallback_to_md5(self):
+        """ A host without the preferred command falls back to md5sum.
+        """
+        mxorc_deploy.DEPLOY_CONFIG.set("Deploy Config", "hash_algorithms",
+                                       "sha256")
+        mxorc_deploy.reset_settings()
+        self.server.hide_commands = ["sha256sum"]
+        stats = mxorc_deploy.deploy("bash", self.ssh)
+        self.assertEqual(self.ssh.algorithm, "md5")
+        self.assertEqual(stats["deployed"], 5)
+
+    def test_hash_large_file(self):
+        """ Files above the mmap threshold hash like any other file.
+        """
+        contents = os.urandom(mxorc_deploy.MMAP_THRESHOLD + 12345)
+        with open(os.path.join(self.local_root, "bash/large.bin"),
+                  "wb") as large_file:
+            large_file.write(contents)
+        self.assertEqual(
+            mxorc_deploy.hashsum("large.bin",
+                                 os.path.join(self.local_root, "bash"),
+                                 "sha256"),
+            hashlib.sha256(contents).hexdigest())
+
+    def test_checksum_mismatch(self):
+        """ A remote file that differs from its local copy is not verified.
+        """
+        mxorc_deploy.deploy("bash", self.ssh)
+        with open(os.path.join(self.remote_root, "bash/script_1.sh"),
+                  "w") as remote_file:
+            remote_file.write("tampered\n")
+        local_path = os.path.join(self.local_root, "bash")
+        local_hashes = dict(
+            (name, mxorc_deploy.md5sum(name, local_path))
+            for name in ("script_0.sh", "script_1.sh"))
+        verified = mxorc_deploy.checksum(
+            local_hashes, os.path.join(self.remote_root, "bash"), self.ssh)
+        self.assertEqual(verified, set(["script_0.sh"]))
+
+
+    def test_manifest_timeout(self):
+        """ The manifest waits for manifest_timeout rather than the
+            per-command timeout, and outlasting it leaves the manifest empty
+            instead of failing.
+        """
+        mxorc_deploy.deploy("bash", self.ssh)
+        remote_path = os.path.join(self.remote_root, "bash")
+        self.server.latency = 1.5
+        self.ssh.timeout = 1
+        mxorc_deploy.DEPLOY_CONFIG.set("Deploy Config", "manifest_timeout",
+                                       "5")
+        mxorc_deploy.reset_settings()
+        self.assertEqual(len(mxorc_deploy.remote_manifest(remote_path,
+                                                          self.ssh)), 5)
+        mxorc_deploy.DEPLOY_CONFIG.set("Deploy Config", "manifest_timeout",
+                                       "1")
+        mxorc_deploy.reset_settings()
+        self.assertEqual(mxorc_deploy.remote_manifest(remote_path, self.ssh),
+                         {})
+
+class TestMetrics(StubTestCase):
+
+    """ Test the per phase timings."""
+
+    def setUp(self):
+        """ Record into a fresh, enabled recorder.
+        Globals:
+            METRICS
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.recorder = mxorc_metrics.Recorder(enabled=True)
+        self.original_recorder = mxorc_deploy.METRICS
+        mxorc_deploy.METRICS = self.recorder
+        StubTestCase.setUp(self)
+
+    def tearDown(self):
+        """ Restore the module's recorder.
+        Globals:
+            METRICS
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        StubTestCase.tearDown(self)
+        mxorc_deploy.METRICS = self.original_recorder
+
+    def test_deploy_phases(self):
+        """ A deploy records every phase with its files, bytes and round trips.
+        """
+        mxorc_deploy.deploy("bash", self.ssh)
+        host = self.recorder.report()["hosts"]["127.0.0.1"]
+        self.assertEqual(set(host["phases"]),
+                         set(["connect", "list", "hash", "manifest", "mkdir",
+                              "upload", "checksum", "chmod"]))
+        self.assertEqual(host["phases"]["upload"]["items"], 5)
+        self.assertEqual(host["phases"]["upload"]["bytes"], 35)
+        self.assertEqual(host["counters"]["round_trips"], 13)
+        local = self.recorder.report()["hosts"][mxorc_metrics.LOCAL]
+        self.assertEqual(local["phases"]["hashsum"]["items"], 5)
+
+    def test_export(self):
+        """ The report is written as JSON and as a Prometheus textfile.
+        """
+        mxorc_deploy.deploy("bash", self.ssh)
+        self.recorder.result("127.0.0.1", "ok", 1.5)
+        report_path = os.path.join(self.directory, "report.json")
+        textfile_path = os.path.join(self.directory, "deploy.prom")
+        self.recorder.write_report(report_path)
+        self.recorder.write_textfile(textfile_path)
+        with open(report_path) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(report["hosts"]["127.0.0.1"]["status"], "ok")
+        with open(textfile_path) as textfile:
+            lines = textfile.read().splitlines()
+        self.assertIn('mxorc_deploy_host_seconds{host="127.0.0.1"} 1.5', lines)
+        self.assertIn('mxorc_deploy_phase_items{host="127.0.0.1",'
+                      'phase="upload"} 5.0', lines)
+
+    def test_disabled(self):
+        """ A disabled recorder hands out one shared span and records nothing.
+        """
+        recorder = mxorc_metrics.Recorder()
+        self.assertIs(recorder.span("host", "upload"), mxorc_metrics.NULL_SPAN)
+        recorder.count("host", "round_trips")
+        self.assertEqual(recorder.report()["hosts"], {})
+
+
+class TestTargets(unittest.TestCase):
+
+    """ Test building the list of hosts and fanning out over it."""
+
+    def test_parse_targets(self):
+        """ Repeated and comma separated targets are joined with the
+            inventory's hosts, in order and without duplicates.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            inventory = os.path.join(directory, "hosts")
+            with open(inventory, "w") as inventory_file:
+                inventory_file.write("# the failover pair\nxldmxs11\n\n"
+                                     "  xldmxs12  # moved\nxldmxs10\n")
+            self.assertEqual(
+                mxorc_deploy.parse_targets(
+                    ["xldmxs10", "xldmxs11, xldmxs10,", "xldmxs13"],
+                    inventory),
+                ["xldmxs10", "xldmxs11", "xldmxs13", "xldmxs12"])
+            self.assertRaises(IOError, mxorc_deploy.parse_targets, [],
+                              os.path.join(directory, "missing"))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(mxorc_deploy.parse_targets([",", " "]), [])
+
+    def test_fan_out(self):
+        """ No more than max_parallel hosts are worked on at once and the
+            results keep the order of the hosts.
+        """
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def work(host):
+            """ Count the hosts being worked on, finishing later hosts
+                first.
+            """
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01 * (10 - host))
+            with lock:
+                running[0] -= 1
+            return host * 2
+
+        self.assertEqual(mxorc_deploy.fan_out(work, range(10), 3),
+                         [host * 2 for host in range(10)])
+        self.assertEqual(running, [0, 3])
+        self.assertEqual(mxorc_deploy.fan_out(work, [], 3), [])
+
+
+class TestMain(StubTestCase):
+
+    """ Test running from the command line."""
+
+    def setUp(self):
+        """ Point the config at a key, an inventory giving 127.0.0.1 the
+            server's port and localhost a closed one, and no agent.
+        Globals:
+            DEPLOY_CONFIG
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        super(TestMain, self).setUp()
+        key_path = os.path.join(self.directory, "id_rsa")
+        KEY.write_private_key_file(key_path)
+        inventory = os.path.join(self.directory, "hosts.conf")
+        with open(inventory, "w") as inventory_file:
+            inventory_file.write("[127.0.0.1]\nport = %d\n\n[localhost]\n"
+                                 "port = 1\n" % self.server.port)
+        config = mxorc_deploy.DEPLOY_CONFIG
+        for option, value in (
+                ("private_key_path", key_path),
+                ("host_inventory_path", inventory),
+                ("manifest_cache_path",
+                 os.path.join(self.directory, "manifests.json")),
+                ("agent_socket", os.path.join(self.directory, "agent.sock")),
+                ("log_queue", "off")):
+            config.set("Deploy Config", option, value)
+        mxorc_deploy.reset_settings()
+        self.argv = sys.argv
+
+    def tearDown(self):
+        """ Put the command line back.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        sys.argv = self.argv
+        super(TestMain, self).tearDown()
+
+    def main(self, *arguments):
+        """ Run main with the arguments as the command line.
+        Globals:
+            none
+        Arguments:
+            self
+            arguments - the command line arguments
+        Returns:
+            What main returns
+        """
+        sys.argv = ["mxorc_deploy.py"] + list(arguments)
+        return mxorc_deploy.main()
+
+    def test_exit_status(self):
+        """ The run fails when one host does, after the others are done.
+        """
+        self.assertEqual(self.main("-d", "-f", "bash", "-t", "127.0.0.1"), 0)
+        self.write("bash/script_0.sh", "echo changed\n")
+        self.assertEqual(self.main("-d", "-f", "bash", "-t",
+                                   "127.0.0.1,localhost"), 1)
+        self.assertDeployed("bash/script_0.sh")
+
+    def test_no_hosts(self):
+        """ A run without any host is an argument error.
+        """
+        with self.assertRaises(SystemExit) as raised:
+            self.main("-d", "-f", "bash", "-t", ",")
+        self.assertEqual(raised.exception.code, 2)
+
+
+class TestSettings(unittest.TestCase):
+
+    """ Test parsing the Deploy Config section."""
+
+    def settings(self, **options):
+        """ Parse a section holding the required options and some others.
+        Globals:
+            none
+        Arguments:
+            self
+            options - option names and values to add
+        Returns:
+            The Settings
+        """
+        config = ConfigParser.ConfigParser()
+        config.add_section("Deploy Config")
+        values = {"user": "tester", "private_key_path": "~/key",
+                  "timeout": "10", "deploy_attempts": "3",
+                  "local_path": "/local/", "remote_path": "/remote/"}
+        values.update(options)
+        for option, value in values.items():
+            config.set("Deploy Config", option, value)
+        return mxorc_deploy.Settings(config)
+
+    def test_types_and_defaults(self):
+        """ Options are converted once and missing ones take their default.
+        """
+        settings = self.settings(upload_window="2", log_queue="off")
+        self.assertEqual(settings.timeout, 10)
+        self.assertEqual(settings.upload_window, 2)
+        self.assertEqual(settings.max_parallel, 8)
+        self.assertFalse(settings.log_queue)
+        self.assertEqual(settings.private_key_path,
+                         os.path.expanduser("~/key"))
+
+    def test_invalid_value(self):
+        """ A value of the wrong type or range names its option.
+        """
+        self.assertRaisesRegexp(ValueError, "^timeout", self.settings,
+                                timeout="ten")
+        self.assertRaisesRegexp(ValueError, "^max_parallel", self.settings,
+                                max_parallel="0")
+        self.assertRaisesRegexp(ValueError, "^log_format", self.settings,
+                                log_format="xml")
+
+    def test_missing_required(self):
+        """ Reading a required option that is not set raises NoOptionError.
+        """
+        config = ConfigParser.ConfigParser()
+        config.add_section("Deploy Config")
+        settings = mxorc_deploy.Settings(config)
+        self.assertRaises(ConfigParser.NoOptionError, getattr, settings,
+                          "user")
@@ -0,0 +1,156 @@
+"""Runs the host inventory unit tests"""
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+import paramiko
+import mxorc_inventory
+import mxorc_logger
+
+mxorc_logger.configure()
+
+KEY = paramiko.RSAKey.generate(1024)
+OTHER_KEY = paramiko.RSAKey.generate(1024)
+
+INVENTORY = """# hosts of the failover pair, keep in rolling order
+[xldmxs10]
+group = failover
+# moved off the default port
+port = 2022
+
+[xldmxs11]
+group = failover
+"""
+
+
+class TestInventory(unittest.TestCase):
+
+    """ Test recording what is learned about hosts."""
+
+    def setUp(self):
+        """ Write an inventory holding comments and stand in for the
+            resolver.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "mxorc_inventory.conf")
+        with open(self.path, "w") as inventory_file:
+            inventory_file.write(INVENTORY)
+        self.resolved = []
+        self.addresses = {"xldmxs10": "10.0.0.10", "xldmxs11": "10.0.0.11"}
+        self.getaddrinfo = mxorc_inventory.socket.getaddrinfo
+        mxorc_inventory.socket.getaddrinfo = self.resolve
+
+    def tearDown(self):
+        """ Put the resolver back and delete the files.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        mxorc_inventory.socket.getaddrinfo = self.getaddrinfo
+        shutil.rmtree(self.directory)
+
+    def resolve(self, host, port, *_):
+        """ Resolve a host from self.addresses, counting every lookup.
+        Globals:
+            none
+        Arguments:
+            self
+            host - the host's name
+            port - the port, if any
+        Returns:
+            What socket.getaddrinfo returns
+        """
+        self.resolved.append(host)
+        if host not in self.addresses:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not "
+                                  "known")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "",
+                 (self.addresses[host], port or 0))]
+
+    def test_save_keeps_inventory(self):
+        """ Learned addresses and keys go to the state file, the inventory
+            is left as the operators wrote it.
+        """
+        inventory = mxorc_inventory.Inventory(self.path)
+        inventory.resolve("xldmxs10")
+        inventory.verify_key("xldmxs10", KEY)
+        inventory.save()
+        with open(self.path) as inventory_file:
+            self.assertEqual(inventory_file.read(), INVENTORY)
+
+        inventory = mxorc_inventory.Inventory(self.path)
+        self.assertEqual(inventory.address("xldmxs10"), "10.0.0.10")
+        self.assertEqual(inventory.port("xldmxs10"), 2022)
+        self.assertEqual(inventory.hosts("failover"), ["xldmxs10", "xldmxs11"])
+        self.assertRaises(paramiko.BadHostKeyException, inventory.verify_key,
+                          "xldmxs10", OTHER_KEY)
+
+    def test_verify_key(self):
+        """ The first key seen is pinned, a changed one is refused.
+        """
+        inventory = mxorc_inventory.Inventory(self.path)
+        inventory.verify_key("xldmxs11", KEY)
+        inventory.verify_key("xldmxs11", KEY)
+        self.assertEqual(inventory.get("xldmxs11", "host_key"),
+                         "ssh-rsa %s" % KEY.get_base64())
+        self.assertRaises(paramiko.BadHostKeyException, inventory.verify_key,
+                          "xldmxs11", OTHER_KEY)
+        self.assertEqual(inventory.get("xldmxs11", "host_key"),
+                         "ssh-rsa %s" % KEY.get_base64())
+
+    def test_resolve_ttl(self):
+        """ A fresh address is used as is, a stale one resolved again.
+        """
+        inventory = mxorc_inventory.Inventory(self.path, resolve_ttl=60)
+        self.assertEqual(inventory.resolve("xldmxs10"), "10.0.0.10")
+        self.addresses["xldmxs10"] = "10.0.1.10"
+        self.assertEqual(inventory.resolve("xldmxs10"), "10.0.0.10")
+        self.assertEqual(self.resolved, ["xldmxs10"])
+
+        inventory.set("xldmxs10", "resolved", int(time.time()) - 61)
+        self.assertEqual(inventory.resolve("xldmxs10"), "10.0.1.10")
+        self.assertEqual(self.resolved, ["xldmxs10", "xldmxs10"])
+
+    def test_resolve_failure(self):
+        """ A host that no longer resolves keeps its last address, one never
+            resolved fails.
+        """
+        inventory = mxorc_inventory.Inventory(self.path, resolve_ttl=0)
+        inventory.resolve("xldmxs10")
+        del self.addresses["xldmxs10"]
+        self.assertEqual(inventory.resolve("xldmxs10"), "10.0.0.10")
+        self.assertRaises(socket.gaierror, inventory.resolve, "xldmxs12")
+
+    def test_preflight(self):
+        """ Hosts not accepting connections are reported with their error.
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        try:
+            # connecting resolves the address through the stand-in too
+            self.addresses = {"up": "127.0.0.1", "down": "127.0.0.1",
+                              "127.0.0.1": "127.0.0.1"}
+            inventory = mxorc_inventory.Inventory(self.path, probe_timeout=1)
+            inventory.set("up", "port", listener.getsockname()[1])
+            inventory.set("down", "port", 1)
+            failed = inventory.preflight(["up", "down", "gone"])
+        finally:
+            listener.close()
+        self.assertEqual(sorted(failed), ["down", "gone"])
+        self.assertIsInstance(failed["down"], socket.error)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+"""Runs the queued logging unit tests"""
+import json
+import logging
+import threading
+import time
+import unittest
+from StringIO import StringIO
+import mxorc_logger
+
+
+class BlockingHandler(logging.Handler):
+
+    """ Collects messages, waiting for a release before writing any."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.gate = threading.Event()
+        self.messages = []
+
+    def emit(self, record):
+        self.gate.wait()
+        self.messages.append(self.format(record))
+
+
+class TestQueue(unittest.TestCase):
+
+    """ Test the queue backed mode."""
+
+    def setUp(self):
+        """ Give a fresh logger a handler writing to a string.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.output = StringIO()
+        self.logger = mxorc_logger.get_logger(name="mxorc_logger_test")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = logging.StreamHandler(self.output)
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+        self.logger.handlers = [self.handler]
+
+    def tearDown(self):
+        """ Stop the listener and drop the handler.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        mxorc_logger.stop_queue()
+        self.logger.handlers = []
+
+    def test_flush_on_stop(self):
+        """ Every queued record is written, in order, when the queue stops.
+        """
+        mxorc_logger.start_queue()
+        self.assertIsInstance(self.logger.handlers[0],
+                              mxorc_logger.QueueHandler)
+        for index in range(100):
+            self.logger.info("line %d", index)
+        mxorc_logger.stop_queue()
+        self.assertEqual(self.output.getvalue().splitlines(),
+                         ["line %d" % index for index in range(100)])
+        self.assertEqual(self.logger.handlers, [self.handler])
+
+    def test_host_context(self):
+        """ Records logged inside a host context name the host.
+        """
+        mxorc_logger.start_queue()
+        with mxorc_logger.context(host="xldmxs10"):
+            self.logger.info("deployed")
+        self.logger.info("done")
+        mxorc_logger.stop_queue()
+        self.assertEqual(self.output.getvalue().splitlines(),
+                         ["xldmxs10: deployed", "done"])
+
+    def test_propagation(self):
+        """ A record reaching the handlers of a parent logger too names the
+            host once on each.
+        """
+        child = mxorc_logger.get_logger(name="mxorc_logger_test.child")
+        child_output = StringIO()
+        child_handler = logging.StreamHandler(child_output)
+        child.handlers = [child_handler]
+        try:
+            mxorc_logger.start_queue()
+            with mxorc_logger.context(host="h1"):
+                child.info("msg")
+            mxorc_logger.stop_queue()
+        finally:
+            child.handlers = []
+        self.assertEqual(child_output.getvalue(), "h1: msg\n")
+        self.assertEqual(self.output.getvalue(), "h1: msg\n")
+
+    def test_json_output(self):
+        """ JSON output carries the message, level and context fields.
+        """
+        mxorc_logger.start_queue(json_output=True)
+        with mxorc_logger.context(host="xldmxs10"):
+            self.logger.warning("%d retries", 2)
+        mxorc_logger.stop_queue()
+        record = json.loads(self.output.getvalue())
+        self.assertEqual(record["message"], "2 retries")
+        self.assertEqual(record["level"], "WARNING")
+        self.assertEqual(record["host"], "xldmxs10")
+        self.assertIs(self.handler.formatter.__class__, logging.Formatter)
+
+    def test_drop_new(self):
+        """ A full queue drops new records and reports how many.
+        """
+        handler = BlockingHandler()
+        self.logger.handlers = [handler]
+        listener = mxorc_logger.start_queue(max_size=1, overflow="drop_new")
+        for index in range(10):
+            self.logger.info("line %d", index)
+        handler.gate.set()
+        mxorc_logger.stop_queue()
+        self.assertGreater(listener.dropped, 0)
+        self.assertIn("Dropped %d log records, the log queue was full." % (
+            listener.dropped), handler.messages)
+        self.assertEqual(len(handler.messages), 10 - listener.dropped + 1)
+
+    def test_drop_old_keeps_stop(self):
+        """ Records logged while stopping never push out the stop sentinel.
+        """
+        handler = BlockingHandler()
+        self.logger.handlers = [handler]
+        listener = mxorc_logger.start_queue(max_size=1, overflow="drop_old")
+        self.logger.info("first")
+        while not listener.queue.empty():
+            time.sleep(0.01)
+        stopper = threading.Thread(target=mxorc_logger.stop_queue)
+        stopper.start()
+        while not listener.queue.full():
+            time.sleep(0.01)
+        self.logger.info("late")
+        handler.gate.set()
+        stopper.join(5)
+        self.assertFalse(stopper.is_alive())
+        self.assertEqual(handler.messages,
+                         ["first", "Dropped 1 log records, the log queue was "
+                          "full."])
+
+    def test_bad_overflow(self):
+        """ An unknown overflow policy is refused.
+        """
+        self.assertRaises(ValueError, mxorc_logger.start_queue,
+                          overflow="spill")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+"""Runs the rolling Tomcat control unit tests against local stand-in
+   servers"""
+import os
+import subprocess
+import unittest
+import paramiko
+import mxorc_logger
+import mxorc_tc_control
+from mxorc_deploy import SSHConnector
+from mxorc_stub_server import StubHostTestCase
+
+mxorc_logger.configure()
+
+KEY = paramiko.RSAKey.generate(1024)
+
+INSTANCE = "WorkOrderExport_1.2.3-A"
+
+# servers directory the hosts pretend to have
+SERVERS = "/srv/mxorc_tc_control/servers"
+
+# stands in for swa-control.sh, running a process named like an instance
+CONTROL_SCRIPT = r"""#!/bin/sh
+directory=$(cd "$(dirname "$0")/.." && pwd)
+case "$1" in
+    start)
+        /bin/sh -c "sleep 60; :" "-Dtomcat.name=$(basename "$directory")" \
+            </dev/null >/dev/null 2>&1 &
+        echo $! > "$directory/pid" ;;
+    stop)
+        [ -f "$directory/pid" ] && kill "$(cat "$directory/pid")"
+        rm -f "$directory/pid" ;;
+esac
+"""
+
+
+class TestControl(StubHostTestCase):
+
+    """ Test reading the control command's results."""
+
+    def test_output(self):
+        """ Only what follows the marker is the output, stderr is not.
+        """
+        class Session(object):
+            """ Answers every command with canned results."""
+            host = "127.0.0.1"
+
+            @staticmethod
+            def run(command):
+                """ The results of a scan and a missing instance."""
+                return (2, "1000.50 100 4096\n%s\nInstance Directory could "
+                        "not be found.\n" % mxorc_tc_control.MARKER,
+                        "cannot open /proc/42/cmdline\n")
+
+        result = {"host": "a"}
+        self.assertEqual(mxorc_tc_control.control(Session(), "start",
+                                                  INSTANCE, result), [])
+        self.assertEqual((result["status"], result["exit_code"],
+                          result["output"]),
+                         ("no_instance", 2,
+                          "Instance Directory could not be found."))
+
+
+    def test_script_failure(self):
+        """ A failed stop ends a restart, and the control script's exit
+            status is its own, not one of the checks'.
+        """
+        servers = os.path.join(self.directory, "servers")
+        bin_dir = os.path.join(servers, INSTANCE, "bin")
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, "swa-control.sh"), "w") as script:
+            script.write("#!/bin/sh\n"
+                         "case \"$1\" in\n"
+                         "    stop) echo \"Could not stop.\"; exit 2 ;;\n"
+                         "    start) touch \"$(dirname \"$0\")/started\" ;;\n"
+                         "esac\n")
+        os.chmod(os.path.join(bin_dir, "swa-control.sh"), 0o755)
+        self.configure(tomcat_servers_dir=servers, tomcat_control_user="")
+
+        class Session(object):
+            """ Runs every command in a local shell."""
+            host = "127.0.0.1"
+
+            @staticmethod
+            def run(command):
+                """ The results of the command."""
+                shell = subprocess.Popen(["/bin/sh", "-c", command],
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+                output, error = shell.communicate()
+                return shell.returncode, output, error
+
+        result = {"host": "a"}
+        mxorc_tc_control.control(Session(), "restart", INSTANCE, result)
+        self.assertEqual((result["status"], result["exit_code"],
+                          result["output"]), ("failed", 2, "Could not stop."))
+        self.assertFalse(os.path.exists(os.path.join(bin_dir, "started")))
+
+class TestRoll(StubHostTestCase):
+
+    """ Test rolling actions over hosts."""
+
+    def setUp(self):
+        """ Give one host an instance, another none, and serve both.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        StubHostTestCase.setUp(self)
+        self.instance_dir = os.path.join(self.directory, "a", INSTANCE)
+        os.makedirs(os.path.join(self.instance_dir, "bin"))
+        os.makedirs(os.path.join(self.directory, "b"))
+        self.control = os.path.join(self.instance_dir, "bin", "swa-control.sh")
+        with open(self.control, "w") as script:
+            script.write(CONTROL_SCRIPT)
+        os.chmod(self.control, 0o755)
+        self.configure(tomcat_servers_dir=SERVERS, tomcat_control_user="",
+                       rolling_health_interval="0.1")
+        self.servers = dict(
+            (name, self.serve(os.path.join(self.directory, name), SERVERS))
+            for name in ("a", "b"))
+        self.connect = lambda host: SSHConnector(
+            "tester", "127.0.0.1", KEY,
+            port=self.servers["a" if host == "a" else "b"].port)
+
+    def tearDown(self):
+        """ Stop the instance, then what every stub test stops.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        subprocess.call([self.control, "stop"])
+        StubHostTestCase.tearDown(self)
+
+    def pid(self):
+        """ The pid of the running instance.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            The pid, as an int
+        """
+        with open(os.path.join(self.instance_dir, "pid")) as pid_file:
+            return int(pid_file.read())
+
+    def test_restart(self):
+        """ A restart is healthy once a new process runs, over one session.
+        """
+        subprocess.check_call([self.control, "start"])
+        before = self.pid()
+        results = mxorc_tc_control.roll(["a"], self.connect, "restart",
+                                        INSTANCE, health_timeout=10)
+        self.assertEqual(results[0]["status"], "ok")
+        self.assertEqual(results[0]["exit_code"], 0)
+        self.assertEqual(results[0]["pid"], self.pid())
+        self.assertNotEqual(results[0]["pid"], before)
+        self.assertEqual(self.servers["a"].counters["connections"], 1)
+
+        results = mxorc_tc_control.roll(["a"], self.connect, "stop",
+                                        INSTANCE, health_timeout=10)
+        self.assertEqual(results[0]["status"], "ok")
+        self.assertFalse(os.path.exists(os.path.join(self.instance_dir,
+                                                     "pid")))
+
+    def test_waves(self):
+        """ A missing instance fails its wave and later waves are skipped,
+            an unreachable host is reported.
+        """
+        results = mxorc_tc_control.roll(["a", "b", "c"], self.connect,
+                                        "start", INSTANCE, health_timeout=10)
+        self.assertEqual([result["status"] for result in results],
+                         ["ok", "no_instance", "skipped"])
+        self.assertEqual([result["exit_code"] for result in results],
+                         [0, 2, None])
+
+        connect = lambda host: SSHConnector("tester", "127.0.0.1", KEY,
+                                            port=1)
+        results = mxorc_tc_control.roll(["a"], connect, "stop", INSTANCE,
+                                        max_failures=1)
+        self.assertEqual(results[0]["status"], "unreachable")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+"""Runs the Tomcat status collector unit tests against a local stand-in
+   server"""
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import paramiko
+import mxorc_logger
+import mxorc_tc_status
+from mxorc_deploy import SSHConnector
+from mxorc_stub_server import StubHostTestCase
+
+mxorc_logger.configure()
+
+KEY = paramiko.RSAKey.generate(1024)
+
+
+class TestParse(unittest.TestCase):
+
+    """ Test reading the scan's output."""
+
+    def test_parse_scan(self):
+        """ Instances are named, versioned and measured, others skipped.
+        """
+        output = ("1000.50 100 4096\n"
+                  "42 WorkOrderExport_1.2.3-A 50000 2560\n"
+                  "7 SWAMPBoard-B 99950 256\n"
+                  "9 not_an_instance 100 1\n")
+        self.assertEqual(mxorc_tc_status.parse_scan(output), [
+            {"name": "SWAMPBoard-B", "service": "SWAMPBoard",
+             "version": None, "instance": "B", "pid": 7, "uptime": 1.0,
+             "rss": 1048576},
+            {"name": "WorkOrderExport_1.2.3-A", "service": "WorkOrderExport",
+             "version": "1.2.3", "instance": "A", "pid": 42, "uptime": 500.5,
+             "rss": 10485760}])
+
+    def test_vanished_process(self):
+        """ A process gone between listing /proc and reading it is skipped
+            without a word on stderr.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(directory, "4242"))
+            scan = subprocess.Popen(
+                ["/bin/sh", "-c", mxorc_tc_status.SCAN.replace(
+                    "/proc/[0-9]*", directory + "/[0-9]*")],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, error = scan.communicate()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(error, "")
+        self.assertEqual(len(output.splitlines()), 1)
+        self.assertEqual(mxorc_tc_status.parse_scan(output), [])
+
+    def test_format_table(self):
+        """ The table has a row per instance and lists failed hosts.
+        """
+        report = {"hosts": {
+            "xldmxs10": {"status": "ok", "error": None, "instances": [
+                {"name": "SWAMPBoard-B", "service": "SWAMPBoard",
+                 "version": None, "instance": "B", "pid": 7,
+                 "uptime": 90061.0, "rss": 1048576}]},
+            "xldmxs11": {"status": "failed", "error": "timed out",
+                         "instances": []}}}
+        lines = mxorc_tc_status.format_table(report).splitlines()
+        self.assertEqual(lines[1].split(), ["xldmxs10", "SWAMPBoard", "-",
+                                            "B", "7", "1-01:01:01", "1M"])
+        self.assertEqual(lines[2:], ["1 instances on 1 hosts.",
+                                     "Could not scan 1 hosts:",
+                                     "    xldmxs11: timed out"])
+
+
+class TestCollect(StubHostTestCase):
+
+    """ Test scanning hosts."""
+
+    def setUp(self):
+        """ Start a process posing as an instance and a server to scan.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        StubHostTestCase.setUp(self)
+        self.process = subprocess.Popen(
+            ["/bin/sh", "-c", "sleep 60",
+             "-Dtomcat.name=WorkOrderExport_1.2.3-A"])
+        self.server = self.serve(self.directory)
+
+    def tearDown(self):
+        """ Stop the process, then what every stub test stops.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        self.process.kill()
+        self.process.wait()
+        StubHostTestCase.tearDown(self)
+
+    def test_collect(self):
+        """ One command per host finds the instance, an unreachable host is
+            reported as failed.
+        """
+        connect = lambda host: SSHConnector(
+            "tester", "127.0.0.1", KEY,
+            port=self.server.port if host == "up" else 1)
+        report = mxorc_tc_status.collect(["up", "down"], connect,
+                                         ["WorkOrderExport"])
+        self.assertEqual(self.server.counters["commands"], 1)
+        self.assertEqual(report["hosts"]["down"]["status"], "failed")
+        instances = report["hosts"]["up"]["instances"]
+        self.assertIn(self.process.pid,
+                      [instance["pid"] for instance in instances])
+        self.assertEqual(instances[0]["version"], "1.2.3")
+        self.assertGreater(instances[0]["rss"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""Runs the instance index unit tests against a local stand-in server"""
+import os
+import time
+import unittest
+import paramiko
+import mxorc_logger
+from mxorc_deploy import SSHConnector
+from mxorc_stub_server import StubHostTestCase
+from mxorc_tc_versions import InstanceIndex, parse_version
+
+mxorc_logger.configure()
+
+KEY = paramiko.RSAKey.generate(1024)
+
+
+class TestIndex(StubHostTestCase):
+
+    """ Test indexing servers directories."""
+
+    def setUp(self):
+        """ Fill a servers directory and serve it.
+        Globals:
+            none
+        Arguments:
+            self
+        Returns:
+            none
+        """
+        StubHostTestCase.setUp(self)
+        self.servers = os.path.join(self.directory, "servers")
+        for name in ("WorkOrderExport_1.2.3-A", "WorkOrderExport_1.10.0-B",
+                     "SWAMPBoard-A", "logs"):
+            os.makedirs(os.path.join(self.servers, name))
+        self.age(time.time() - 60)
+        self.configure(tomcat_servers_dir=self.servers)
+        self.server = self.serve(self.directory)
+        self.connect = lambda host: SSHConnector("tester", "127.0.0.1", KEY,
+                                                 port=self.server.port)
+        self.index_path = os.path.join(self.directory, "index.json")
+
+    def age(self, mtime):
+        """ Set the servers directory's mtime, as the host would see it.
+        Globals:
+            none
+        Arguments:
+            self
+            mtime - the mtime
+        Returns:
+            none
+        """
+        os.utime(self.servers, (mtime, mtime))
+
+    def test_query(self):
+        """ Instances are found by service, version range and slot.
+        """
+        index = InstanceIndex(self.index_path)
+        self.assertEqual(index.refresh(["xldmxs10"], self.connect), [])
+        self.assertEqual(
+            [instance["name"] for instance in index.query()],
+            ["SWAMPBoard-A", "WorkOrderExport_1.10.0-B",
+             "WorkOrderExport_1.2.3-A"])
+        self.assertEqual(
+            [instance["name"] for instance in index.query(
+                services=["WorkOrderExport"], minimum=parse_version("1.3"))],
+            ["WorkOrderExport_1.10.0-B"])
+        self.assertEqual(
+            [instance["host"] for instance in index.query(slots=["A"])],
+            ["xldmxs10", "xldmxs10"])
+
+    def test_cached(self):
+        """ A saved index answers without a command until the ttl passes,
+            then one command relists only if the directory changed.
+        """
+        index = InstanceIndex(self.index_path, ttl=60)
+        index.refresh(["xldmxs10"], self.connect)
+        index.save()
+        self.server.reset()
+        index = InstanceIndex(self.index_path, ttl=60)
+        index.refresh(["xldmxs10"], self.connect)
+        self.assertEqual(self.server.counters["commands"], 0)
+        self.assertEqual(len(index.query()), 3)
+
+        os.makedirs(os.path.join(self.servers, "SWAMPBoard_2.0.0-B"))
+        index.refresh(["xldmxs10"], self.connect)
+        self.assertEqual(len(index.query()), 3)
+        self.age(time.time() - 30)
+        index.refresh(["xldmxs10"], self.connect, force=True)
+        self.assertEqual(self.server.counters["commands"], 1)
+        self.assertEqual(len(index.query(services=["SWAMPBoard"])), 2)
+
+    def test_unreachable(self):
+        """ A host never indexed that can not be reached is reported.
+        """
+        index = InstanceIndex(self.index_path)
+        connect = lambda host: SSHConnector("tester", "127.0.0.1", KEY,
+                                            port=1)
+        self.assertEqual(index.refresh(["xldmxs10"], connect), ["xldmxs10"])
+        self.assertEqual(index.query(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()